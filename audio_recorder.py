@@ -18,8 +18,11 @@
 This module requires pyaudio. See here for installation instructions:
 http://people.csail.mit.edu/hubert/pyaudio/
 
-This module provides one class, AudioRecorder, which buffers chunks of audio
-from PyAudio.
+This module provides AudioRecorder, which buffers audio from PyAudio in a ring
+buffer, and Resampler, which converts the microphone's sample rate to the rate
+a model expects. AudioRecorder is one kind of AudioSource; ArrayAudioSource
+and WavAudioSource play back recorded audio instead, either in real time or
+as fast as it is consumed.
 """
 
 from __future__ import absolute_import
@@ -29,11 +32,14 @@ from __future__ import print_function
 import logging
 
 import math
+import threading
 import time
+import wave
 
 import numpy as np
 import pyaudio
-import queue
+
+import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -43,19 +49,329 @@ class TimeoutError(Exception):
   pass
 
 
-class AudioRecorder(object):
+class Resampler(object):
+  """Streaming polyphase resampler.
+
+  Converts audio between any two integer sample rates by the rational factor
+  up/down, using a Kaiser-windowed sinc low-pass filter to avoid aliasing.
+  Only the filter phase that contributes to each output sample is evaluated,
+  and all output samples of a chunk are computed in one vectorized step.
+  The filter state is carried between calls to process(), so a stream can be
+  fed in chunks of any size.
+
+  Args:
+    input_rate_hz: The sample rate of the audio passed to process().
+    output_rate_hz: The sample rate of the audio returned by process().
+    zero_crossings: The half-length of the filter, in zero crossings of the
+      lower of the two rates. More gives a sharper cutoff at more CPU cost.
+    rolloff: The filter cutoff, as a fraction of the lower Nyquist frequency.
+    kaiser_beta: The Kaiser window shape; higher trades a wider transition
+      band for more stopband attenuation.
+  """
+
+  def __init__(self, input_rate_hz, output_rate_hz, zero_crossings=8,
+               rolloff=0.9, kaiser_beta=8.0):
+    gcd = math.gcd(int(input_rate_hz), int(output_rate_hz))
+    self.up = int(output_rate_hz) // gcd
+    self.down = int(input_rate_hz) // gcd
+    factor = max(self.up, self.down)
+    taps_per_phase = max(1, -(-2 * zero_crossings * factor // self.up))
+    num_taps = taps_per_phase * self.up
+    # The filter runs at the upsampled rate, input_rate_hz * up.
+    cutoff = rolloff / factor
+    n = np.arange(num_taps) - (num_taps - 1) / 2
+    taps = cutoff * np.sinc(cutoff * n) * np.kaiser(num_taps, kaiser_beta) * self.up
+    # _phases[p, j] is taps[p + j * up], the weight of input n - j for an
+    # output that falls at phase p after input n. process() takes dot products
+    # with windows of consecutive inputs, oldest first, so it uses them reversed.
+    phases = taps.reshape(taps_per_phase, self.up).T
+    self._reversed_phases = np.ascontiguousarray(phases[:, ::-1])
+    self._taps_per_phase = taps_per_phase
+    self.reset()
+
+  def reset(self):
+    """Forgets all audio passed to process() so far."""
+    # _buffer[c, :_history_length] holds the input samples of channel c that
+    # pending outputs still need; _history_start is the stream index of the
+    # first one. New audio is appended after them.
+    self._buffer = np.zeros((0, 0))
+    self._history_length = self._taps_per_phase - 1
+    self._history_start = 1 - self._taps_per_phase
+    self._num_outputs = 0
+    self._dot = np.zeros(0)
+
+  @property
+  def _num_inputs(self):
+    return self._history_start + self._history_length
+
+  def input_frames_needed(self, num_outputs):
+    """Returns how many more input samples are needed for num_outputs outputs."""
+    if self.up == self.down:
+      return num_outputs
+    last_input = (self._num_outputs + num_outputs - 1) * self.down // self.up
+    return max(0, last_input + 1 - self._num_inputs)
+
+  def _append(self, audio):
+    """Copies audio of shape (num_samples, num_channels) after the history."""
+    num_channels = audio.shape[1]
+    end = self._history_length + len(audio)
+    if self._buffer.shape[0] != num_channels:
+      self._buffer = np.zeros((num_channels, 2 * end))
+    elif self._buffer.shape[1] < end:
+      buffer = np.zeros((num_channels, 2 * end))
+      buffer[:, :self._history_length] = self._buffer[:, :self._history_length]
+      self._buffer = buffer
+    self._buffer[:, self._history_length:end] = audio.T
+    return end
+
+  def process(self, audio, max_outputs=None):
+    """Resamples the next chunk of a stream.
+
+    The input is copied once into a buffer that is kept between calls, and
+    each output phase is a matrix-vector product over a strided view of that
+    buffer, so the only new array is the returned one.
+
+    Args:
+      audio: np.array of shape (num_samples,) or (num_samples, num_channels).
+      max_outputs: The maximum number of samples to return. Samples that
+        could be computed but aren't are returned by the next call.
+
+    Returns:
+      np.array of the resampled audio, with the same number of dimensions
+      as `audio`.
+    """
+    if self.up == self.down:
+      return np.array(audio, dtype=np.float64)
+    audio = np.asarray(audio)
+    squeeze = audio.ndim == 1
+    if squeeze:
+      audio = audio[:, np.newaxis]
+    buffer_length = self._append(audio)
+    num_inputs = self._history_start + buffer_length
+
+    start = self._num_outputs
+    end = -(-num_inputs * self.up // self.down)
+    if max_outputs is not None:
+      end = min(end, start + max_outputs)
+    output = np.empty((end - start, audio.shape[1]))
+    num_taps = self._taps_per_phase
+    if len(self._dot) < len(output) // self.up + 1:
+      self._dot = np.zeros(2 * (len(output) // self.up + 1))
+
+    for c in range(audio.shape[1]):
+      windows = np.lib.stride_tricks.sliding_window_view(
+          self._buffer[c, :buffer_length], num_taps)
+      # Outputs that are `up` apart have the same phase, and their newest inputs
+      # are `down` apart.
+      for r in range(min(self.up, len(output))):
+        position = (start + r) * self.down
+        first = position // self.up - self._history_start - (num_taps - 1)
+        count = len(range(r, len(output), self.up))
+        dot = self._dot[:count]
+        np.matmul(windows[first::self.down][:count],
+                  self._reversed_phases[position % self.up], out=dot)
+        output[r::self.up, c] = dot
+
+    self._num_outputs = end
+    keep_from = end * self.down // self.up - (num_taps - 1)
+    offset = keep_from - self._history_start
+    self._history_length = buffer_length - offset
+    self._buffer[:, :self._history_length] = self._buffer[:, offset:buffer_length]
+    self._history_start = keep_from
+    return output[:, 0] if squeeze else output
+
+
+class AudioSource(object):
+  """The interface shared by everything that provides audio to a model.
+
+  A source is used as a context manager, and get_audio() returns the next
+  audio as float samples in AudioRecorder's units (int16 values scaled by
+  0.5), at audio_sample_rate_hz.
+  """
+  audio_sample_rate_hz = None
+  num_channels = 1
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exception_type, exception_value, traceback):
+    pass
+
+  @property
+  def is_active(self):
+    return True
+
+  def get_audio(self, num_audio_frames):
+    """Returns the next num_audio_frames frames of audio.
+
+    Returns:
+      A tuple of (audio, first_timestamp, last_timestamp), where audio has
+      shape (num_audio_frames, num_channels) and the timestamps estimate when
+      the first and last samples were recorded, in time.time() seconds.
+
+    Raises:
+      EOFError: if the source has run out of audio.
+    """
+    raise NotImplementedError
+
+
+class ArrayAudioSource(AudioSource):
+  """Plays back audio from a numpy array.
+
+  Multi-channel audio is mixed down to mono, and the audio is resampled to
+  audio_sample_rate_hz. By default get_audio() returns as fast as it is
+  called, which makes it possible to run a model over recorded audio faster
+  than real time; with realtime=True it instead waits until the audio would
+  have been recorded, like a microphone.
+
+  With realtime=True, the timestamps get_audio() returns are when each sample
+  would have been recorded. Otherwise the audio is taken to have just been
+  recorded when it's read, so the newest sample is stamped with the current
+  time, and latencies measured from the timestamps stay meaningful.
+
+  Args:
+    audio: An array of shape (num_samples,) or (num_samples, num_channels),
+      either of int16 samples or of floats in [-1, 1].
+    sample_rate_hz: The sample rate of `audio`.
+    audio_sample_rate_hz: The sample rate to return audio at. Defaults to
+      sample_rate_hz.
+    realtime: Whether to pace get_audio() to the rate of the audio.
+  """
+
+  def __init__(self, audio, sample_rate_hz, audio_sample_rate_hz=None,
+               realtime=False):
+    self._audio = _mix_down(audio)
+    self._init_playback(sample_rate_hz, audio_sample_rate_hz, realtime)
+
+  def _init_playback(self, sample_rate_hz, audio_sample_rate_hz, realtime):
+    self._raw_audio_sample_rate_hz = sample_rate_hz
+    self.audio_sample_rate_hz = audio_sample_rate_hz or sample_rate_hz
+    self._resampler = Resampler(sample_rate_hz, self.audio_sample_rate_hz)
+    self.realtime = realtime
+    self._position = 0
+    self._exhausted = False
+    self._start_time = time.time()
+
+  def __enter__(self):
+    self._start_time = time.time() - self.position_seconds
+    return self
+
+  @property
+  def is_active(self):
+    return not self._exhausted
+
+  @property
+  def position_seconds(self):
+    """How much of the audio has been returned so far, in seconds."""
+    return self._position / self._raw_audio_sample_rate_hz
+
+  @property
+  def duration_seconds(self):
+    """The length of the audio, in seconds."""
+    return len(self._audio) / self._raw_audio_sample_rate_hz
+
+  def _read(self, num_frames):
+    """Returns up to num_frames frames at the current position."""
+    return self._audio[self._position:self._position + num_frames]
+
+  def get_audio(self, num_audio_frames):
+    num_audio_frames = max(1, num_audio_frames)
+    num_raw_frames = self._resampler.input_frames_needed(num_audio_frames)
+    raw_audio = self._read(num_raw_frames)
+    if len(raw_audio) < num_raw_frames:
+      self._exhausted = True
+      raise EOFError("End of audio after %.2f seconds." % self.position_seconds)
+    start_frame = self._position
+    self._position += num_raw_frames
+    audio = self._resampler.process(raw_audio, max_outputs=num_audio_frames)
+    rate = self._raw_audio_sample_rate_hz
+    if not self.realtime:
+      now = time.time()
+      return audio, now - (num_raw_frames - 1) / rate, now
+    delay = self._start_time + self._position / rate - time.time()
+    if delay > 0:
+      time.sleep(delay)
+    return (audio, self._start_time + start_frame / rate,
+            self._start_time + (self._position - 1) / rate)
+
+
+class WavAudioSource(ArrayAudioSource):
+  """Plays back audio from a PCM WAV file.
+
+  The file is read as the audio is consumed, so long recordings don't need
+  to fit in memory. See ArrayAudioSource for the playback behavior.
+
+  Args:
+    filename: Path to a WAV file, or a binary file-like object (e.g. a socket
+      or pipe that provides a WAV stream).
+    audio_sample_rate_hz: The sample rate to return audio at. Defaults to the
+      rate of the file.
+    realtime: Whether to pace get_audio() to the rate of the audio.
+  """
+
+  def __init__(self, filename, audio_sample_rate_hz=None, realtime=False):
+    self._wav = wave.open(filename, 'rb')
+    self._num_frames = self._wav.getnframes()
+    self._init_playback(self._wav.getframerate(), audio_sample_rate_hz, realtime)
+
+  def __exit__(self, exception_type, exception_value, traceback):
+    self._wav.close()
+
+  @property
+  def duration_seconds(self):
+    return self._num_frames / self._raw_audio_sample_rate_hz
+
+  def _read(self, num_frames):
+    data = self._wav.readframes(num_frames)
+    sample_width = self._wav.getsampwidth()
+    if sample_width == 1:
+      # 8-bit WAV samples are unsigned.
+      samples = (np.frombuffer(data, dtype=np.uint8) - 128.0) / 2**7
+    elif sample_width == 3:
+      samples = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+      samples = (samples[:, 0].astype(np.int32) << 8 |
+                 samples[:, 1].astype(np.int32) << 16 |
+                 samples[:, 2].astype(np.int32) << 24) / 2**31
+    else:
+      samples = np.frombuffer(data, dtype='<i%d' % sample_width)
+      samples = samples / 2**(8 * sample_width - 1)
+    return _mix_down(samples.reshape(-1, self._wav.getnchannels()))
+
+
+def _mix_down(audio):
+  """Converts audio to mono float samples in AudioRecorder's units."""
+  audio = np.asarray(audio)
+  if audio.ndim == 1:
+    audio = audio[:, np.newaxis]
+  if not np.issubdtype(audio.dtype, np.integer):
+    audio = audio * 2**15
+  return 0.5 * audio.mean(axis=1, keepdims=True)
+
+
+class AudioRecorder(AudioSource):
   """Asynchronously record and buffer audio using pyaudio.
 
-  This class wraps the pyaudio interface. It contains a queue.Queue object to
-  hold chunks of raw audio, and a callback function _enqueue_audio() which
-  places raw audio into this queue. This allows the pyaudio.Stream object to
-  record asynchronously at low latency.
+  This class wraps the pyaudio interface. It contains a preallocated ring
+  buffer of raw audio samples, and a callback function _enqueue_raw_audio()
+  which copies each chunk from PyAudio straight into the buffer. This allows
+  the pyaudio.Stream object to record asynchronously at low latency.
+
+  The callback is the only writer and get_audio() the only reader, so the
+  two sides coordinate through a pair of ever-increasing frame counters
+  instead of a lock: the callback publishes new audio by advancing the write
+  counter after copying it in, and get_audio() frees space by advancing the
+  read counter after copying audio out. If the reader falls so far behind
+  that a chunk doesn't fit, the chunk is dropped and counted in `overflows`
+  rather than raising on the audio thread.
+
+  Audio is recorded at raw_audio_sample_rate_hz and converted to
+  audio_sample_rate_hz with a Resampler, so any microphone rate works (e.g.
+  44.1 kHz, 22.05 kHz or 8 kHz). If audio_sample_rate_hz isn't given, it is
+  raw_audio_sample_rate_hz // downsample_factor.
 
   The class acts as a context manager. When entering the context it creates a
   pyaudio.Stream object and starts recording; it stops recording on exit. The
-  Stream saves all of its audio to the Queue as two-tuples of
-  (timestamp, raw_audio). The raw_audio is available from the queue as a numpy
-  array using the get_audio() function.
+  buffered audio is available as a numpy array using the get_audio() function.
 
   This class uses the term "frame" in the same sense that PortAudio does, so
   "frame" means something different here than elsewhere in the daredevil stack.
@@ -70,20 +386,35 @@ class AudioRecorder(object):
   # Higher numbers will increase the latancy.
   frames_per_chunk = 2**9
 
-  # Limit queue to this number of audio chunks.
+  # Size the ring buffer to hold this number of audio chunks.
   max_queue_chunks = 1200
 
-  # Timeout if we can't get a chunk from the queue for timeout_factor times the
-  # chunk duration.
+  # Timeout if we can't get audio for timeout_factor times the chunk duration
+  # (on top of the duration of the requested audio).
   timeout_factor = 40
 
   def __init__(self, raw_audio_sample_rate_hz=48000,
                      downsample_factor=3,
-                     device_index=None):
-    self._downsample_factor = downsample_factor
+                     device_index=None,
+                     audio_sample_rate_hz=None):
     self._raw_audio_sample_rate_hz = raw_audio_sample_rate_hz
-    self.audio_sample_rate_hz = self._raw_audio_sample_rate_hz // self._downsample_factor
-    self._raw_audio_queue = queue.Queue(self.max_queue_chunks)
+    if audio_sample_rate_hz is None:
+      audio_sample_rate_hz = raw_audio_sample_rate_hz // downsample_factor
+    self.audio_sample_rate_hz = audio_sample_rate_hz
+    self._resampler = Resampler(raw_audio_sample_rate_hz, audio_sample_rate_hz)
+    self._buffer = np.zeros((self.max_queue_chunks * self.frames_per_chunk,
+                             self.num_channels), dtype=self.numpy_format)
+    # Scratch space for the scaled frames of a get_audio() call; the resampler
+    # copies them, so it's reused.
+    self._raw_audio = np.zeros((0, self.num_channels))
+    self._write_frames = 0
+    self._read_frames = 0
+    # (total frames written, time.time()) as of the most recent chunk.
+    self._latest_chunk = (0, time.time())
+    self._data_ready = threading.Event()
+    self.overflows = 0
+    self.overflow_frames = 0
+    self._reported_overflows = 0
     self._audio = pyaudio.PyAudio()
     self._print_input_devices()
     self._device_index = device_index
@@ -134,6 +465,11 @@ class AudioRecorder(object):
   def _chunk_duration_seconds(self):
     return self.frames_per_chunk / self._raw_audio_sample_rate_hz
 
+  @property
+  def buffered_frames(self):
+    """The number of raw frames recorded but not yet read."""
+    return self._write_frames - self._read_frames
+
   def _print_input_devices(self):
     info = self._audio.get_host_api_info_by_index(0)
     print("\nInput microphone devices:")
@@ -143,19 +479,50 @@ class AudioRecorder(object):
       print("  ID: ", i, " - ", device_info.get("name"))
 
   def _enqueue_raw_audio(self, in_data, *_):  # unused args to match expected
-    try:
-      self._raw_audio_queue.put((in_data, time.time()), block=False)
-      return None, pyaudio.paContinue
-    except queue.Full:
-      error_message = "Raw audio buffer full."
-      logger.critical(error_message)
-      raise TimeoutError(error_message)
-
-  def _get_chunk(self, timeout=None):
-    raw_data, timestamp = self._raw_audio_queue.get(timeout=timeout)
-    array_data = np.fromstring(raw_data, self.numpy_format).reshape(
+    chunk = np.frombuffer(in_data, self.numpy_format).reshape(
         -1, self.num_channels)
-    return array_data, timestamp
+    num_frames = len(chunk)
+    capacity = len(self._buffer)
+    write_frames = self._write_frames
+    if write_frames + num_frames - self._read_frames > capacity:
+      self.overflows += 1
+      self.overflow_frames += num_frames
+    else:
+      start = write_frames % capacity
+      split = min(num_frames, capacity - start)
+      self._buffer[start:start + split] = chunk[:split]
+      self._buffer[:num_frames - split] = chunk[split:]
+      self._write_frames = write_frames + num_frames
+      self._latest_chunk = (self._write_frames, time.time())
+    self._data_ready.set()
+    return None, pyaudio.paContinue
+
+  def _wait_for_frames(self, num_frames, timeout):
+    deadline = time.monotonic() + timeout
+    while self.buffered_frames < num_frames:
+      self._data_ready.clear()
+      # Check again, in case the callback wrote audio before the clear().
+      if self.buffered_frames >= num_frames:
+        break
+      remaining = deadline - time.monotonic()
+      if remaining <= 0 or not self._data_ready.wait(remaining):
+        error_message = "Audio capture timed out after %.1f seconds." % timeout
+        logger.critical(error_message)
+        raise TimeoutError(error_message)
+
+  def _frame_timestamp(self, frame_index):
+    """Estimates the wall clock time at which a raw frame was recorded."""
+    latest_frames, latest_time = self._latest_chunk
+    return latest_time - ((latest_frames - frame_index) /
+                          self._raw_audio_sample_rate_hz)
+
+  def _copy_out(self, start_frame, num_frames, out):
+    """Copies num_frames buffered frames into out, scaled by 0.5."""
+    capacity = len(self._buffer)
+    start = start_frame % capacity
+    split = min(num_frames, capacity - start)
+    np.multiply(self._buffer[start:start + split], 0.5, out=out[:split])
+    np.multiply(self._buffer[:num_frames - split], 0.5, out=out[split:])
 
   def get_audio_device_info(self):
     if self._device_index is None:
@@ -167,54 +534,53 @@ class AudioRecorder(object):
     return num_samples / self.audio_sample_rate_hz / self.num_channels
 
   def clear_queue(self):
-    logger.debug("Purging %d chunks from queue.", self._raw_audio_queue.qsize())
-    while not self._raw_audio_queue.empty():
-      self._raw_audio_queue.get()
+    logger.debug("Purging %d frames from buffer.", self.buffered_frames)
+    self._read_frames = self._write_frames
 
   def get_audio(self, num_audio_frames):
-    """Grab at least num_audio_frames frames of audio.
+    """Grab num_audio_frames frames of audio.
 
-    Record at least num_audio_frames of audio and transform it into a
+    Wait until num_audio_frames of audio are recorded and transform it into a
     numpy array. The term "frame" is in the sense used by PortAudio; see the
     note in the class docstring for details.
 
-    Audio returned will be the earliest audio in the queue; it could be from
+    Audio returned will be the earliest audio in the buffer; it could be from
     before this function was called.
 
     Args:
-      num_audio_frames: minimum number of samples of audio to grab.
+      num_audio_frames: number of samples of audio to grab.
 
     Returns:
-      A tuple of (audio, first_timestamp, last_timestamp).
+      A tuple of (audio, first_timestamp, last_timestamp), where the
+      timestamps estimate when the first and last returned samples were
+      recorded, in time.time() seconds.
     """
-    num_audio_chunks = int(math.ceil(num_audio_frames *
-                    self._downsample_factor / self.frames_per_chunk))
-    logger.debug("Capturing %d chunks to get at least %d frames.",
-                 num_audio_chunks, num_audio_frames)
-    if num_audio_chunks < 1:
-      num_audio_chunks = 1
-    try:
-      timeout = self.timeout_factor * self._chunk_duration_seconds
-      chunks, timestamps = zip(
-          *[self._get_chunk(timeout=timeout) for _ in range(num_audio_chunks)])
-    except queue.Empty:
-      error_message = "Audio capture timed out after %.1f seconds." % timeout
-      logger.critical(error_message)
-      raise TimeoutError(error_message)
-
-    assert len(chunks) == num_audio_chunks
-    logger.debug("Got %d chunks. Chunk 0 has shape %s and dtype %s.",
-                 len(chunks), chunks[0].shape, chunks[0].dtype)
-    if self._raw_audio_queue.qsize() > (0.8 * self.max_queue_chunks):
-      logger.warning("%d chunks remain in the queue.",
-                     self._raw_audio_queue.qsize())
-    else:
-      logger.debug("%d chunks remain in the queue.",
-                   self._raw_audio_queue.qsize())
-
-    audio = np.concatenate(chunks)
-    if self._downsample_factor != 1:
-      audio = audio[::self._downsample_factor]
+    num_audio_frames = max(1, num_audio_frames)
+    num_raw_frames = self._resampler.input_frames_needed(num_audio_frames)
+    if num_raw_frames > len(self._buffer):
+      raise ValueError("Can't get %d frames from a %d frame buffer." %
+                       (num_raw_frames, len(self._buffer)))
+    timeout = (self.timeout_factor * self._chunk_duration_seconds +
+               num_raw_frames / self._raw_audio_sample_rate_hz)
+    self._wait_for_frames(num_raw_frames, timeout)
+
+    if self.overflows != self._reported_overflows:
+      logger.warning("Raw audio buffer full, dropped %d frames so far.",
+                     self.overflow_frames)
+      metrics.count("audio.overflows", self.overflows - self._reported_overflows)
+      self._reported_overflows = self.overflows
+    if self.buffered_frames > (0.8 * len(self._buffer)):
+      logger.warning("%d frames remain in the buffer.", self.buffered_frames)
+
+    start_frame = self._read_frames
+    if len(self._raw_audio) < num_raw_frames:
+      self._raw_audio = np.zeros((num_raw_frames, self.num_channels))
+    raw_audio = self._raw_audio[:num_raw_frames]
+    self._copy_out(start_frame, num_raw_frames, raw_audio)
+    # Only now may the callback reuse this part of the buffer.
+    self._read_frames = start_frame + num_raw_frames
+    audio = self._resampler.process(raw_audio, max_outputs=num_audio_frames)
     logging.debug("Audio array has shape %s and dtype %s.", audio.shape,
                   audio.dtype)
-    return audio * 0.5, timestamps[0], timestamps[-1]
+    return (audio, self._frame_timestamp(start_frame),
+            self._frame_timestamp(start_frame + max(num_raw_frames, 1) - 1))
@@ -0,0 +1,247 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Selects how a .tflite model is executed.
+
+Three backends are available:
+
+  * 'edgetpu': the model runs on a Coral Edge TPU (the default).
+  * 'cpu': the model runs on the CPU with the TensorFlow Lite runtime, which uses
+    XNNPACK where it can. Edge TPU models can't run on the CPU, so for a model
+    named `foo_edgetpu.tflite` the CPU backend loads `foo.tflite` if it exists.
+  * 'stub': a pure-NumPy stand-in that has the same tensors as the real model
+    but returns canned results. It needs no model file, so it is useful to run
+    the scripts headless, e.g. in CI.
+
+The default backend can be set with the EDGE_ML_BACKEND environment variable,
+and the default number of CPU threads with EDGE_ML_NUM_THREADS.
+"""
+
+import os
+import platform
+
+import numpy as np
+import tflite_runtime.interpreter as tflite
+
+EDGETPU = 'edgetpu'
+CPU = 'cpu'
+STUB = 'stub'
+BACKENDS = (EDGETPU, CPU, STUB)
+
+_EDGETPU_SHARED_LIB = {
+  'Linux': 'libedgetpu.so.1',
+  'Darwin': 'libedgetpu.1.dylib',
+  'Windows': 'edgetpu.dll'
+}[platform.system()]
+
+
+def default_backend():
+  """Returns the backend named by EDGE_ML_BACKEND, or 'edgetpu'."""
+  return os.environ.get('EDGE_ML_BACKEND', EDGETPU)
+
+
+def default_num_threads():
+  """Returns the thread count named by EDGE_ML_NUM_THREADS, or the CPU count."""
+  return int(os.environ.get('EDGE_ML_NUM_THREADS', os.cpu_count() or 1))
+
+
+def cpu_model_path(model_file):
+  """Returns the path of the CPU version of an Edge TPU model, if it exists.
+
+  Args:
+    model_file: Path to a `.tflite` file.
+
+  Returns:
+    `foo.tflite` if `model_file` is `foo_edgetpu.tflite` and `foo.tflite` exists,
+    otherwise `model_file`.
+  """
+  root, ext = os.path.splitext(model_file)
+  if root.endswith('_edgetpu'):
+    cpu_file = root[:-len('_edgetpu')] + ext
+    if os.path.exists(cpu_file):
+      return cpu_file
+  return model_file
+
+
+def make_interpreter(model_file, backend=None, num_threads=None, stub=None):
+  """Creates an interpreter for the given model and backend.
+
+  Args:
+    model_file: Path to a `.tflite` file. For the Edge TPU backend, you can pick a device by
+      appending it after an '@', as in `model.tflite@usb:0` or `model.tflite@:1`.
+    backend: One of 'edgetpu', 'cpu' or 'stub'. Defaults to `default_backend()`.
+    num_threads: The number of threads for the CPU backend. Defaults to
+      `default_num_threads()`.
+    stub: A `StubModel` describing the model, required for the stub backend.
+
+  Returns:
+    An interpreter with the `tflite.Interpreter` API. Call `allocate_tensors()` before use.
+
+  Raises:
+    ValueError: if the backend is unknown, or the stub backend is used without a stub.
+  """
+  backend = backend or default_backend()
+  model_file, *device = model_file.split('@')
+  if backend == EDGETPU:
+    return tflite.Interpreter(
+        model_path=model_file,
+        experimental_delegates=[tflite.load_delegate(_EDGETPU_SHARED_LIB,
+                                {'device': device[0]} if device else {})])
+  if backend == CPU:
+    return tflite.Interpreter(
+        model_path=cpu_model_path(model_file),
+        num_threads=num_threads or default_num_threads())
+  if backend == STUB:
+    if stub is None:
+      raise ValueError('The stub backend needs a StubModel for %s' % model_file)
+    return StubInterpreter(stub)
+  raise ValueError('Unknown backend %r, must be one of: %s' %
+                   (backend, ', '.join(BACKENDS)))
+
+
+class StubModel(object):
+  """Describes the tensors and behavior of a model for the stub backend.
+
+  Args:
+    inputs: A list of (shape, dtype, quantization) tuples, one per input tensor.
+    outputs: A list of (shape, dtype, quantization) tuples, one per output tensor.
+      `quantization` is a (scale, zero_point) tuple, or (0.0, 0) if not quantized.
+    run: A function that takes the list of input arrays and returns a list of output
+      arrays (or values that broadcast to the output shapes).
+  """
+
+  def __init__(self, inputs, outputs, run):
+    self.inputs = inputs
+    self.outputs = outputs
+    self.run = run
+
+
+class StubInterpreter(object):
+  """A NumPy implementation of the parts of `tflite.Interpreter` used in this repo."""
+
+  def __init__(self, model):
+    self._model = model
+    self._specs = list(model.inputs) + list(model.outputs)
+    self._tensors = None
+
+  def allocate_tensors(self):
+    self._tensors = [np.zeros(shape, dtype) for shape, dtype, _ in self._specs]
+
+  def _details(self, index):
+    shape, dtype, (scale, zero_point) = self._specs[index]
+    return {
+        'name': 'stub_%d' % index,
+        'index': index,
+        'shape': np.array(shape, dtype=np.int32),
+        'shape_signature': np.array(shape, dtype=np.int32),
+        'dtype': dtype,
+        'quantization': (scale, zero_point),
+        'quantization_parameters': {
+            'scales': np.array([scale], dtype=np.float32),
+            'zero_points': np.array([zero_point], dtype=np.int32),
+            'quantized_dimension': 0,
+        },
+        'sparsity_parameters': {},
+    }
+
+  def get_input_details(self):
+    return [self._details(i) for i in range(len(self._model.inputs))]
+
+  def get_output_details(self):
+    first = len(self._model.inputs)
+    return [self._details(i) for i in range(first, len(self._specs))]
+
+  def get_signature_list(self):
+    return {}
+
+  def _get_full_signature_list(self):
+    return {}
+
+  def tensor(self, tensor_index):
+    return lambda: self._tensors[tensor_index]
+
+  def get_tensor(self, tensor_index):
+    return self._tensors[tensor_index].copy()
+
+  def set_tensor(self, tensor_index, value):
+    np.copyto(self._tensors[tensor_index], value)
+
+  def invoke(self):
+    num_inputs = len(self._model.inputs)
+    results = self._model.run(self._tensors[:num_inputs])
+    for tensor, result in zip(self._tensors[num_inputs:], results):
+      tensor[...] = result
+
+
+def _quantize(value, scale):
+  return np.uint8(min(255, round(value / scale)))
+
+
+def detection_stub(input_size=(300, 300)):
+  """Returns a StubModel for an SSD detection model with postprocessing.
+
+  The model always detects one object of class 0 in the middle of the image.
+  """
+  width, height = input_size
+
+  def run(inputs):
+    boxes = [[[0.25, 0.25, 0.75, 0.75]]]
+    return boxes, [[0.0]], [[0.5]], [1.0]
+
+  return StubModel(
+      inputs=[((1, height, width, 3), np.uint8, (0.0078125, 128))],
+      outputs=[((1, 1, 4), np.float32, (0.0, 0)),
+               ((1, 1), np.float32, (0.0, 0)),
+               ((1, 1), np.float32, (0.0, 0)),
+               ((1,), np.float32, (0.0, 0))],
+      run=run)
+
+
+def classification_stub(num_classes=1001, input_size=(224, 224)):
+  """Returns a StubModel for a quantized image classification model.
+
+  The top class is derived from the mean pixel value, so different images give
+  different (but repeatable) results.
+  """
+  width, height = input_size
+  scale = 1.0 / 256
+
+  def run(inputs):
+    scores = np.zeros((1, num_classes), dtype=np.uint8)
+    scores[0, int(inputs[0].mean()) % num_classes] = _quantize(0.8, scale)
+    return [scores]
+
+  return StubModel(
+      inputs=[((1, height, width, 3), np.uint8, (0.0078125, 128))],
+      outputs=[((1, num_classes), np.uint8, (scale, 0))],
+      run=run)
+
+
+def keyword_stub(num_classes, spectrogram_shape=(198, 32)):
+  """Returns a StubModel for the keyword spotter model.
+
+  The model always reports the 'negative' class (index 0), so nothing is
+  ever detected.
+  """
+  scale = 1.0 / 256
+
+  def run(inputs):
+    scores = np.zeros((1, num_classes), dtype=np.uint8)
+    scores[0, 0] = _quantize(0.9, scale)
+    return [scores]
+
+  return StubModel(
+      inputs=[((1,) + tuple(spectrogram_shape), np.uint8, (1.0, 0))],
+      outputs=[((1, num_classes), np.uint8, (scale, 0))],
+      run=run)
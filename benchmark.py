@@ -0,0 +1,340 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks for the vision and voice hot paths, using synthetic data.
+
+Compare per-clip and batched mel spectrograms:
+  python3 benchmark.py mel_batch --num_clips 500
+
+Run the whole suite headless and save the results, then compare another commit
+against them (models run on the cpu backend if the CPU versions of the models
+are in models/, and otherwise on the stub backend, unless --backend is given):
+  python3 benchmark.py suite --json before.json
+  python3 benchmark.py suite --baseline before.json --max_regression 10
+
+The suite reports p50/p95/p99 latency and throughput for each case, and the
+memory each call allocates (as seen by tracemalloc). Cases whose dependencies
+(such as pyaudio, or the model files for the cpu backend) are missing are skipped.
+"""
+
+import argparse
+import collections
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import mel_features
+
+def best_time(fn, repeat):
+  """Returns the fastest of `repeat` runs of fn(), in seconds."""
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - start)
+  return min(times)
+
+def bench_mel_batch(num_clips, clip_seconds, dtype, repeat, sample_rate_hz=16000):
+  """Compares log_mel_spectrogram() in a loop against log_mel_spectrogram_batch()."""
+  rng = np.random.default_rng(0)
+  num_samples = int(clip_seconds * sample_rate_hz)
+  # Vary the clip lengths by up to 20% so the batch has to pad.
+  clips = [0.1 * rng.standard_normal(int(num_samples * rng.uniform(0.8, 1.0)))
+           for _ in range(num_clips)]
+  kwargs = dict(audio_sample_rate=sample_rate_hz, log_offset=0.001,
+                num_mel_bins=32, lower_edge_hertz=60, upper_edge_hertz=3800)
+
+  def loop():
+    for clip in clips:
+      mel_features.log_mel_spectrogram(clip, dtype=dtype, **kwargs)
+
+  def batch():
+    mel_features.log_mel_spectrogram_batch(clips, dtype=dtype, **kwargs)
+
+  loop_seconds = best_time(loop, repeat)
+  batch_seconds = best_time(batch, repeat)
+  print('%d clips of up to %.2f s, %s' % (num_clips, clip_seconds, dtype))
+  print('  per-clip loop: %8.1f clips/sec' % (num_clips / loop_seconds))
+  print('  batched:       %8.1f clips/sec (%.2fx)' % (num_clips / batch_seconds,
+                                                      loop_seconds / batch_seconds))
+
+def measure(fn, iterations, warmup=10, setup=None, alloc_iterations=20):
+  """Times fn() and measures its allocations.
+
+  Args:
+    fn: The function to benchmark.
+    iterations: The number of timed calls.
+    warmup: The number of untimed calls first.
+    setup: An optional function called before each call of fn(), and not timed.
+    alloc_iterations: The number of calls to measure allocations on; these run
+      separately, because tracemalloc slows everything down.
+
+  Returns:
+    A dict of results.
+  """
+  for _ in range(warmup):
+    if setup:
+      setup()
+    fn()
+
+  times = np.empty(iterations)
+  for i in range(iterations):
+    if setup:
+      setup()
+    start = time.perf_counter()
+    fn()
+    times[i] = time.perf_counter() - start
+
+  tracemalloc.start()
+  peak = retained = 0
+  for _ in range(alloc_iterations):
+    if setup:
+      setup()
+    before = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    fn()
+    current, peak_now = tracemalloc.get_traced_memory()
+    peak = max(peak, peak_now - before)
+    retained += current - before
+  tracemalloc.stop()
+
+  p50, p95, p99 = np.percentile(times, [50, 95, 99])
+  return {
+    'iterations': iterations,
+    'mean_ms': 1000 * float(times.mean()),
+    'p50_ms': 1000 * float(p50),
+    'p95_ms': 1000 * float(p95),
+    'p99_ms': 1000 * float(p99),
+    'throughput_per_s': iterations / float(times.sum()),
+    'alloc_peak_kib': peak / 1024,
+    'alloc_retained_kib': retained / 1024 / max(alloc_iterations, 1),
+  }
+
+def synthetic_frame(seed=0):
+  """Returns a random camera frame, as BGR uint8."""
+  width, height = 640, 480
+  return np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+def synthetic_audio(seconds, sample_rate_hz=16000, seed=0):
+  """Returns noise in the int16 range, as float32."""
+  rng = np.random.default_rng(seed)
+  return (3000 * rng.standard_normal(int(seconds * sample_rate_hz))).astype(np.float32)
+
+# Each case takes the parsed arguments and returns the function to benchmark, or a
+# (function, setup) tuple. ImportError, OSError and ValueError skip the case.
+
+def case_detector(args):
+  import vision
+  detector = vision.Detector(vision.OBJECT_DETECTION_MODEL, backend=args.backend,
+                             num_threads=args.num_threads)
+  frame = synthetic_frame()
+  return lambda: detector.get_objects(frame, threshold=0.5)
+
+def case_classifier(args):
+  import vision
+  classifier = vision.Classifier(vision.CLASSIFICATION_MODEL, backend=args.backend,
+                                 num_threads=args.num_threads)
+  frame = synthetic_frame()
+  return lambda: classifier.get_classes(frame)
+
+def case_draw_objects(args):
+  import vision
+  from pycoral.adapters import detect
+  frame = synthetic_frame()
+  objs = [detect.Object(i, 0.9, detect.BBox(40 * i, 30 * i, 40 * i + 120, 30 * i + 90))
+          for i in range(10)]
+  labels = {i: 'object %d' % i for i in range(10)}
+  return lambda: vision.draw_objects(frame, objs, labels)
+
+def case_log_mel(args):
+  audio = synthetic_audio(1.0) / 2**15
+  return lambda: mel_features.log_mel_spectrogram(
+      audio, audio_sample_rate=16000, log_offset=0.001, window_length_secs=0.025,
+      hop_length_secs=0.010, num_mel_bins=32, lower_edge_hertz=60, upper_edge_hertz=3800)
+
+def case_get_next_spectrogram(args):
+  import audio_recorder
+  import voice
+
+  class LoopingSource(audio_recorder.AudioSource):
+    """Replays a few seconds of noise forever, so only the extractor is measured."""
+    audio_sample_rate_hz = voice.MODEL_SAMPLE_RATE_HZ
+
+    def __init__(self, audio):
+      self._audio = np.concatenate([audio, audio]).reshape(-1, 1)
+      self._length = len(audio)
+      self._position = 0
+
+    def get_audio(self, num_audio_frames):
+      start = self._position % self._length
+      self._position += num_audio_frames
+      now = time.time()
+      return self._audio[start:start + num_audio_frames], now, now
+
+  extractor = voice.Uint8LogMelFeatureExtractor(num_frames_hop=33)
+  source = LoopingSource(synthetic_audio(4.0))
+  extractor.get_next_spectrogram(source)  # Fill the first window.
+  return lambda: extractor.get_next_spectrogram(source)
+
+def case_get_audio(args):
+  import audio_recorder
+  recorder = audio_recorder.AudioRecorder()
+  # One 33-frame hop of 16 kHz audio, recorded at 48 kHz. The recorder isn't started;
+  # the setup feeds it chunks as the PyAudio callback would.
+  num_frames = 33 * 160
+  num_chunks = -(-recorder._resampler.input_frames_needed(num_frames) //
+                 recorder.frames_per_chunk)
+  chunk = (synthetic_audio(recorder.frames_per_chunk / 48000, 48000)
+           .astype(np.int16).tobytes())
+
+  def setup():
+    while recorder.buffered_frames < num_chunks * recorder.frames_per_chunk:
+      recorder._enqueue_raw_audio(chunk)
+
+  return lambda: recorder.get_audio(num_frames), setup
+
+def default_backend():
+  """Returns 'cpu' if the CPU versions of the suite's models exist, else 'stub'.
+
+  Stub models measure nothing about inference, so falling back to them is announced.
+  """
+  try:
+    import backends
+    import vision
+  except ImportError as e:
+    print('Timing models on the stub backend (%s).' % e, file=sys.stderr)
+    return 'stub'
+  models = [vision.OBJECT_DETECTION_MODEL, vision.CLASSIFICATION_MODEL]
+  missing = [m for m in models if backends.cpu_model_path(m) == m]
+  if missing:
+    print('Timing models on the stub backend, because the CPU versions of %s are missing.' %
+          ', '.join(missing), file=sys.stderr)
+    return 'stub'
+  return 'cpu'
+
+CASES = collections.OrderedDict([
+  ('detector', case_detector),
+  ('classifier', case_classifier),
+  ('draw_objects', case_draw_objects),
+  ('log_mel', case_log_mel),
+  ('get_next_spectrogram', case_get_next_spectrogram),
+  ('get_audio', case_get_audio),
+])
+
+def run_suite(names, args):
+  """Runs the named cases and returns the results as a JSON-serializable dict."""
+  results = {
+    'meta': {
+      'backend': args.backend,
+      'python': platform.python_version(),
+      'numpy': np.__version__,
+      'machine': platform.machine(),
+      'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    },
+    'cases': {},
+    'skipped': {},
+  }
+  for name in names:
+    try:
+      case = CASES[name](args)
+    except (ImportError, OSError, ValueError) as e:
+      results['skipped'][name] = '%s: %s' % (type(e).__name__, e)
+      print('%-22s skipped (%s)' % (name, results['skipped'][name]))
+      continue
+    fn, setup = case if isinstance(case, tuple) else (case, None)
+    result = measure(fn, args.iterations, args.warmup, setup)
+    results['cases'][name] = result
+    print('%-22s p50 %8.3f ms  p95 %8.3f ms  p99 %8.3f ms  %9.1f/s  peak %8.1f KiB' % (
+        name, result['p50_ms'], result['p95_ms'], result['p99_ms'],
+        result['throughput_per_s'], result['alloc_peak_kib']))
+  return results
+
+def compare(baseline, results, max_regression=None):
+  """Prints how each case changed from a baseline, and returns the regressed cases.
+
+  A case regresses if its p50 latency grew by more than max_regression percent.
+  """
+  regressions = []
+  print('\nChange from baseline (%s):' % baseline['meta'].get('time', '?'))
+  for name, result in results['cases'].items():
+    old = baseline['cases'].get(name)
+    if old is None:
+      print('  %-22s (new)' % name)
+      continue
+    changes = {key: 100 * (result[key] - old[key]) / old[key] if old[key] else 0.0
+               for key in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_per_s')}
+    regressed = max_regression is not None and changes['p50_ms'] > max_regression
+    print('  %-22s p50 %+6.1f%%  p95 %+6.1f%%  p99 %+6.1f%%  throughput %+6.1f%%  '
+          'peak %+.1f KiB%s' % (
+              name, changes['p50_ms'], changes['p95_ms'], changes['p99_ms'],
+              changes['throughput_per_s'], result['alloc_peak_kib'] - old['alloc_peak_kib'],
+              '  REGRESSION' if regressed else ''))
+    if regressed:
+      regressions.append(name)
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('benchmark', choices=['mel_batch', 'suite'],
+                      help='Benchmark to run')
+  parser.add_argument('--num_clips', type=int, default=500,
+                      help='Number of synthetic audio clips')
+  parser.add_argument('--clip_seconds', type=float, default=1.0,
+                      help='Maximum clip duration')
+  parser.add_argument('--dtype', choices=['float64', 'float32'], default='float64',
+                      help='Floating point type for feature computation')
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='Runs per measurement; the fastest is reported')
+  parser.add_argument('--cases', nargs='+', choices=list(CASES), default=list(CASES),
+                      help='Suite cases to run')
+  parser.add_argument('--iterations', type=int, default=200,
+                      help='Timed calls per suite case')
+  parser.add_argument('--warmup', type=int, default=10,
+                      help='Untimed calls before timing each suite case')
+  parser.add_argument('--backend', choices=['edgetpu', 'cpu', 'stub'], default=None,
+                      help='How to run the models in the suite (default: cpu if the CPU '
+                           'models are present, else stub)')
+  parser.add_argument('--num_threads', type=int, default=None,
+                      help='Number of threads for the cpu backend')
+  parser.add_argument('--json', type=str, default=None,
+                      help='Write the suite results to this JSON file')
+  parser.add_argument('--baseline', type=str, default=None,
+                      help='Compare the suite results with this JSON file')
+  parser.add_argument('--max_regression', type=float, default=None,
+                      help='Exit with an error if a case\'s p50 latency grew by more than '
+                           'this percentage over the baseline')
+  args = parser.parse_args()
+
+  if args.benchmark == 'mel_batch':
+    bench_mel_batch(args.num_clips, args.clip_seconds, args.dtype, args.repeat)
+  elif args.benchmark == 'suite':
+    if args.backend is None:
+      args.backend = default_backend()
+    results = run_suite(args.cases, args)
+    if args.json:
+      with open(args.json, 'w') as f:
+        json.dump(results, f, indent=2)
+    if args.baseline:
+      with open(args.baseline) as f:
+        baseline = json.load(f)
+      if compare(baseline, results, args.max_regression):
+        sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,109 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs the keyword spotter over recorded WAV files.
+
+By default the files are processed as fast as possible, and the script
+reports the real-time factor: processing time divided by audio duration, so
+0.1 means ten times faster than real time. For example:
+
+  python3 classify_audio_files.py recordings/
+  EDGE_ML_BACKEND=stub python3 classify_audio_files.py recordings/*.wav
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import audio_recorder
+import metrics
+import voice
+
+
+def find_wavs(paths):
+  """Returns the WAV files in paths, searching directories recursively."""
+  wavs = []
+  for path in paths:
+    if os.path.isdir(path):
+      for root, _, files in os.walk(path):
+        wavs.extend(os.path.join(root, name) for name in sorted(files)
+                    if name.lower().endswith('.wav'))
+    else:
+      wavs.append(path)
+  return wavs
+
+
+def classify_file(wav_file, model, labels, realtime=False, **kwargs):
+  """Prints the keywords detected in one WAV file.
+
+  Returns:
+    A tuple of (audio duration, processing time) in seconds.
+  """
+  source = audio_recorder.WavAudioSource(
+      wav_file, audio_sample_rate_hz=voice.MODEL_SAMPLE_RATE_HZ, realtime=realtime)
+
+  def callback(label, score):
+    print('%s\t%.2f\t%s\t%.2f' % (wav_file, source.position_seconds, label, score))
+    return True
+
+  start = time.monotonic()
+  voice.classify_audio(model, labels, callback, audio_source=source, **kwargs)
+  return source.duration_seconds, time.monotonic() - start
+
+
+def main():
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('inputs', nargs='+',
+                      help='WAV files, or directories to search for WAV files')
+  parser.add_argument('-m', '--model', default=voice.VOICE_MODEL,
+                      help='File path of .tflite file.')
+  parser.add_argument('-l', '--labels', default=voice.VOICE_LABELS,
+                      help='File path of labels file.')
+  parser.add_argument('--realtime', action='store_true',
+                      help='Play the files back at real time speed, like a mic')
+  parser.add_argument('--num_frames_hop', type=int, default=33,
+                      help='Spectrogram frames between inferences')
+  parser.add_argument('--window_hops', type=int, default=1,
+                      help='Number of hops to average the scores over')
+  parser.add_argument('--refractory_hops', type=int, default=0,
+                      help='Hops to wait after a detection before detecting again')
+  parser.add_argument('--vad', action='store_true',
+                      help='Only run the model when there may be speech')
+  parser.add_argument('--backend', choices=['edgetpu', 'cpu', 'stub'], default=None,
+                      help='How to run the model (default: $EDGE_ML_BACKEND or edgetpu)')
+  parser.add_argument('--num_threads', type=int, default=None,
+                      help='Number of threads for the cpu backend')
+  args = parser.parse_args()
+  metrics.start_from_env()
+
+  total_audio = total_time = 0.0
+  for wav_file in find_wavs(args.inputs):
+    duration, elapsed = classify_file(
+        wav_file, args.model, args.labels, realtime=args.realtime,
+        num_frames_hop=args.num_frames_hop, window_hops=args.window_hops,
+        refractory_hops=args.refractory_hops, vad=args.vad, backend=args.backend,
+        num_threads=args.num_threads)
+    print('%s: %.1f s of audio in %.2f s, real-time factor %.3f' % (
+        wav_file, duration, elapsed, elapsed / max(duration, 1e-9)), file=sys.stderr)
+    total_audio += duration
+    total_time += elapsed
+
+  if total_audio:
+    print('Total: %.1f s of audio in %.2f s, real-time factor %.3f' % (
+        total_audio, total_time, total_time / total_audio), file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
@@ -14,13 +14,18 @@
 
 import argparse
 import contextlib
+import csv
+import json
+import os
 import select
 import sys
 import termios
+import time
 import tty
 
 from cv2 import imread
 from pycoral.utils.dataset import read_label_file
+import metrics
 import vision
 
 classifier = vision.Classifier(vision.CLASSIFICATION_MODEL)
@@ -48,6 +53,61 @@ def classify_image(frame):
   print(label, score)
   return classes
 
+IMAGE_EXTENSIONS = ('.bmp', '.jpeg', '.jpg', '.png')
+
+def find_images(directory):
+  paths = []
+  for root, _, files in os.walk(directory):
+    paths.extend(os.path.join(root, name) for name in files
+                 if name.lower().endswith(IMAGE_EXTENSIONS))
+  return sorted(paths)
+
+def classify_directory(directory, output, top_k=1):
+  """Classifies every image under a directory and writes the results as CSV or JSONL.
+
+  Args:
+    directory: The directory to search (recursively) for images.
+    output: The results file. If it ends with '.jsonl' each line is a JSON object for one
+      image; otherwise the file is CSV with one row per (image, class). '-' writes CSV to stdout.
+    top_k: The number of top classes to report for each image.
+
+  Images that can't be read are reported on stderr (and with an 'error' field in JSONL)
+  and skipped.
+  """
+  paths = find_images(directory)
+  start = time.monotonic()
+  with contextlib.ExitStack() as stack:
+    if output == '-':
+      f = sys.stdout
+    else:
+      f = stack.enter_context(open(output, 'w', newline=''))
+    jsonl = output.endswith('.jsonl')
+    if not jsonl:
+      writer = csv.writer(f)
+      writer.writerow(['path', 'rank', 'label_id', 'label', 'score'])
+    results = classifier.get_classes_batch(paths, top_k=top_k, skip_unreadable=True)
+    skipped = 0
+    for path, classes in zip(paths, results):
+      if classes is None:
+        skipped += 1
+        print('Cannot read image %s, skipping it.' % path, file=sys.stderr)
+        if jsonl:
+          f.write(json.dumps({'path': path, 'error': 'Cannot read image'}) + '\n')
+        continue
+      if jsonl:
+        f.write(json.dumps({'path': path,
+                            'classes': [{'id': int(c.id), 'label': labels.get(c.id),
+                                         'score': float(c.score)} for c in classes]}) + '\n')
+      else:
+        for rank, c in enumerate(classes):
+          writer.writerow([path, rank, int(c.id), labels.get(c.id), '%.5f' % c.score])
+  elapsed = time.monotonic() - start
+  count = len(paths) - skipped
+  print('Classified %d images in %.2f seconds (%.1f images/sec).' %
+        (count, elapsed, count / elapsed if elapsed else 0.0), file=sys.stderr)
+  if skipped:
+    print('Skipped %d images that could not be read.' % skipped, file=sys.stderr)
+
 def classify_live():
   with nonblocking(sys.stdin) as get_char:
     # Handle key events from GUI window.
@@ -75,17 +135,32 @@ def main():
                       help='File path of .tflite file. Default is vision.CLASSIFICATION_MODEL')
   parser.add_argument('-l', '--labels',
                       help='File path of labels file. Default is vision.CLASSIFICATION_LABELS')
+  parser.add_argument('--head',
+                      help='Embedding classifier (.npz) to use on the output of the model, '
+                           'which must then be an extractor; see evaluate_images.py')
   parser.add_argument('-i', '--input',
-                      help='Image to be classified. If not given, use spacebar to capture an image.')
+                      help='Image to be classified, or a directory of images to classify. '
+                           'If not given, use spacebar to capture an image.')
+  parser.add_argument('-o', '--output', default='-',
+                      help='Results file for directory input: .csv or .jsonl ("-" for stdout)')
+  parser.add_argument('-k', '--top_k', type=int, default=1,
+                      help='Number of classes to report per image for directory input')
   args = parser.parse_args()
+  metrics.start_from_env()
 
+  if args.head and not args.model:
+    parser.error('--head needs the extractor model it was trained on, given with -m')
+  if args.head and not args.labels:
+    parser.error('--head needs the labels file it was trained with, given with -l')
   if args.model:
-    classifier = vision.Classifier(args.model)
+    classifier = vision.Classifier(args.model, head=args.head)
 
   if args.labels:
     labels = read_label_file(args.labels)
 
-  if args.input:
+  if args.input and os.path.isdir(args.input):
+    classify_directory(args.input, args.output, args.top_k)
+  elif args.input:
     frame = imread(args.input)
     classify_image(frame)
   else:
@@ -34,6 +34,11 @@ import time
 import threading
 import tty
 
+import cv2
+
+import dataset
+import metrics
+import pipeline
 import vision
 
 from pycoral.utils.dataset import read_label_file
@@ -52,33 +57,91 @@ def nonblocking(f):
   finally:
     termios.tcsetattr(f, termios.TCSADRAIN, old_settings)
 
-@contextlib.contextmanager
-def worker(process):
-  requests = queue.Queue()
-
-  def run():
+# The file extension and OpenCV encoding parameters for each format.
+FORMATS = {
+  'png': ('.png', lambda args: [cv2.IMWRITE_PNG_COMPRESSION, args.png_compression]),
+  'jpg': ('.jpg', lambda args: [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality]),
+  'npy': ('.npy', lambda args: None),
+}
+
+# In burst mode, a label's burst ends when its key hasn't repeated for this
+# many seconds: longer than the keyboard's auto-repeat delay after the first
+# press, and longer than the auto-repeat interval after that.
+BURST_DELAY_SECONDS = 0.6
+BURST_REPEAT_SECONDS = 0.15
+
+class ImageWriter:
+  """Saves frames on a pool of threads, without ever blocking the caller.
+
+  Frames wait in a bounded queue. If the writers can't keep up and the queue is full, new
+  frames are dropped (and counted) rather than stalling the camera loop. A frame that
+  fails to save is reported and counted in `errors`, and the writer moves on.
+
+  Args:
+    num_workers: The number of writer threads.
+    max_queued: The maximum number of frames waiting to be written.
+    params: OpenCV encoding parameters for `vision.save_frame()`.
+    save: A function called as `save(target, frame)` instead of `vision.save_frame()`, where
+      target is what was passed to `submit()`.
+  """
+  def __init__(self, num_workers=2, max_queued=64, params=None, save=None):
+    self._requests = queue.Queue(max_queued)
+    self._save = save or (lambda filename, frame: vision.save_frame(filename, frame, params))
+    self._lock = threading.Lock()
+    self.stats = pipeline.StageStats('write', metric='images.write')
+    self.errors = 0
+    self._closing = threading.Event()
+    self._threads = [threading.Thread(target=self._run) for _ in range(num_workers)]
+    for thread in self._threads:
+      thread.start()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def _run(self):
     while True:
-      request = requests.get()
-      if request is None:
-        break
-      process(request)
-      requests.task_done()
-
-  def submit(request):
-    requests.put(request)
-
-  thread = threading.Thread(target=run)
-  thread.start()
-  try:
-    yield submit
-  finally:
-    requests.put(None)
-    thread.join()
-
-def save_frame(request):
-  filename, frame = request
-  vision.save_frame(filename, frame)
-  print('Saved: %s' % filename)
+      try:
+        target, frame = self._requests.get(timeout=0.1)
+      except queue.Empty:
+        if self._closing.is_set():
+          break
+        continue
+      start = time.monotonic()
+      try:
+        self._save(target, frame)
+      except Exception as e:
+        with self._lock:
+          self.errors += 1
+        print('Failed to save %s: %s' % (target, e), file=sys.stderr)
+        continue
+      with self._lock:
+        self.stats.record(time.monotonic() - start)
+      print('Saved: %s' % target)
+
+  def submit(self, target, frame):
+    """Queues a frame to be saved to target (a filename by default). Returns False if it
+    was dropped."""
+    try:
+      self._requests.put_nowait((target, frame))
+      return True
+    except queue.Full:
+      with self._lock:
+        self.stats.drop()
+      return False
+
+  def close(self):
+    """Writes the remaining queued frames and stops the threads."""
+    self._closing.set()
+    for thread in self._threads:
+      thread.join()
+
+  def summary(self):
+    return ('Wrote %d frames (%.1f frames/s, %.1f ms each on average), dropped %d, '
+            'failed %d.' % (self.stats.count, self.stats.fps, 1000 * self.stats.mean_latency,
+                            self.stats.dropped, self.errors))
 
 def main():
   parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -88,9 +151,27 @@ def main():
                       help='Capture directory')
   parser.add_argument('--capture_device_index', '-i', type=int, default=0,
                       help='Capture device index')
+  parser.add_argument('--format', '-f', choices=sorted(FORMATS), default='png',
+                      help='Image format; npy (raw NumPy arrays) is the fastest to write')
+  parser.add_argument('--png_compression', type=int, default=3,
+                      help='PNG compression level, 0 (fastest) to 9 (smallest)')
+  parser.add_argument('--jpeg_quality', type=int, default=95,
+                      help='JPEG quality, 0 to 100')
+  parser.add_argument('--num_writers', type=int, default=2,
+                      help='Number of threads writing images')
+  parser.add_argument('--max_queued', type=int, default=64,
+                      help='Frames that may wait to be written before new ones are dropped')
+  parser.add_argument('--packed', type=str, default=None,
+                      help='Append images to this packed dataset (see dataset.py) instead '
+                           'of saving files in the capture directory')
+  parser.add_argument('--burst_every', type=int, default=0,
+                      help='While a key is held, save every Nth frame; 0 saves one per press')
   args = parser.parse_args()
+  metrics.start_from_env()
 
   print("Press buttons '0' .. '9' to save images from the camera.")
+  if args.burst_every:
+    print('Hold a button to save every %d frames.' % args.burst_every)
 
   labels = {}
   if args.labels:
@@ -98,7 +179,27 @@ def main():
     for key in sorted(labels):
       print(key, '-', labels[key])
 
-  with nonblocking(sys.stdin) as get_char, worker(save_frame) as submit:
+  extension, get_params = FORMATS[args.format]
+  packed = None
+  if args.packed:
+    # Frames are resized and appended on the writer threads, so nothing is encoded.
+    packed = dataset.PackedWriter(args.packed, labels)
+    writer = ImageWriter(args.num_writers, args.max_queued,
+                         save=lambda label_id, frame: packed.add(frame, label_id))
+  else:
+    writer = ImageWriter(args.num_writers, args.max_queued, get_params(args))
+  # The label directory, end time and frame count of the current burst.
+  burst = {'class_dir': None, 'until': 0.0, 'frames': 0}
+  label_ids = {labels.get(label_id, str(label_id)): label_id for label_id in range(10)}
+
+  with nonblocking(sys.stdin) as get_char, writer:
+    def save(class_dir, frame):
+      if packed:
+        writer.submit(label_ids[class_dir], frame.copy())
+        return
+      name = str(round(time.time() * 1000)) + extension
+      writer.submit(os.path.join(args.capture_dir, class_dir, name), frame.copy())
+
     # Handle key events from GUI window.
     def handle_key(key, frame):
       if key == ord('q') or key == ord('Q'):
@@ -106,9 +207,16 @@ def main():
       if ord('0') <= key <= ord('9'):
         label_id = key - ord('0')
         class_dir = labels.get(label_id, str(label_id))
-        name = str(round(time.time() * 1000)) + '.png'
-        filename = os.path.join(args.capture_dir, class_dir, name)
-        submit((filename, frame.copy()))
+        if not args.burst_every:
+          save(class_dir, frame)
+        else:
+          # Held keys repeat, and each repeat extends the burst. A new burst saves the
+          # current frame first, from the frame loop below.
+          if class_dir != burst['class_dir'] or time.monotonic() > burst['until']:
+            burst.update(class_dir=class_dir, frames=-1)
+            burst['until'] = time.monotonic() + BURST_DELAY_SECONDS
+          else:
+            burst['until'] = time.monotonic() + BURST_REPEAT_SECONDS
       return True  # Keep processing frames.
 
     for frame in vision.get_frames(handle_key=handle_key,
@@ -117,6 +225,14 @@ def main():
       ch = get_char()
       if ch is not None and not handle_key(ord(ch), frame):
         break
+      if burst['class_dir'] and time.monotonic() <= burst['until']:
+        burst['frames'] += 1
+        if burst['frames'] % args.burst_every == 0:
+          save(burst['class_dir'], frame)
+
+  if packed:
+    packed.close()
+  print(writer.summary())
 
 if __name__ == '__main__':
   main()
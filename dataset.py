@@ -0,0 +1,220 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A packed format for training images, which is read without decoding.
+
+A packed dataset is a directory with three files:
+
+  meta.json   The image size and the labels.
+  images.bin  Every image, already resized and converted to RGB, as raw uint8
+              pixels one after another. It's read as a memory-mapped array of
+              shape (count, height, width, 3).
+  labels.bin  The label ID of each image, as little-endian int32.
+
+Both .bin files are only ever appended to, so collect_images.py can add
+frames as they are captured. Each image is flushed together with its label,
+and a writer that opens a dataset first drops any image or label left
+without its partner by a crash. To convert a directory of captured images:
+
+  python3 dataset.py -l my-labels.txt -d capture -o capture.packed
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+from pycoral.utils.dataset import read_label_file
+
+IMAGE_SIZE = (224, 224)
+META_FILE = 'meta.json'
+IMAGES_FILE = 'images.bin'
+LABELS_FILE = 'labels.bin'
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.npy')
+
+def is_packed(path):
+  """Returns whether path is a packed dataset."""
+  return os.path.isfile(os.path.join(path, META_FILE))
+
+def prepare_image(image, size=IMAGE_SIZE):
+  """Converts an image to the RGB pixels that are stored in a packed dataset.
+
+  Images are resized the same way train_images.py always has, so training on a
+  packed dataset gives the same model as training on the image files.
+
+  Args:
+    image: A PIL image, or a BGR frame from the camera as a NumPy array.
+    size: The (width, height) to resize to.
+
+  Returns:
+    A uint8 array of shape (height, width, 3).
+  """
+  if isinstance(image, np.ndarray):
+    image = Image.fromarray(np.ascontiguousarray(image[..., ::-1]))
+  return np.asarray(image.convert('RGB').resize(size, Image.NEAREST))
+
+def read_image(path, size=IMAGE_SIZE):
+  """Reads an image file (or a '.npy' BGR frame) and prepares it with prepare_image()."""
+  if path.endswith('.npy'):
+    return prepare_image(np.load(path), size)
+  with Image.open(path) as img:
+    return prepare_image(img, size)
+
+class PackedWriter:
+  """Appends images to a packed dataset, creating it if needed.
+
+  It's safe to call add() from several threads.
+
+  Args:
+    path: The dataset directory.
+    labels: A dict of label names by ID, stored in the metadata of a new dataset.
+      For an existing dataset, they must match the stored labels.
+    size: The (width, height) of the stored images, for a new dataset.
+
+  Raises:
+    ValueError: If labels are given and differ from an existing dataset's.
+  """
+  def __init__(self, path, labels=None, size=IMAGE_SIZE):
+    if is_packed(path):
+      existing = PackedDataset(path)
+      if labels and existing.label_names != dict(labels):
+        raise ValueError('%s was packed with different labels: %s' % (
+            path, existing.label_names))
+      size = existing.size
+      self._truncate(path, len(existing), size)
+    else:
+      os.makedirs(path, exist_ok=True)
+      with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump({'version': 1, 'size': list(size),
+                   'labels': {str(k): v for k, v in (labels or {}).items()}}, f, indent=2)
+    self.path = path
+    self.size = tuple(size)
+    self._lock = threading.Lock()
+    self._images = open(os.path.join(path, IMAGES_FILE), 'ab')
+    self._labels = open(os.path.join(path, LABELS_FILE), 'ab')
+
+  @staticmethod
+  def _truncate(path, count, size):
+    """Cuts both .bin files to count records."""
+    width, height = size
+    os.truncate(os.path.join(path, IMAGES_FILE), count * width * height * 3)
+    os.truncate(os.path.join(path, LABELS_FILE), count * 4)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def add(self, image, label_id):
+    """Adds an image (see prepare_image()) with the given label ID."""
+    self.add_pixels(prepare_image(image, self.size), label_id)
+
+  def add_pixels(self, pixels, label_id):
+    """Adds an image that was already prepared at this dataset's size."""
+    with self._lock:
+      # Readers only see images that have a label, so the label goes last.
+      self._images.write(pixels.tobytes())
+      self._images.flush()
+      self._labels.write(np.int32(label_id).astype('<i4').tobytes())
+      self._labels.flush()
+
+  def close(self):
+    with self._lock:
+      self._images.close()
+      self._labels.close()
+
+class PackedDataset:
+  """Reads a packed dataset, without copying or decoding the images.
+
+  Args:
+    path: The dataset directory.
+  """
+  def __init__(self, path):
+    with open(os.path.join(path, META_FILE)) as f:
+      meta = json.load(f)
+    self.path = path
+    self.size = tuple(meta['size'])
+    self.label_names = {int(k): v for k, v in meta['labels'].items()}
+    width, height = self.size
+    self.labels = np.fromfile(os.path.join(path, LABELS_FILE), dtype='<i4')
+    image_bytes = width * height * 3
+    # A writer may be appending, so only map the images that have a label.
+    count = min(len(self.labels),
+                os.path.getsize(os.path.join(path, IMAGES_FILE)) // image_bytes)
+    self.labels = self.labels[:count]
+    if count:
+      self.images = np.memmap(os.path.join(path, IMAGES_FILE), dtype=np.uint8, mode='r',
+                              shape=(count, height, width, 3))
+    else:
+      self.images = np.zeros((0, height, width, 3), dtype=np.uint8)
+
+  def __len__(self):
+    return len(self.labels)
+
+  def __getitem__(self, index):
+    """Returns the (image, label ID) at index."""
+    return self.images[index], int(self.labels[index])
+
+  def indices(self, label_id):
+    """Returns the indices of the images with the given label ID."""
+    return np.flatnonzero(self.labels == label_id)
+
+def convert(capture_dir, labels, out_path, size=IMAGE_SIZE, num_workers=4):
+  """Packs a directory of captured images, as written by collect_images.py.
+
+  Args:
+    capture_dir: The directory with a subdirectory of images for each label.
+    labels: A dict of label names by ID; the subdirectories are named after the labels.
+    out_path: The packed dataset directory to create (or append to).
+    size: The (width, height) to store the images at.
+    num_workers: The number of threads decoding images.
+
+  Returns:
+    The number of images packed.
+  """
+  files = []
+  for label_id in sorted(labels):
+    class_dir = os.path.join(capture_dir, labels[label_id])
+    if os.path.isdir(class_dir):
+      files.extend((os.path.join(class_dir, name), label_id)
+                   for name in sorted(os.listdir(class_dir))
+                   if name.lower().endswith(IMAGE_EXTENSIONS))
+
+  with PackedWriter(out_path, labels, size) as writer, \
+       concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+    images = executor.map(lambda f: read_image(f[0], writer.size), files)
+    for (_, label_id), pixels in zip(files, images):
+      writer.add_pixels(pixels, label_id)
+  return len(files)
+
+def main():
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('--labels', '-l', type=str, required=True,
+                      help='Labels file')
+  parser.add_argument('--capture_dir', '-d', type=str, default='capture',
+                      help='Capture directory to convert')
+  parser.add_argument('--output', '-o', type=str, default='capture.packed',
+                      help='Packed dataset directory')
+  args = parser.parse_args()
+
+  count = convert(args.capture_dir, read_label_file(args.labels), args.output)
+  print('Packed %d images into %s' % (count, args.output))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,322 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Extracts image embeddings, caching them on disk.
+
+The embedding of an image only depends on the image and the extractor model, so
+EmbeddingCache keys embeddings by the SHA-1 of the image content, and keeps one
+cache file per extractor model. Retraining after adding a few images then only
+runs the extractor on the new ones.
+
+ClassEmbeddings keeps the running sum of each class's normalized embeddings,
+which is enough to imprint the class again without its images.
+
+CentroidClassifier and KnnClassifier classify embeddings in NumPy, to evaluate
+a set of labels without building a model, or as the last layer on top of the
+extractor (see `vision.Classifier`).
+"""
+
+import collections
+import concurrent.futures
+import hashlib
+import os
+
+import numpy as np
+
+from pycoral.adapters import classify
+from pycoral.adapters import common
+
+# An image to extract: `key()` returns its content hash and `load()` returns its
+# pixels, both called on a worker thread.
+Sample = collections.namedtuple('Sample', ['name', 'key', 'load'])
+
+def content_hash(data):
+  """Returns the SHA-1 hex digest of bytes, or of a NumPy array's shape and pixels."""
+  sha1 = hashlib.sha1()
+  if isinstance(data, np.ndarray):
+    sha1.update(repr(data.shape).encode())
+    data = np.ascontiguousarray(data)
+  sha1.update(memoryview(data).cast('B'))
+  return sha1.hexdigest()
+
+def file_hash(path):
+  """Returns the SHA-1 hex digest of a file's content."""
+  with open(path, 'rb') as f:
+    return content_hash(f.read())
+
+class EmbeddingCache:
+  """Embeddings by image content hash, for one extractor model.
+
+  The cache is loaded from and saved to `<cache_dir>/<model_key>.npz`.
+
+  Args:
+    cache_dir: The directory with the cache files.
+    model_key: Identifies the extractor, e.g. `content_hash()` of the extractor model.
+  """
+  def __init__(self, cache_dir, model_key):
+    self.path = os.path.join(cache_dir, model_key + '.npz')
+    self._embeddings = {}
+    self._dirty = False
+    if os.path.exists(self.path):
+      with np.load(self.path) as data:
+        self._embeddings = dict(zip(data['keys'].tolist(), data['embeddings']))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.save()
+
+  def __len__(self):
+    return len(self._embeddings)
+
+  def __contains__(self, key):
+    return key in self._embeddings
+
+  def get(self, key):
+    return self._embeddings.get(key)
+
+  def put(self, key, embedding):
+    self._embeddings[key] = np.asarray(embedding, dtype=np.float32)
+    self._dirty = True
+
+  def save(self):
+    """Writes the cache file, if anything was added."""
+    if not self._dirty:
+      return
+    os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+    keys = list(self._embeddings)
+    tmp_path = self.path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+      np.savez(f, keys=np.array(keys, dtype='U40'),
+               embeddings=np.stack([self._embeddings[key] for key in keys]))
+    os.replace(tmp_path, self.path)
+    self._dirty = False
+
+def extract(extractor, samples, cache=None, num_workers=4):
+  """Yields the embedding of each sample, in order.
+
+  Hashing and loading images happens on a pool of threads, a few samples ahead of
+  the extractor. Samples found in the cache are never loaded, and new embeddings
+  are added to it.
+
+  Args:
+    extractor: The interpreter of the extractor model, with tensors allocated.
+    samples: An iterable of `Sample`.
+    cache: An optional `EmbeddingCache`.
+    num_workers: The number of threads loading images.
+
+  Yields:
+    Tuples of (sample name, embedding as a float32 array, True if it was cached).
+  """
+  def prepare(sample):
+    key = sample.key() if cache is not None else None
+    if key is not None and key in cache:
+      return sample.name, key, None
+    return sample.name, key, sample.load()
+
+  def embed(prepared):
+    name, key, image = prepared
+    if image is None:
+      return name, cache.get(key), True
+    common.set_input(extractor, image)
+    extractor.invoke()
+    embedding = classify.get_scores(extractor).astype(np.float32)
+    if key is not None:
+      cache.put(key, embedding)
+    return name, embedding, False
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+    pending = collections.deque()
+    for sample in samples:
+      pending.append(executor.submit(prepare, sample))
+      if len(pending) > 2 * num_workers:
+        yield embed(pending.popleft().result())
+    while pending:
+      yield embed(pending.popleft().result())
+
+def l2_normalize(x, axis=-1):
+  """Scales vectors to unit length (zero vectors stay zero)."""
+  x = np.asarray(x, dtype=np.float64)
+  norm = np.linalg.norm(x, axis=axis, keepdims=True)
+  return x / np.where(norm > 0, norm, 1)
+
+class ClassEmbeddings:
+  """The sum of the L2-normalized embeddings of each class, and which samples they came from.
+
+  An imprinted class's weights are the normalized average of its normalized embeddings,
+  so this is all that's needed to imprint a class again, or to add more samples to it,
+  without extracting the old samples. Samples are identified by their content hash
+  (`Sample.key()`), kept in a `collections.Counter` per class, so an image that changed
+  under the same name counts as a different sample.
+
+  Args:
+    model_key: Identifies the extractor the embeddings came from.
+  """
+  def __init__(self, model_key=None):
+    self.model_key = model_key
+    self.sums = {}
+    self.counts = {}
+    self.samples = {}
+
+  def __contains__(self, class_name):
+    return class_name in self.sums
+
+  def add(self, class_name, embedding, sample_key):
+    embedding = l2_normalize(embedding)
+    if class_name in self.sums:
+      self.sums[class_name] += embedding
+    else:
+      self.sums[class_name] = embedding.copy()
+      self.counts[class_name] = 0
+      self.samples[class_name] = collections.Counter()
+    self.counts[class_name] += 1
+    self.samples[class_name][sample_key] += 1
+
+  def remove(self, class_name):
+    for values in (self.sums, self.counts, self.samples):
+      values.pop(class_name, None)
+
+  def save(self, path):
+    names = sorted(self.sums)
+    sample_keys = [key for name in names for key in sorted(self.samples[name].elements())]
+    sample_classes = [i for i, name in enumerate(names)
+                      for _ in self.samples[name].elements()]
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+      np.savez(f, model_key=np.array(self.model_key or ''), names=np.array(names, dtype=str),
+               sums=np.array([self.sums[name] for name in names]),
+               counts=np.array([self.counts[name] for name in names], dtype=np.int64),
+               sample_keys=np.array(sample_keys, dtype='U40'),
+               sample_classes=np.array(sample_classes, dtype=np.int64))
+    os.replace(tmp_path, path)
+
+  @classmethod
+  def load(cls, path):
+    with np.load(path) as data:
+      if 'sample_keys' not in data:
+        # Saved when samples were identified by name, which can't tell if they changed.
+        return cls()
+      class_embeddings = cls(str(data['model_key']) or None)
+      names = data['names'].tolist()
+      for i, name in enumerate(names):
+        class_embeddings.sums[name] = data['sums'][i].astype(np.float64)
+        class_embeddings.counts[name] = int(data['counts'][i])
+        class_embeddings.samples[name] = collections.Counter()
+      for sample_key, i in zip(data['sample_keys'].tolist(), data['sample_classes']):
+        class_embeddings.samples[names[i]][sample_key] += 1
+    return class_embeddings
+
+class _EmbeddingClassifier:
+  """Scores embeddings against classes; subclasses implement `scores()`."""
+
+  def scores(self, embeddings):
+    raise NotImplementedError
+
+  def predict(self, embeddings):
+    """Returns the best class ID for each row of an (N, D) array of embeddings."""
+    return self.class_ids[np.argmax(self.scores(embeddings), axis=1)]
+
+  def classify(self, embedding, top_k=1, threshold=0.0):
+    """Classifies one embedding, like `classify.get_classes()` does for a model's output.
+
+    Returns:
+      A list of `classify.Class`, ordered by score.
+    """
+    scores = self.scores(np.reshape(embedding, (1, -1)))[0]
+    return [classify.Class(int(self.class_ids[c.id]), c.score)
+            for c in classify.get_classes_from_scores(scores, top_k, threshold)]
+
+class CentroidClassifier(_EmbeddingClassifier):
+  """Classifies embeddings by cosine similarity to the average embedding of each class.
+
+  This is what an imprinted model computes, but in NumPy: scoring N embeddings against
+  C classes is a single (N, D) x (D, C) matrix multiply, so it works for thousands of
+  classes and doesn't need a new model for every change of labels.
+
+  Args:
+    class_ids: The ID of each class.
+    centroids: A (C, D) array with a centroid (any length) for each class.
+  """
+  def __init__(self, class_ids, centroids):
+    self.class_ids = np.asarray(class_ids, dtype=np.int64)
+    self._centroids_t = np.ascontiguousarray(l2_normalize(centroids).T, dtype=np.float32)
+
+  @classmethod
+  def fit(cls, embeddings, class_ids):
+    """Builds the classifier from (N, D) embeddings and the class ID of each."""
+    embeddings = l2_normalize(embeddings)
+    class_ids = np.asarray(class_ids)
+    ids, index = np.unique(class_ids, return_inverse=True)
+    sums = np.zeros((len(ids), embeddings.shape[1]))
+    np.add.at(sums, index, embeddings)
+    return cls(ids, sums)
+
+  @classmethod
+  def from_class_embeddings(cls, class_embeddings, labels):
+    """Builds the classifier from `ClassEmbeddings` and a dict of label names by ID."""
+    ids = [i for i in sorted(labels) if labels[i] in class_embeddings]
+    return cls(ids, [class_embeddings.sums[labels[i]] for i in ids])
+
+  def scores(self, embeddings):
+    """Returns the (N, C) cosine similarities of (N, D) embeddings to each class."""
+    return l2_normalize(embeddings).astype(np.float32) @ self._centroids_t
+
+  def save(self, path):
+    """Saves the classifier to path, as given (np.savez would add '.npz' to a bare name)."""
+    with open(path, 'wb') as f:
+      np.savez(f, type='centroid', class_ids=self.class_ids, centroids=self._centroids_t.T)
+
+class KnnClassifier(_EmbeddingClassifier):
+  """Classifies embeddings by their k most similar training embeddings.
+
+  A class scores the sum of the cosine similarities of its neighbors, divided by k.
+  This follows the shape of each class more closely than `CentroidClassifier`, but
+  scoring costs a multiply with every training embedding.
+
+  Args:
+    embeddings: The (N, D) training embeddings.
+    class_ids: The class ID of each training embedding.
+    k: The number of neighbors.
+  """
+  def __init__(self, embeddings, class_ids, k=5):
+    self.class_ids, self._labels = np.unique(np.asarray(class_ids, dtype=np.int64),
+                                             return_inverse=True)
+    self._embeddings_t = np.ascontiguousarray(l2_normalize(embeddings).T, dtype=np.float32)
+    self.k = min(k, len(self._labels))
+
+  @classmethod
+  def fit(cls, embeddings, class_ids, k=5):
+    return cls(embeddings, class_ids, k)
+
+  def scores(self, embeddings):
+    similarities = l2_normalize(embeddings).astype(np.float32) @ self._embeddings_t
+    nearest = np.argpartition(-similarities, self.k - 1, axis=1)[:, :self.k]
+    rows = np.arange(len(similarities))[:, None]
+    scores = np.zeros((len(similarities), len(self.class_ids)), dtype=np.float32)
+    np.add.at(scores, (rows, self._labels[nearest]), similarities[rows, nearest])
+    return scores / self.k
+
+  def save(self, path):
+    """Saves the classifier to path, as given (np.savez would add '.npz' to a bare name)."""
+    with open(path, 'wb') as f:
+      np.savez(f, type='knn', class_ids=self.class_ids[self._labels],
+               embeddings=self._embeddings_t.T, k=self.k)
+
+def load_classifier(path):
+  """Loads a classifier saved by `CentroidClassifier.save()` or `KnnClassifier.save()`."""
+  with np.load(path) as data:
+    if str(data['type']) == 'knn':
+      return KnnClassifier(data['embeddings'], data['class_ids'], int(data['k']))
+    return CentroidClassifier(data['class_ids'], data['centroids'])
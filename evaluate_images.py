@@ -0,0 +1,144 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Evaluates a set of labels on captured images, without building a model.
+
+Some of each label's images are held out, the rest train a NumPy classifier on
+the extractor's embeddings, and the held-out images measure its accuracy:
+  python3 evaluate_images.py -l my-labels.txt
+
+Embeddings are cached like in train_images.py, so evaluating again after
+changing the labels or capturing more images is fast.
+
+To classify with the NumPy classifier instead of an imprinted model, save it and
+the extractor, then:
+  python3 evaluate_images.py -l my-labels.txt --holdout 0 \\
+      --out_head my-head.npz --out_extractor my-extractor.tflite
+  python3 classify_image.py -m my-extractor.tflite --head my-head.npz -l my-labels.txt
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+import embeddings
+import train_images
+
+from pycoral.adapters import common
+from pycoral.utils.dataset import read_label_file
+
+def extract_all(capture_dir, labels, extractor, cache=None, num_workers=4):
+  """Returns the (N, D) embeddings of all captured images and the (N,) label IDs."""
+  vectors, class_ids = [], []
+  for class_id in sorted(labels):
+    samples = train_images.class_samples(capture_dir, class_id, labels[class_id],
+                                         common.input_size(extractor))
+    for _, embedding, _ in embeddings.extract(extractor, samples, cache, num_workers):
+      vectors.append(embedding)
+      class_ids.append(class_id)
+  return np.array(vectors, dtype=np.float32), np.array(class_ids, dtype=np.int64)
+
+def split(class_ids, holdout, seed=0):
+  """Picks a fraction of each class to hold out.
+
+  Returns:
+    A boolean array that's True for held-out samples. Classes with a single sample
+    are never held out.
+  """
+  rng = np.random.default_rng(seed)
+  held_out = np.zeros(len(class_ids), dtype=bool)
+  for class_id in np.unique(class_ids):
+    indices = rng.permutation(np.flatnonzero(class_ids == class_id))
+    if len(indices) > 1:
+      held_out[indices[:min(len(indices) - 1, int(round(holdout * len(indices))))]] = True
+  return held_out
+
+def make_classifier(kind, vectors, class_ids, k=5):
+  if kind == 'knn':
+    return embeddings.KnnClassifier.fit(vectors, class_ids, k)
+  return embeddings.CentroidClassifier.fit(vectors, class_ids)
+
+def evaluate(classifier, vectors, class_ids, labels):
+  """Prints the accuracy of each label and overall, and the most common confusions."""
+  start = time.monotonic()
+  predicted = classifier.predict(vectors)
+  elapsed = time.monotonic() - start
+  correct = predicted == class_ids
+  for class_id in sorted(labels):
+    mask = class_ids == class_id
+    if mask.any():
+      print('  %-20s %5.1f%% of %d' % (labels[class_id], 100 * correct[mask].mean(), mask.sum()))
+  print('Accuracy: %.1f%% of %d held-out images (scored in %.1f ms)' % (
+      100 * correct.mean(), len(correct), 1000 * elapsed))
+
+  pairs, counts = np.unique(np.stack([class_ids[~correct], predicted[~correct]], axis=1),
+                            axis=0, return_counts=True)
+  for (actual, guess), count in sorted(zip(pairs.tolist(), counts), key=lambda p: -p[1])[:5]:
+    print('  %d x %s classified as %s' % (count, labels.get(actual), labels.get(guess)))
+
+def main():
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('--labels', '-l', type=str, required=True,
+                      help='Labels file')
+  parser.add_argument('--capture_dir', '-d', type=str, default='capture',
+                      help='Capture directory, or packed dataset')
+  parser.add_argument('--model', '-m', type=str, default=train_images.DEFAULT_BASE_MODEL,
+                      help='Base model')
+  parser.add_argument('--classifier', choices=['centroid', 'knn'], default='centroid',
+                      help='Nearest class average, or k nearest images')
+  parser.add_argument('-k', type=int, default=5,
+                      help='Number of neighbors for the knn classifier')
+  parser.add_argument('--holdout', type=float, default=0.2,
+                      help='Fraction of each label\'s images to evaluate on; 0 only trains')
+  parser.add_argument('--seed', type=int, default=0,
+                      help='Random seed for picking the held-out images')
+  parser.add_argument('--cache_dir', type=str, default=None,
+                      help='Embedding cache directory (default: <capture_dir>/.embeddings)')
+  parser.add_argument('--num_workers', type=int, default=4,
+                      help='Number of threads reading images')
+  parser.add_argument('--out_head', type=str, default=None,
+                      help='Save a classifier trained on all images here (.npz)')
+  parser.add_argument('--out_extractor', type=str, default=None,
+                      help='Save the extractor model here (.tflite), to use with --out_head')
+  args = parser.parse_args()
+
+  labels = read_label_file(args.labels)
+  engine, extractor, model_key = train_images.make_extractor(args.model)
+  cache_dir = args.cache_dir or os.path.join(args.capture_dir, '.embeddings')
+  with embeddings.EmbeddingCache(cache_dir, model_key) as cache:
+    vectors, class_ids = extract_all(args.capture_dir, labels, extractor, cache,
+                                     args.num_workers)
+  print('%d images of %d labels' % (len(vectors), len(np.unique(class_ids))))
+
+  if args.holdout > 0:
+    held_out = split(class_ids, args.holdout, args.seed)
+    if not held_out.any():
+      parser.error('No label has enough images to hold any out')
+    classifier = make_classifier(args.classifier, vectors[~held_out], class_ids[~held_out],
+                                 args.k)
+    evaluate(classifier, vectors[held_out], class_ids[held_out], labels)
+
+  if args.out_head:
+    make_classifier(args.classifier, vectors, class_ids, args.k).save(args.out_head)
+    print('Classifier was saved to %s' % args.out_head)
+  if args.out_extractor:
+    with open(args.out_extractor, 'wb') as f:
+      f.write(engine.serialize_extractor_model())
+    print('Extractor model was saved to %s' % args.out_extractor)
+
+if __name__ == '__main__':
+  main()
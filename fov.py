@@ -0,0 +1,149 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Divides the camera image into a grid of cells, the Raspimon's "field of view".
+
+The cells are numbered from left to right and top to bottom, like this for a
+3x2 grid:
+
+  -------------------
+  |     |     |     |
+  |  0  |  1  |  2  |
+  -------------------
+  |     |     |     |
+  |  3  |  4  |  5  |
+  -------------------
+
+get_fov_grid() returns a FovGrid, which finds the cells of many boxes at once,
+and FovHeatmap counts how often each cell is occupied over time.
+"""
+
+import functools
+
+import numpy as np
+
+from pycoral.adapters.detect import BBox
+
+
+class FovGrid(object):
+  """A grid of equally sized cells over an image.
+
+  Use get_fov_grid() to get one, so the grid for each image size and shape is
+  only built once.
+
+  Args:
+    image_size: The (width, height) of the image.
+    columns: The number of cells across.
+    rows: The number of cells down.
+  """
+
+  def __init__(self, image_size, columns, rows):
+    self.image_size = tuple(image_size)
+    self.columns = columns
+    self.rows = rows
+    width, height = self.image_size
+    cell_width = width / columns
+    cell_height = height / rows
+    self.bboxes = tuple(
+        BBox(column * cell_width, row * cell_height,
+             (column + 1) * cell_width, (row + 1) * cell_height)
+        for row in range(rows) for column in range(columns))
+    # The same edges as the boxes, so locate_points() agrees with them exactly.
+    self._column_edges = np.arange(columns + 1) * cell_width
+    self._row_edges = np.arange(rows + 1) * cell_height
+
+  def __len__(self):
+    return self.columns * self.rows
+
+  def locate_points(self, points):
+    """Finds the cell of each point.
+
+    Args:
+      points: An (N, 2) array of x, y coordinates.
+
+    Returns:
+      An array of N cell indices, with -1 for points outside the image.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    # Cell edges needn't be whole pixels, so points aren't rounded: each lands in
+    # the cell whose box in `bboxes` contains it.
+    columns = np.searchsorted(self._column_edges, points[:, 0], side='right') - 1
+    rows = np.searchsorted(self._row_edges, points[:, 1], side='right') - 1
+    inside = ((columns >= 0) & (columns < self.columns) &
+              (rows >= 0) & (rows < self.rows))
+    return np.where(inside, rows * self.columns + columns, -1)
+
+  def locate(self, bboxes):
+    """Finds the cell that contains the center of each box.
+
+    Args:
+      bboxes: A list of `BBox` objects.
+
+    Returns:
+      An array of cell indices, with -1 for boxes centered outside the image.
+    """
+    boxes = np.array(bboxes, dtype=np.float64).reshape(-1, 4)
+    return self.locate_points((boxes[:, :2] + boxes[:, 2:]) / 2)
+
+
+@functools.lru_cache(maxsize=16)
+def get_fov_grid(image_size, columns, rows):
+  """Returns the FovGrid for an image size and grid shape, building it only once.
+
+  Args:
+    image_size: The (width, height) of the image, as a tuple.
+    columns: The number of cells across.
+    rows: The number of cells down.
+  """
+  return FovGrid(image_size, columns, rows)
+
+
+class FovHeatmap(object):
+  """Counts how often objects appear in each cell of a FovGrid.
+
+  Args:
+    grid: The FovGrid to count in.
+    decay: If set, older counts fade by this factor with every update, so the
+      heatmap shows recent activity (e.g. 0.99 forgets over a few hundred
+      frames). If None, counts accumulate forever.
+  """
+
+  def __init__(self, grid, decay=None):
+    self.grid = grid
+    self.decay = decay
+    self._counts = np.zeros(len(grid))
+    self.updates = 0
+
+  def reset(self):
+    self._counts[:] = 0
+    self.updates = 0
+
+  def update(self, cells):
+    """Adds one frame's cell indices (as from FovGrid.locate), ignoring any -1."""
+    if self.decay is not None:
+      self._counts *= self.decay
+    cells = np.asarray(cells, dtype=np.int64)
+    np.add.at(self._counts, cells[cells >= 0], 1)
+    self.updates += 1
+
+  @property
+  def counts(self):
+    """The counts as a (rows, columns) array."""
+    return self._counts.reshape(self.grid.rows, self.grid.columns)
+
+  def hottest(self):
+    """Returns the index of the most occupied cell, or None if nothing was seen."""
+    if not self._counts.any():
+      return None
+    return int(np.argmax(self._counts))
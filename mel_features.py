@@ -14,6 +14,8 @@
 
 """Defines routines to compute mel spectrogram features from audio waveform."""
 
+import functools
+
 import numpy as np
 
 
@@ -170,24 +172,137 @@ def spectrogram_to_mel_matrix(num_mel_bins=20,
                                hertz_to_mel(upper_edge_hertz), num_mel_bins + 2)
   # Matrix to post-multiply feature arrays whose rows are num_spectrogram_bins
   # of spectrogram values.
-  mel_weights_matrix = np.empty((num_spectrogram_bins, num_mel_bins))
-  for i in range(num_mel_bins):
-    lower_edge_mel, center_mel, upper_edge_mel = band_edges_mel[i:i + 3]
-    # Calculate lower and upper slopes for every spectrogram bin.
-    # Line segments are linear in the *mel* domain, not hertz.
-    lower_slope = ((spectrogram_bins_mel - lower_edge_mel) /
-                   (center_mel - lower_edge_mel))
-    upper_slope = ((upper_edge_mel - spectrogram_bins_mel) /
-                   (upper_edge_mel - center_mel))
-    # .. then intersect them with each other and zero.
-    mel_weights_matrix[:, i] = np.maximum(0.0, np.minimum(lower_slope,
-                                                          upper_slope))
+  lower_edge_mel = band_edges_mel[:-2]
+  center_mel = band_edges_mel[1:-1]
+  upper_edge_mel = band_edges_mel[2:]
+  # Calculate lower and upper slopes for every spectrogram bin (rows) and mel
+  # band (columns). Line segments are linear in the *mel* domain, not hertz.
+  bins_mel = spectrogram_bins_mel[:, np.newaxis]
+  lower_slope = ((bins_mel - lower_edge_mel) /
+                 (center_mel - lower_edge_mel))
+  upper_slope = ((upper_edge_mel - bins_mel) /
+                 (upper_edge_mel - center_mel))
+  # .. then intersect them with each other and zero.
+  mel_weights_matrix = np.maximum(0.0, np.minimum(lower_slope, upper_slope))
   # HTK excludes the spectrogram DC bin; make sure it always gets a zero
   # coefficient.
   mel_weights_matrix[0, :] = 0.0
   return mel_weights_matrix
 
 
+class MelFrontend(object):
+  """Computes log mel spectrograms with a precomputed window and filterbank.
+
+  Building the Hann window and the mel weights matrix costs more than
+  applying them to a short waveform, so a MelFrontend builds them once.
+  Only the band of FFT bins with non-zero mel weights is kept, which skips
+  the magnitude and matrix-multiply work for bins outside
+  [lower_edge_hertz, upper_edge_hertz].
+
+  Use get_mel_frontend() to share instances between callers.
+
+  Args:
+    audio_sample_rate: The sampling rate of the waveforms.
+    window_length_secs: Duration of each window to analyze.
+    hop_length_secs: Advance between successive analysis windows.
+    num_mel_bins: How many bands in the resulting mel spectrum.
+    lower_edge_hertz: Lower bound on the frequencies to be included.
+    upper_edge_hertz: The desired top edge of the highest frequency band.
+    log_offset: Add this to values when taking log to avoid -Infs.
+    dtype: The floating point type to compute in. np.float32 halves the memory
+      of the frames and features, but isn't faster: NumPy's FFT and the
+      casts around it make it slightly slower per hop than np.float64.
+  """
+
+  def __init__(self,
+               audio_sample_rate=8000,
+               window_length_secs=0.025,
+               hop_length_secs=0.010,
+               num_mel_bins=20,
+               lower_edge_hertz=125.0,
+               upper_edge_hertz=3800.0,
+               log_offset=0.0,
+               dtype=np.float64):
+    self.audio_sample_rate = audio_sample_rate
+    self.window_length_samples = int(round(audio_sample_rate * window_length_secs))
+    self.hop_length_samples = int(round(audio_sample_rate * hop_length_secs))
+    self.fft_length = 2 ** int(np.ceil(np.log(self.window_length_samples) /
+                                       np.log(2.0)))
+    self.num_mel_bins = num_mel_bins
+    self.log_offset = log_offset
+    self.dtype = np.dtype(dtype)
+    self.window = periodic_hann(self.window_length_samples).astype(self.dtype)
+    mel_matrix = spectrogram_to_mel_matrix(
+        num_mel_bins=num_mel_bins,
+        num_spectrogram_bins=self.fft_length // 2 + 1,
+        audio_sample_rate=audio_sample_rate,
+        lower_edge_hertz=lower_edge_hertz,
+        upper_edge_hertz=upper_edge_hertz)
+    nonzero_bins = np.flatnonzero(mel_matrix.any(axis=1))
+    self._first_bin = nonzero_bins[0]
+    self._last_bin = nonzero_bins[-1] + 1
+    self.mel_matrix = mel_matrix[self._first_bin:self._last_bin].astype(self.dtype)
+    self.window.flags.writeable = False
+    self.mel_matrix.flags.writeable = False
+
+  def num_frames(self, num_samples):
+    """Returns how many complete frames fit in num_samples samples."""
+    if num_samples < self.window_length_samples:
+      return 0
+    return 1 + (num_samples - self.window_length_samples) // self.hop_length_samples
+
+  def mel_spectrogram(self, frames):
+    """Convert framed waveform data to a (linear) mel spectrogram.
+
+    Args:
+      frames: np.array of shape (..., window_length_samples), e.g. from frame().
+
+    Returns:
+      np.array of shape (..., num_mel_bins).
+    """
+    spectrum = np.fft.rfft(frames * self.window, self.fft_length)
+    magnitudes = np.abs(spectrum[..., self._first_bin:self._last_bin])
+    return np.matmul(magnitudes.astype(self.dtype, copy=False), self.mel_matrix)
+
+  def __call__(self, data):
+    """Convert waveform to a log magnitude mel-frequency spectrogram.
+
+    Args:
+      data: 1D np.array of waveform data.
+
+    Returns:
+      2D np.array of (num_frames, num_mel_bins) consisting of log mel
+      filterbank magnitudes for successive frames.
+    """
+    frames = frame(np.asarray(data, dtype=self.dtype), self.window_length_samples,
+                   self.hop_length_samples)
+    return np.log(self.mel_spectrogram(frames) + self.log_offset)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_mel_frontend(*args):
+  return MelFrontend(*args)
+
+
+def get_mel_frontend(audio_sample_rate=8000,
+                     window_length_secs=0.025,
+                     hop_length_secs=0.010,
+                     num_mel_bins=20,
+                     lower_edge_hertz=125.0,
+                     upper_edge_hertz=3800.0,
+                     log_offset=0.0,
+                     dtype=np.float64):
+  """Returns a shared MelFrontend for the given parameters.
+
+  Frontends are memoized, so repeated calls with the same parameters are
+  cheap. See MelFrontend for the arguments.
+  """
+  return _get_mel_frontend(audio_sample_rate, window_length_secs,
+                           hop_length_secs, num_mel_bins,
+                           float(lower_edge_hertz), float(upper_edge_hertz),
+                           log_offset, np.dtype(dtype).name)
+
+
 def log_mel_spectrogram(data,
                         audio_sample_rate=8000,
                         log_offset=0.0,
@@ -202,21 +317,85 @@ def log_mel_spectrogram(data,
     log_offset: Add this to values when taking log to avoid -Infs.
     window_length_secs: Duration of each window to analyze.
     hop_length_secs: Advance between successive analysis windows.
-    **kwargs: Additional arguments to pass to spectrogram_to_mel_matrix.
+    **kwargs: Additional arguments to pass to spectrogram_to_mel_matrix
+      (num_mel_bins, lower_edge_hertz and upper_edge_hertz).
 
   Returns:
     2D np.array of (num_frames, num_mel_bins) consisting of log mel filterbank
     magnitudes for successive frames.
   """
-  window_length_samples = int(round(audio_sample_rate * window_length_secs))
-  hop_length_samples = int(round(audio_sample_rate * hop_length_secs))
-  fft_length = 2 ** int(np.ceil(np.log(window_length_samples) / np.log(2.0)))
-  spectrogram = stft_magnitude(
-      data,
-      fft_length=fft_length,
-      hop_length=hop_length_samples,
-      window_length=window_length_samples)
-  mel_spectrogram = np.dot(spectrogram, spectrogram_to_mel_matrix(
-      num_spectrogram_bins=spectrogram.shape[1],
-      audio_sample_rate=audio_sample_rate, **kwargs))
-  return np.log(mel_spectrogram + log_offset)
+  frontend = get_mel_frontend(audio_sample_rate, window_length_secs,
+                              hop_length_secs, log_offset=log_offset, **kwargs)
+  return frontend(data)
+
+
+def log_mel_spectrogram_batch(clips,
+                              audio_sample_rate=8000,
+                              log_offset=0.0,
+                              window_length_secs=0.025,
+                              hop_length_secs=0.010,
+                              pad_value=0.0,
+                              block_frames=256,
+                              **kwargs):
+  """Convert many waveforms to log mel spectrograms at once.
+
+  All clips are padded into one array and framed with a single strided view,
+  which saves the per-call overhead of log_mel_spectrogram() in a loop.
+  Whether that is faster depends on the clip length, dtype and machine, so
+  time both with `python3 benchmark.py mel_batch` on the target first.
+
+  Args:
+    clips: 2D np.array of (num_clips, num_samples) waveform data, or a list
+      of 1D np.arrays of possibly different lengths.
+    audio_sample_rate: The sampling rate of the clips.
+    log_offset: Add this to values when taking log to avoid -Infs.
+    window_length_secs: Duration of each window to analyze.
+    hop_length_secs: Advance between successive analysis windows.
+    pad_value: The value for frames past the end of shorter clips.
+    block_frames: Roughly how many frames to transform per FFT call.
+    **kwargs: Additional arguments to pass to spectrogram_to_mel_matrix
+      (num_mel_bins, lower_edge_hertz and upper_edge_hertz), and dtype.
+
+  Returns:
+    A tuple of (features, lengths), where features is a 3D np.array of
+    (num_clips, max_num_frames, num_mel_bins) and lengths is a 1D np.array
+    with the number of valid frames of each clip.
+  """
+  frontend = get_mel_frontend(audio_sample_rate, window_length_secs,
+                              hop_length_secs, log_offset=log_offset, **kwargs)
+  if isinstance(clips, np.ndarray) and clips.ndim == 2:
+    num_samples = np.full(len(clips), clips.shape[1])
+  else:
+    num_samples = np.array([len(clip) for clip in clips], dtype=np.int64)
+  lengths = np.array([frontend.num_frames(n) for n in num_samples], dtype=np.int64)
+  max_frames = lengths.max(initial=0)
+  features = np.empty((len(clips), max_frames, frontend.num_mel_bins),
+                      dtype=frontend.dtype)
+  if max_frames == 0:
+    return features, lengths
+
+  # Clips are copied into a small zero-padded block buffer, which is then
+  # framed with a single strided view and transformed in one FFT call.
+  clips_per_block = max(1, block_frames // max_frames)
+  block_samples = (frontend.window_length_samples +
+                   (max_frames - 1) * frontend.hop_length_samples)
+  block = np.zeros((clips_per_block, block_samples), dtype=frontend.dtype)
+  shape = (clips_per_block, max_frames, frontend.window_length_samples)
+  strides = (block.strides[0], block.strides[1] * frontend.hop_length_samples,
+             block.strides[1])
+  frames = np.lib.stride_tricks.as_strided(block, shape=shape, strides=strides,
+                                           writeable=False)
+  for start in range(0, len(clips), clips_per_block):
+    end = min(start + clips_per_block, len(clips))
+    for row, clip in zip(block, clips[start:end]):
+      count = min(len(clip), block_samples)
+      row[:count] = clip[:count]
+      row[count:] = 0
+    features[start:end] = frontend.mel_spectrogram(frames[:end - start])
+  # Only valid frames are logged: the zero-filled rest would give -inf.
+  for clip_features, length in zip(features, lengths):
+    valid = clip_features[:length]
+    valid += log_offset
+    np.log(valid, out=valid)
+    clip_features[length:] = pad_value
+  return features, lengths
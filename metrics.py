@@ -0,0 +1,268 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Opt-in timing histograms and event counters for the vision and voice stages.
+
+The camera, models, drawing and keyword spotter time their stages with span(),
+and count dropped frames and audio overflows with count(). Metrics are off
+unless the EDGE_ML_METRICS environment variable is set (to anything but 0);
+then every span lands in a histogram with fixed buckets, which costs a few
+microseconds. Turned off, span() returns a shared do-nothing context manager.
+
+With metrics on, they can be exported in the Prometheus text format or as JSON,
+once the program calls start_from_env() (the example and command-line scripts
+do; importing this module never starts anything):
+
+  * EDGE_ML_METRICS_FILE=metrics.prom writes them to a file when the program
+    exits (as JSON if the name ends with '.json').
+  * EDGE_ML_METRICS_PORT=9100 serves them on http://127.0.0.1:9100/metrics
+    (and as JSON on /metrics.json).
+
+Or call dump(), to_prometheus() or to_json() from the program.
+"""
+
+import atexit
+import bisect
+import contextlib
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+
+# Histogram bucket upper bounds, in seconds.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram(object):
+  """Counts observations in fixed buckets, like a Prometheus histogram.
+
+  Args:
+    buckets: The sorted upper bounds of the buckets; a last bucket catches the rest.
+  """
+
+  def __init__(self, buckets=BUCKETS):
+    self.buckets = tuple(buckets)
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.count += 1
+    self.sum += value
+
+  def quantile(self, q):
+    """Estimates a quantile by interpolating within its bucket (None if empty)."""
+    if not self.count:
+      return None
+    rank = q * self.count
+    seen = 0
+    for i, n in enumerate(self.counts):
+      if n and seen + n >= rank:
+        lower = self.buckets[i - 1] if i > 0 else 0.0
+        upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+        return lower + (upper - lower) * (rank - seen) / n
+      seen += n
+    return self.buckets[-1]
+
+
+class _Span(object):
+  """Times a `with` block into a registry's histogram."""
+  __slots__ = ('_registry', '_name', '_start')
+
+  def __init__(self, registry, name):
+    self._registry = registry
+    self._name = name
+
+  def __enter__(self):
+    self._start = time.monotonic()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self._registry.observe(self._name, time.monotonic() - self._start)
+
+
+class Registry(object):
+  """A thread-safe store of named histograms and counters."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._histograms = {}
+    self._counters = {}
+
+  def reset(self):
+    with self._lock:
+      self._histograms.clear()
+      self._counters.clear()
+
+  def span(self, name):
+    return _Span(self, name)
+
+  def observe(self, name, seconds):
+    with self._lock:
+      histogram = self._histograms.get(name)
+      if histogram is None:
+        histogram = self._histograms[name] = Histogram()
+      histogram.observe(seconds)
+
+  def count(self, name, n=1):
+    with self._lock:
+      self._counters[name] = self._counters.get(name, 0) + n
+
+  def snapshot(self):
+    """Returns the metrics as a JSON-serializable dict."""
+    with self._lock:
+      spans = {}
+      for name, h in sorted(self._histograms.items()):
+        spans[name] = {
+          'count': h.count,
+          'sum_seconds': h.sum,
+          'mean_seconds': h.sum / h.count,
+          'p50_seconds': h.quantile(0.5),
+          'p95_seconds': h.quantile(0.95),
+          'p99_seconds': h.quantile(0.99),
+          'buckets': dict(zip([str(b) for b in h.buckets] + ['+Inf'], h.counts)),
+        }
+      return {'spans': spans, 'counters': dict(sorted(self._counters.items()))}
+
+  def to_prometheus(self):
+    """Returns the metrics in the Prometheus text exposition format."""
+    with self._lock:
+      lines = ['# TYPE edge_ml_span_seconds histogram']
+      for name, h in sorted(self._histograms.items()):
+        cumulative = 0
+        for bound, n in zip([repr(b) for b in h.buckets] + ['+Inf'], h.counts):
+          cumulative += n
+          lines.append('edge_ml_span_seconds_bucket{span="%s",le="%s"} %d' % (
+              name, bound, cumulative))
+        lines.append('edge_ml_span_seconds_sum{span="%s"} %r' % (name, h.sum))
+        lines.append('edge_ml_span_seconds_count{span="%s"} %d' % (name, h.count))
+      lines.append('# TYPE edge_ml_events_total counter')
+      for name, n in sorted(self._counters.items()):
+        lines.append('edge_ml_events_total{event="%s"} %d' % (name, n))
+      return '\n'.join(lines) + '\n'
+
+  def to_json(self):
+    return json.dumps(self.snapshot(), indent=2)
+
+
+logger = logging.getLogger(__name__)
+
+registry = Registry()
+_enabled = os.environ.get('EDGE_ML_METRICS', '0') not in ('', '0')
+_started = False
+_NULL_SPAN = contextlib.nullcontext()
+
+
+def enabled():
+  """Returns whether metrics are being collected."""
+  return _enabled
+
+
+def enable(on=True):
+  """Turns metrics on or off, overriding EDGE_ML_METRICS."""
+  global _enabled
+  _enabled = on
+
+
+def span(name):
+  """Returns a context manager that times its block into the `name` histogram.
+
+  For example:
+
+    with metrics.span('detector.invoke'):
+      interpreter.invoke()
+  """
+  return _Span(registry, name) if _enabled else _NULL_SPAN
+
+
+def observe(name, seconds):
+  """Adds a duration to the `name` histogram."""
+  if _enabled:
+    registry.observe(name, seconds)
+
+
+def count(name, n=1):
+  """Adds n to the `name` counter."""
+  if _enabled and n:
+    registry.count(name, n)
+
+
+def to_prometheus():
+  return registry.to_prometheus()
+
+
+def to_json():
+  return registry.to_json()
+
+
+def dump(path):
+  """Writes the metrics to a file: JSON if the name ends with '.json', else Prometheus text."""
+  text = to_json() if path.endswith('.json') else to_prometheus()
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'w') as f:
+    f.write(text)
+  os.replace(tmp_path, path)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    if self.path == '/metrics':
+      body, content_type = to_prometheus(), 'text/plain; version=0.0.4'
+    elif self.path == '/metrics.json':
+      body, content_type = to_json(), 'application/json'
+    else:
+      self.send_error(404)
+      return
+    body = body.encode()
+    self.send_response(200)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+def serve(port, host='127.0.0.1'):
+  """Serves the metrics over HTTP from a background thread, and returns the server."""
+  server = http.server.ThreadingHTTPServer((host, port), _Handler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+
+def start_from_env():
+  """Starts the exports that EDGE_ML_METRICS_FILE and EDGE_ML_METRICS_PORT ask for.
+
+  Does nothing if metrics are off, or after the first call. If the port can't be
+  used, for example because another program on the host is serving its metrics
+  there, a warning is logged and the program carries on without serving.
+  """
+  global _started
+  if not _enabled or _started:
+    return
+  _started = True
+  if os.environ.get('EDGE_ML_METRICS_FILE'):
+    atexit.register(dump, os.environ['EDGE_ML_METRICS_FILE'])
+  if os.environ.get('EDGE_ML_METRICS_PORT'):
+    port = int(os.environ['EDGE_ML_METRICS_PORT'])
+    try:
+      serve(port)
+    except OSError as e:
+      logger.warning('Cannot serve metrics on port %d: %s', port, e)
@@ -0,0 +1,173 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Building blocks for running capture, inference and display as stages.
+
+This module provides DropOldestQueue, a bounded queue that never blocks the
+producer, and StageStats/PipelineStats, which keep per-stage frame rate and
+latency counters. Stats given a metric name also feed every latency and drop
+into `metrics`, so the summaries and the exported histograms come from the
+same record() calls.
+"""
+
+import collections
+import queue
+import threading
+import time
+
+import metrics
+
+
+class DropOldestQueue(object):
+  """A bounded queue that discards the oldest item when it is full.
+
+  Real-time stages want the most recent data, so rather than blocking a fast
+  producer (such as the camera) behind a slow consumer, put() evicts the oldest
+  queued item and counts it in `dropped`.
+
+  Args:
+    maxsize: The maximum number of queued items.
+    name: If set, drops are also counted in the '<name>.dropped' metric (see `metrics`).
+  """
+
+  def __init__(self, maxsize=1, name=None):
+    if maxsize < 1:
+      raise ValueError('maxsize must be >= 1, got %d' % maxsize)
+    self._items = collections.deque()
+    self._maxsize = maxsize
+    self._dropped_metric = name and name + '.dropped'
+    self._cond = threading.Condition()
+    self.dropped = 0
+
+  def __len__(self):
+    with self._cond:
+      return len(self._items)
+
+  def put(self, item):
+    """Adds an item, evicting the oldest one if the queue is full."""
+    with self._cond:
+      if len(self._items) >= self._maxsize:
+        self._items.popleft()
+        self.dropped += 1
+        if self._dropped_metric:
+          metrics.count(self._dropped_metric)
+      self._items.append(item)
+      self._cond.notify()
+
+  def get(self, timeout=None):
+    """Removes and returns the oldest item.
+
+    Args:
+      timeout: How long to wait for an item, in seconds. None waits forever.
+
+    Raises:
+      queue.Empty: if no item arrived within `timeout`.
+    """
+    with self._cond:
+      if not self._cond.wait_for(lambda: self._items, timeout):
+        raise queue.Empty
+      return self._items.popleft()
+
+  def get_nowait(self):
+    """Like get(), but raises queue.Empty immediately if there is no item."""
+    return self.get(timeout=0)
+
+
+class StageStats(object):
+  """Frame rate and latency counters for one pipeline stage.
+
+  Counters are updated by a single stage thread and read by anyone, so they are
+  plain attributes; a reader may see values that are one update apart.
+
+  Args:
+    name: A short name for the stage, used in summaries.
+    metric: If set, latencies are also observed in this `metrics` histogram, and
+      drops counted in '<metric>.dropped'.
+  """
+
+  def __init__(self, name, metric=None):
+    self.name = name
+    self.metric = metric
+    self.reset()
+
+  def reset(self):
+    self.count = 0
+    self.dropped = 0
+    self.total_latency = 0.0
+    self.max_latency = 0.0
+    self._start_time = None
+    self._last_time = None
+
+  def record(self, latency):
+    """Records one processed item that took `latency` seconds."""
+    now = time.monotonic()
+    if self._start_time is None:
+      self._start_time = now - latency
+    self._last_time = now
+    self.count += 1
+    self.total_latency += latency
+    if latency > self.max_latency:
+      self.max_latency = latency
+    if self.metric:
+      metrics.observe(self.metric, latency)
+
+  def drop(self, n=1):
+    """Counts n items that the stage skipped."""
+    self.dropped += n
+    if self.metric:
+      metrics.count(self.metric + '.dropped', n)
+
+  @property
+  def fps(self):
+    """The average number of items processed per second."""
+    if not self.count or self._last_time == self._start_time:
+      return 0.0
+    return self.count / (self._last_time - self._start_time)
+
+  @property
+  def mean_latency(self):
+    """The average time spent per item, in seconds."""
+    return self.total_latency / self.count if self.count else 0.0
+
+  def summary(self):
+    return '%-10s %6.1f fps  mean %6.1f ms  max %6.1f ms  dropped %d' % (
+        self.name, self.fps, 1000 * self.mean_latency,
+        1000 * self.max_latency, self.dropped)
+
+
+class PipelineStats(object):
+  """A collection of StageStats, keyed by stage name.
+
+  Args:
+    stage_names: The names of the stages to track, in pipeline order.
+    metric_prefix: If set, each stage feeds the '<metric_prefix>.<stage name>'
+      metric (see `StageStats`).
+  """
+
+  def __init__(self, stage_names=('capture', 'inference', 'display', 'end2end'),
+               metric_prefix=None):
+    self.stages = collections.OrderedDict(
+        (name, StageStats(name, metric_prefix and metric_prefix + '.' + name))
+        for name in stage_names)
+
+  def __getitem__(self, name):
+    return self.stages[name]
+
+  def reset(self):
+    for stage in self.stages.values():
+      stage.reset()
+
+  def summary(self):
+    """Returns a human readable, multi-line summary of all stages."""
+    return '\n'.join(stage.summary() for stage in self.stages.values())
@@ -3,6 +3,7 @@ import vision
 from time import sleep
 from pycoral.adapters.detect import BBox
 from bestiary import Volt
+import fov
 
 #   The video image is divided into
 #   numbered squares like this:
@@ -41,18 +42,26 @@ def get_fov_bboxes(image_size):
     left-to-right and top-to-bottom (top-left is first).
     See https://coral.ai/docs/reference/py/pycoral.adapters/#pycoral.adapters.detect.BBox
   """
-  cell_width = image_size[0] / FOV_COLUMNS
-  cell_height = image_size[1] / FOV_ROWS
-  bboxes = []
-  ymin = 0
-  for row in range(FOV_ROWS):
-    xmin = 0
-    for column in range(FOV_COLUMNS):
-      bbox = BBox(xmin, ymin, xmin + cell_width, ymin + cell_height)
-      bboxes.append(bbox)
-      xmin = xmin + cell_width
-    ymin = ymin + cell_height
-  return bboxes
+  # The grid for each image size is only built once, see fov.FovGrid.
+  return fov.get_fov_grid(tuple(image_size), FOV_COLUMNS, FOV_ROWS).bboxes
+
+
+def get_locations(bboxes, image_size):
+  """
+  Get the FOV cells where each of the given BBoxes currently appear.
+
+  This does the same as `get_location()` for many boxes at once, which is much
+  faster when there are several faces in every frame.
+
+  Args:
+    bboxes: A list of `BBox` objects you want to locate
+    image_size (x,y): A tuple with the image height and width
+  Returns:
+    A list with the FOV cell index of each BBox (based on the BBox center
+    point), or None for boxes centered outside the image.
+  """
+  grid = fov.get_fov_grid(tuple(image_size), FOV_COLUMNS, FOV_ROWS)
+  return [None if cell < 0 else int(cell) for cell in grid.locate(bboxes)]
 
 
 def get_location(bbox, image_size):
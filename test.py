@@ -15,6 +15,10 @@
 import subprocess
 import sys
 import time
+
+import numpy as np
+
+import fov
 import vision
 
 
@@ -25,8 +29,30 @@ def usb_accelerator_connected():
     return True
   return False
 
+def is_point_in_box(x, y, bbox):
+  return bbox.xmin <= x < bbox.xmax and bbox.ymin <= y < bbox.ymax
+
+def check_fov_grid(image_size=vision.VIDEO_SIZE, columns=3, rows=2):
+  """Checks that FovGrid.locate_points() picks the cell whose box contains each point."""
+  grid = fov.get_fov_grid(image_size, columns, rows)
+  width, height = image_size
+  # Half-pixel points, like the centers of integer boxes, and the cell corners.
+  rng = np.random.default_rng(0)
+  points = np.concatenate([rng.integers(0, [2 * width, 2 * height], (1000, 2)) / 2,
+                           [(bbox.xmin, bbox.ymin) for bbox in grid.bboxes]])
+  for (x, y), cell in zip(points, grid.locate_points(points)):
+    if [cell] != [i for i, bbox in enumerate(grid.bboxes) if is_point_in_box(x, y, bbox)]:
+      return False
+  return True
+
 if __name__ == '__main__':
 
+  print('--- Testing field of view grid ---')
+  if not check_fov_grid():
+    print('FovGrid.locate() disagrees with the grid boxes!')
+    sys.exit(1)
+  print('Field of view grid OK.\n')
+
   print('--- Testing camera ---')
 
   TIME_LIMIT = 7
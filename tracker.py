@@ -0,0 +1,369 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tracks detected objects from frame to frame.
+
+Tracker gives each object from `Detector.get_objects()` a stable track ID, by
+matching it with the tracks of earlier frames, and predicts where each track
+moves with a constant-velocity Kalman filter. TrackedDetector builds on it to
+run the detection model only every few frames and predict the boxes (and
+optionally follow them with optical flow) in between. For example:
+
+  detector = tracker.TrackedDetector(vision.Detector(vision.FACE_DETECTION_MODEL))
+  for frame in vision.get_frames():
+    faces = detector.get_objects(frame, threshold=0.5)
+    vision.draw_objects(frame, faces)
+"""
+
+import collections
+import time
+
+import cv2
+import numpy as np
+
+from pycoral.adapters import detect
+
+import pipeline
+
+TrackedObject = collections.namedtuple('TrackedObject', ['id', 'score', 'bbox', 'track_id'])
+TrackedObject.__doc__ = """A detected object with the ID of its track.
+
+Like `detect.Object`, `id` is the class ID and `bbox` a `BBox`, so tracked objects can be
+passed to `vision.draw_objects()`. `track_id` is the same for the same object in every frame.
+"""
+
+
+def _boxes(objects):
+  """Returns an (N, 4) array of xmin, ymin, xmax, ymax of the objects' boxes."""
+  return np.array([obj.bbox for obj in objects], dtype=np.float64).reshape(-1, 4)
+
+
+def iou_matrix(boxes_a, boxes_b):
+  """Returns the intersection over union of every pair of boxes.
+
+  Args:
+    boxes_a: An (N, 4) array of xmin, ymin, xmax, ymax.
+    boxes_b: An (M, 4) array of xmin, ymin, xmax, ymax.
+
+  Returns:
+    An (N, M) array.
+  """
+  a = boxes_a[:, np.newaxis]
+  b = boxes_b[np.newaxis]
+  width = np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0])
+  height = np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1])
+  intersection = np.maximum(width, 0) * np.maximum(height, 0)
+  area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+  area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+  union = area_a + area_b - intersection
+  return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+def _greedy_match(scores, min_score):
+  """Pairs rows with columns, best score first, ignoring pairs below min_score."""
+  matches = []
+  if not scores.size:
+    return matches
+  used_rows, used_cols = set(), set()
+  for flat in np.argsort(-scores, axis=None):
+    row, col = divmod(int(flat), scores.shape[1])
+    if scores[row, col] < min_score:
+      break
+    if row not in used_rows and col not in used_cols:
+      matches.append((row, col))
+      used_rows.add(row)
+      used_cols.add(col)
+  return matches
+
+
+def _to_state(boxes):
+  """Converts xmin, ymin, xmax, ymax boxes to center x, center y, width, height."""
+  return np.concatenate([(boxes[:, :2] + boxes[:, 2:]) / 2, boxes[:, 2:] - boxes[:, :2]], axis=1)
+
+
+def _to_boxes(state):
+  """Converts center x, center y, width, height to xmin, ymin, xmax, ymax boxes."""
+  half = np.maximum(state[:, 2:4], 0) / 2
+  return np.concatenate([state[:, :2] - half, state[:, :2] + half], axis=1)
+
+
+class Tracker(object):
+  """Assigns stable track IDs to detected objects and predicts their motion.
+
+  Each track is a Kalman filter over the box center, width and height and their velocities
+  (in pixels per frame). All tracks are predicted and corrected together, as one batch of
+  NumPy operations.
+
+  Call `predict()` once per frame, then `update()` with the frame's detections if there are
+  any. Detections are matched to tracks of the same class by IoU; detections that overlap
+  no track are matched by the distance between the centers instead, which catches small,
+  fast objects. Unmatched detections start new tracks.
+
+  Args:
+    iou_threshold: The minimum IoU to match a detection with a track.
+    max_distance: The maximum distance between the centers of a detection and a track that
+      don't overlap enough, relative to the size of the track's box, to still match them.
+    max_age: How many updates in a row a track may go unmatched before it is dropped. Until
+      then its predicted box is still reported, which stops boxes from flickering when the
+      model misses an object for a frame.
+    min_hits: How many detections a track needs before it is reported.
+    process_noise: How much the velocity of an object may change per frame (a variance,
+      in pixels squared).
+    measurement_noise: How noisy the detected boxes are (a variance, in pixels squared).
+  """
+
+  def __init__(self, iou_threshold=0.3, max_distance=0.5, max_age=2, min_hits=1,
+               process_noise=1.0, measurement_noise=10.0):
+    self.iou_threshold = iou_threshold
+    self.max_distance = max_distance
+    self.max_age = max_age
+    self.min_hits = min_hits
+    self.measurement_noise = measurement_noise
+    self._transition = np.eye(8)
+    self._transition[:4, 4:] = np.eye(4)
+    self._process_noise = np.diag([process_noise / 4] * 4 + [process_noise] * 4)
+    self._next_track_id = 0
+    self.reset()
+
+  def reset(self):
+    """Drops all tracks."""
+    self._state = np.zeros((0, 8))
+    self._covariance = np.zeros((0, 8, 8))
+    self._track_ids = np.zeros(0, dtype=np.int64)
+    self._class_ids = np.zeros(0, dtype=np.int64)
+    self._scores = np.zeros(0)
+    self._hits = np.zeros(0, dtype=np.int64)
+    self._misses = np.zeros(0, dtype=np.int64)
+
+  def __len__(self):
+    return len(self._state)
+
+  @property
+  def boxes(self):
+    """The current (N, 4) xmin, ymin, xmax, ymax boxes of all tracks, as floats."""
+    return _to_boxes(self._state)
+
+  def objects(self):
+    """Returns a `TrackedObject` for each track that has enough hits."""
+    boxes = np.rint(self.boxes).astype(int)
+    return [TrackedObject(id=int(class_id), score=float(score),
+                          bbox=detect.BBox(*(int(v) for v in box)), track_id=int(track_id))
+            for box, class_id, score, track_id, hits
+            in zip(boxes, self._class_ids, self._scores, self._track_ids, self._hits)
+            if hits >= self.min_hits]
+
+  def predict(self):
+    """Moves every track ahead by one frame, and returns `objects()`."""
+    self._state = self._state @ self._transition.T
+    self._covariance = (self._transition @ self._covariance @ self._transition.T +
+                        self._process_noise)
+    return self.objects()
+
+  def correct(self, indices, boxes, noise=None):
+    """Corrects the state of some tracks with measured boxes.
+
+    Args:
+      indices: The indices of the tracks to correct.
+      boxes: An array with the measured xmin, ymin, xmax, ymax of each of those tracks.
+      noise: The variance of the measurements; defaults to `measurement_noise`.
+    """
+    if not len(indices):
+      return
+    noise = self.measurement_noise if noise is None else noise
+    state = self._state[indices]
+    covariance = self._covariance[indices]
+    residual = _to_state(np.asarray(boxes, dtype=np.float64)) - state[:, :4]
+    innovation = covariance[:, :4, :4] + noise * np.eye(4)
+    gain = covariance[:, :, :4] @ np.linalg.inv(innovation)
+    self._state[indices] = state + (gain @ residual[..., np.newaxis])[..., 0]
+    self._covariance[indices] = covariance - gain @ covariance[:, :4, :]
+
+  def match(self, objects):
+    """Matches detected objects with the current tracks.
+
+    Returns:
+      A list of (track index, object index) pairs.
+    """
+    detections = _boxes(objects)
+    class_ids = np.array([obj.id for obj in objects], dtype=np.int64)
+    same_class = self._class_ids[:, np.newaxis] == class_ids[np.newaxis]
+    tracks = self.boxes
+    ious = np.where(same_class, iou_matrix(tracks, detections), -1.0)
+    matches = _greedy_match(ious, self.iou_threshold)
+
+    # Match what's left by how close the centers are, relative to the track's size.
+    rows = np.setdiff1d(np.arange(len(tracks)), [m[0] for m in matches])
+    cols = np.setdiff1d(np.arange(len(detections)), [m[1] for m in matches])
+    if len(rows) and len(cols):
+      centers = _to_state(tracks[rows])
+      offsets = centers[:, np.newaxis, :2] - _to_state(detections[cols])[np.newaxis, :, :2]
+      sizes = np.maximum(np.hypot(centers[:, 2], centers[:, 3]), 1.0)
+      closeness = np.where(same_class[np.ix_(rows, cols)],
+                           -np.hypot(offsets[..., 0], offsets[..., 1]) / sizes[:, np.newaxis],
+                           -np.inf)
+      matches += [(int(rows[r]), int(cols[c]))
+                  for r, c in _greedy_match(closeness, -self.max_distance)]
+    return matches
+
+  def update(self, objects):
+    """Updates the tracks with the objects detected in the current frame.
+
+    Args:
+      objects: A list of `Object` from `Detector.get_objects()`.
+
+    Returns:
+      A list of `TrackedObject`, as from `objects()`.
+    """
+    matches = self.match(objects)
+    track_indices = np.array([m[0] for m in matches], dtype=np.int64)
+    object_indices = [m[1] for m in matches]
+    self.correct(track_indices, _boxes([objects[i] for i in object_indices]))
+    self._scores[track_indices] = [objects[i].score for i in object_indices]
+    self._hits[track_indices] += 1
+    self._misses += 1
+    self._misses[track_indices] = 0
+
+    keep = self._misses <= self.max_age
+    matched = set(object_indices)
+    new = [obj for i, obj in enumerate(objects) if i not in matched]
+    self._add_tracks(new, keep)
+    return self.objects()
+
+  def _add_tracks(self, objects, keep):
+    """Drops the tracks not in keep, and starts a track for each of objects."""
+    count = len(objects)
+    state = np.zeros((count, 8))
+    state[:, :4] = _to_state(_boxes(objects))
+    covariance = np.tile(np.diag([self.measurement_noise] * 4 + [100.0] * 4), (count, 1, 1))
+    track_ids = np.arange(self._next_track_id, self._next_track_id + count)
+    self._next_track_id += count
+    self._state = np.concatenate([self._state[keep], state])
+    self._covariance = np.concatenate([self._covariance[keep], covariance])
+    self._track_ids = np.concatenate([self._track_ids[keep], track_ids])
+    self._class_ids = np.concatenate(
+        [self._class_ids[keep], np.array([obj.id for obj in objects], dtype=np.int64)])
+    self._scores = np.concatenate([self._scores[keep], [obj.score for obj in objects]])
+    self._hits = np.concatenate([self._hits[keep], np.ones(count, dtype=np.int64)])
+    self._misses = np.concatenate([self._misses[keep], np.zeros(count, dtype=np.int64)])
+
+
+class TrackedDetector(object):
+  """Runs a detector every few frames and tracks the objects in between.
+
+  On every `detect_every`'th frame the detection model runs and its objects update the
+  tracker. On the other frames the boxes are predicted from their motion so far and, with
+  `optical_flow=True`, corrected by following the image inside each box with Lucas-Kanade
+  optical flow, which handles objects that change direction at a small cost in CPU.
+
+  The `stats` attribute has the latency of the 'detect' and 'track' frames, and
+  `prediction_iou` measures how well the tracking keeps up: the mean IoU between the
+  predicted boxes and the boxes the model then detects on the next detection frame.
+
+  Args:
+    detector: A `vision.Detector`, or anything with its `get_objects()` method.
+    detect_every: Run the model on one of this many frames. 1 tracks without skipping.
+    tracker: The `Tracker` to use; by default, one with default settings.
+    optical_flow: Whether to follow the boxes with optical flow between detections.
+  """
+
+  def __init__(self, detector, detect_every=3, tracker=None, optical_flow=False):
+    if detect_every < 1:
+      raise ValueError('detect_every must be >= 1, got %d' % detect_every)
+    self.detector = detector
+    self.detect_every = detect_every
+    self.tracker = tracker or Tracker()
+    self.optical_flow = optical_flow
+    self.stats = pipeline.PipelineStats(('detect', 'track'), metric_prefix='tracker')
+    self._frame_count = 0
+    self._prev_gray = None
+    self._iou_sum = 0.0
+    self._iou_count = 0
+
+  @property
+  def prediction_iou(self):
+    """The mean IoU of the predicted boxes with the next detections, or None."""
+    return self._iou_sum / self._iou_count if self._iou_count else None
+
+  def reset_stats(self):
+    self.stats.reset()
+    self._iou_sum = 0.0
+    self._iou_count = 0
+
+  def summary(self):
+    """Returns a human readable summary of the stats."""
+    lines = [self.stats.summary()]
+    if self.prediction_iou is not None:
+      lines.append('prediction IoU %.3f' % self.prediction_iou)
+    return '\n'.join(lines)
+
+  def get_objects(self, frame, threshold=0.01):
+    """
+    Gets a list of tracked objects in the given image frame.
+
+    Args:
+      frame: The bitmap image; pass every frame of the video, in order.
+      threshold: The minimum confidence score for detected objects.
+
+    Returns:
+      A list of `TrackedObject` objects.
+    """
+    start = time.monotonic()
+    detect_now = self._frame_count % self.detect_every == 0
+    self._frame_count += 1
+    previous_boxes = self.tracker.boxes
+    self.tracker.predict()
+
+    gray = None
+    if self.optical_flow:
+      gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+      if not detect_now and self._prev_gray is not None and len(self.tracker):
+        self._follow_flow(previous_boxes, self._prev_gray, gray)
+      self._prev_gray = gray
+
+    if not detect_now:
+      objects = self.tracker.objects()
+      self.stats['track'].record(time.monotonic() - start)
+      return objects
+
+    detections = self.detector.get_objects(frame, threshold)
+    if len(self.tracker):
+      predicted = self.tracker.boxes
+      for track, obj in self.tracker.match(detections):
+        self._iou_sum += iou_matrix(predicted[track:track + 1], _boxes([detections[obj]]))[0, 0]
+        self._iou_count += 1
+    objects = self.tracker.update(detections)
+    self.stats['detect'].record(time.monotonic() - start)
+    return objects
+
+  def _follow_flow(self, boxes, prev_gray, gray):
+    """Corrects the tracks with the motion of a few points inside each box."""
+    # A 3x3 grid over the middle half of each box.
+    grid = np.linspace(0.25, 0.75, 3)
+    fx, fy = np.meshgrid(grid, grid)
+    fx, fy = fx.ravel(), fy.ravel()
+    points = np.stack([
+        boxes[:, 0:1] + fx * (boxes[:, 2:3] - boxes[:, 0:1]),
+        boxes[:, 1:2] + fy * (boxes[:, 3:4] - boxes[:, 1:2])], axis=-1)
+    moved, status, _ = cv2.calcOpticalFlowPyrLK(
+        prev_gray, gray, points.reshape(-1, 1, 2).astype(np.float32), None)
+    shifts = (moved.reshape(points.shape) - points)
+    found = status.reshape(points.shape[:2]).astype(bool)
+    indices = [i for i in range(len(boxes)) if found[i].any()]
+    if not indices:
+      return
+    shift = np.array([np.median(shifts[i][found[i]], axis=0) for i in indices])
+    measured = boxes[indices] + np.tile(shift, 2)
+    # Flow is less reliable than the detector.
+    self.tracker.correct(np.array(indices), measured,
+                         noise=4 * self.tracker.measurement_noise)
@@ -19,16 +19,28 @@ Capture images:
 Train new model using captured images (THIS SCRIPT):
   python3 train_images.py -l my-labels.txt
 
+Or using a packed dataset (see dataset.py), which needs no image decoding:
+  python3 train_images.py -l my-labels.txt -d capture.packed
+
+After capturing more images or adding labels, only extract the new images:
+  python3 train_images.py -l my-labels.txt --incremental
+
 Run the model:
   python3 classify_image.py -m my-model.tflite -l my-labels.txt
 """
 
 import argparse
+import collections
+import concurrent.futures
+import functools
 import os
 
+import numpy as np
 from PIL import Image
 
-from pycoral.adapters import classify
+import dataset
+import embeddings
+
 from pycoral.adapters import common
 from pycoral.learn.imprinting.engine import ImprintingEngine
 from pycoral.utils.edgetpu import make_interpreter
@@ -41,42 +53,159 @@ def read_image(path, shape):
   with Image.open(path) as img:
     return img.convert('RGB').resize(shape, Image.NEAREST)
 
-def train(capture_dir, labels, model, out_model):
+def _packed_image(packed, index, shape):
+  image = packed.images[index]
+  if packed.size != tuple(shape):
+    image = Image.fromarray(image).resize(shape, Image.NEAREST)
+  return image
+
+def class_samples(capture_dir, class_id, class_name, shape):
+  """Yields an `embeddings.Sample` for each captured image of a class.
+
+  capture_dir is either a directory with a subdirectory of image files per class,
+  or a packed dataset, whose images are used straight from the memory-mapped file.
+  """
+  if dataset.is_packed(capture_dir):
+    packed = dataset.PackedDataset(capture_dir)
+    for index in packed.indices(class_id):
+      yield embeddings.Sample(
+          '%s[%d]' % (capture_dir, index),
+          functools.partial(embeddings.content_hash, packed.images[index]),
+          functools.partial(_packed_image, packed, index, shape))
+    return
+
+  class_capture_dir = os.path.join(capture_dir, class_name)
+  for img in sorted(os.listdir(class_capture_dir)):
+    imgpath = os.path.join(class_capture_dir, img)
+    yield embeddings.Sample(imgpath, functools.partial(embeddings.file_hash, imgpath),
+                            functools.partial(read_image, imgpath, shape))
+
+def class_state_path(out_model):
+  """Returns the path of the per-class embedding sums saved alongside a trained model."""
+  return os.path.splitext(out_model)[0] + '.classes.npz'
+
+def make_extractor(model):
+  """Returns the imprinting engine for a base model, the interpreter of its embedding
+  extractor, and a key identifying the extractor (see `embeddings.EmbeddingCache`)."""
   engine = ImprintingEngine(model, keep_classes=False)
-
-  extractor = make_interpreter(engine.serialize_extractor_model(), device=':0')
+  extractor_model = engine.serialize_extractor_model()
+  extractor = make_interpreter(extractor_model, device=':0')
   extractor.allocate_tensors()
-
-  for class_id in sorted(labels):
-    class_name = labels[class_id]
-    print('\nClass: %s (id=%d)' % (class_name, class_id))
-    class_capture_dir = os.path.join(capture_dir, class_name)
-    for img in os.listdir(class_capture_dir):
-      imgpath = os.path.join(class_capture_dir, img)
-      common.set_input(extractor, read_image(imgpath, common.input_size(extractor)))
-      extractor.invoke()
-      embedding = classify.get_scores(extractor)
-      print('  %s => %s' % (imgpath, embedding))
-      engine.train(embedding, class_id)
+  return engine, extractor, embeddings.content_hash(extractor_model)
+
+def train(capture_dir, labels, model, out_model, cache_dir=None, num_workers=4,
+          incremental=False):
+  """Imprints a model with the captured images of each label.
+
+  The sum of each class's normalized embeddings is saved next to the model (see
+  class_state_path()). With incremental=True, those saved sums are reused: only the
+  images that weren't in the previous training run are extracted, and classes whose
+  images were all seen before aren't extracted at all. Images are compared by content
+  hash, so a file replaced under the same name is new. A class that lost images (or
+  whose images changed) is extracted again in full.
+
+  Args:
+    capture_dir: The capture directory or packed dataset.
+    labels: A dict of label names by ID.
+    model: The base model.
+    out_model: The path to save the trained model to.
+    cache_dir: Where to cache embeddings, so only new images are extracted when
+      retraining; None disables the cache.
+    num_workers: The number of threads reading images.
+    incremental: Whether to update the classes saved from the previous run of out_model.
+  """
+  engine, extractor, model_key = make_extractor(model)
+  cache = None
+  if cache_dir:
+    cache = embeddings.EmbeddingCache(cache_dir, model_key)
+
+  state_path = class_state_path(out_model)
+  classes = embeddings.ClassEmbeddings(model_key)
+  if incremental and os.path.exists(state_path):
+    previous = embeddings.ClassEmbeddings.load(state_path)
+    if previous.model_key == model_key:
+      classes = previous
+    else:
+      print('%s is for a different base model or an older version, training all classes.' %
+          state_path)
+
+  num_images = num_cached = num_reused = 0
+  try:
+    for class_id in sorted(labels):
+      class_name = labels[class_id]
+      print('\nClass: %s (id=%d)' % (class_name, class_id))
+      samples = list(class_samples(capture_dir, class_id, class_name,
+                                   common.input_size(extractor)))
+      with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        keys = dict(zip([s.name for s in samples], executor.map(lambda s: s.key(), samples)))
+      # Hash each image only once: extract() asks for the keys again.
+      samples = [s._replace(key=functools.partial(keys.get, s.name)) for s in samples]
+      current = collections.Counter(keys.values())
+      if class_name in classes and not classes.samples[class_name] - current:
+        num_reused += classes.counts[class_name]
+        new = current - classes.samples[class_name]
+        new_samples = []
+        for sample in samples:
+          if new[keys[sample.name]] > 0:
+            new[keys[sample.name]] -= 1
+            new_samples.append(sample)
+        samples = new_samples
+        print('  Reusing %d images, %d new' % (classes.counts[class_name], len(samples)))
+      else:
+        classes.remove(class_name)
+
+      for imgpath, embedding, cached in embeddings.extract(extractor, samples, cache,
+                                                           num_workers):
+        print('  %s => %s%s' % (imgpath, embedding, ' (cached)' if cached else ''))
+        if not incremental:
+          engine.train(embedding, class_id)
+        classes.add(class_name, embedding, keys[imgpath])
+        num_images += 1
+        num_cached += cached
+      if incremental and class_name in classes:
+        # A single embedding with the direction of the class average imprints the same
+        # weights as all of the class's images.
+        engine.train(classes.sums[class_name].astype(np.float32), class_id)
+  finally:
+    if cache is not None:
+      cache.save()
 
   with open(out_model, 'wb') as f:
     f.write(engine.serialize_model())
-  print('\nTrained model was saved to %s' % out_model)
+  for class_name in set(classes.sums) - set(labels.values()):
+    classes.remove(class_name)
+  classes.save(state_path)
+  print('\nExtracted %d images (%d embeddings from the cache), reused %d.' % (
+      num_images, num_cached, num_reused))
+  print('Trained model was saved to %s' % out_model)
 
 def main():
   parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   parser.add_argument('--labels', '-l', type=str, required=True,
                       help='Labels file')
   parser.add_argument('--capture_dir', '-d', type=str, default='capture',
-                      help='Capture directory')
+                      help='Capture directory, or packed dataset')
   parser.add_argument('--model', '-m', type=str, default=DEFAULT_BASE_MODEL,
                       help='Base model')
   parser.add_argument('--out_model', '-om', type=str, default='my-model.tflite',
                       help='Output model')
+  parser.add_argument('--cache_dir', type=str, default=None,
+                      help='Embedding cache directory (default: <capture_dir>/.embeddings)')
+  parser.add_argument('--no_cache', action='store_true',
+                      help='Extract every embedding again, without the cache')
+  parser.add_argument('--incremental', action='store_true',
+                      help='Only extract images that are new since the last training of '
+                           'the output model')
+  parser.add_argument('--num_workers', type=int, default=4,
+                      help='Number of threads reading images')
   args = parser.parse_args()
 
   labels = read_label_file(args.labels)
-  train(args.capture_dir, labels, args.model, args.out_model)
+  cache_dir = None
+  if not args.no_cache:
+    cache_dir = args.cache_dir or os.path.join(args.capture_dir, '.embeddings')
+  train(args.capture_dir, labels, args.model, args.out_model, cache_dir, args.num_workers,
+        args.incremental)
 
 if __name__ == '__main__':
   main()
@@ -12,23 +12,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import concurrent.futures
 import os.path
 import platform
+import queue
 import sys
+import threading
+import time
 
 import cv2
 import numpy as np
-import tflite_runtime.interpreter as tflite
 
 from pycoral.adapters import common
 from pycoral.adapters import classify
 from pycoral.adapters import detect
 
-_EDGETPU_SHARED_LIB = {
-  'Linux': 'libedgetpu.so.1',
-  'Darwin': 'libedgetpu.1.dylib',
-  'Windows': 'edgetpu.dll'
-}[platform.system()]
+import backends
+import embeddings
+import metrics
+import pipeline
 
 FACE_DETECTION_MODEL = 'models/ssd_mobilenet_v2_face_quant_postprocess_edgetpu.tflite'
 OBJECT_DETECTION_MODEL = 'models/ssd_mobilenet_v2_coco_quant_postprocess_edgetpu.tflite'
@@ -37,29 +40,142 @@ CLASSIFICATION_MODEL = 'models/tf2_mobilenet_v2_1.0_224_ptq_edgetpu.tflite'
 CLASSIFICATION_LABELS = 'models/imagenet_labels.txt'
 
 VIDEO_SIZE = (640, 480)
+# How long the capture thread waits after a failed camera read, doubling up to
+# the maximum while the camera keeps failing.
+READ_RETRY_SECONDS = 0.01
+MAX_READ_RETRY_SECONDS = 0.5
+# macOS only allows windows on the main thread, so get_frames() displays frames
+# from its own loop there, after the caller is done with each frame.
+DISPLAY_THREAD = platform.system() != 'Darwin'
 CORAL_COLOR = (86, 104, 237)
 BLUE = (255, 0, 0) # BGR (not RGB)
 
-def make_interpreter(model_file):
-  model_file, *device = model_file.split('@')
-  return tflite.Interpreter(
-      model_path=model_file,
-      experimental_delegates=[tflite.load_delegate(_EDGETPU_SHARED_LIB,
-                              {'device': device[0]} if device else {})])
+make_interpreter = backends.make_interpreter
 
 #########################
 ### VISION MODEL APIS ###
 #########################
 
+INTERPOLATION = {
+  'nearest': cv2.INTER_NEAREST,
+  'linear': cv2.INTER_LINEAR,
+  'area': cv2.INTER_AREA,
+  'cubic': cv2.INTER_CUBIC,
+}
+
+def _read_frame(frame, skip_unreadable=False):
+  """Returns `frame`, or reads it first if it's a file path.
+
+  A file that can't be read raises ValueError, or returns None if skip_unreadable.
+  """
+  if isinstance(frame, (str, os.PathLike)):
+    image = cv2.imread(os.fspath(frame))
+    if image is None:
+      if skip_unreadable:
+        return None
+      raise ValueError('Cannot read image %s' % frame)
+    return image
+  return frame
+
+def _prefetch(frames, preprocess, num_workers):
+  """Runs `preprocess` on each frame using worker threads, yielding results in order."""
+  with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+    pending = collections.deque()
+    for frame in frames:
+      pending.append(executor.submit(preprocess, frame))
+      if len(pending) > 2 * num_workers:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+
+class _InputWriter:
+  """Resizes frames straight into an interpreter's input tensor.
+
+  The tensor view is fetched for every frame and dropped before `invoke()`, because
+  TensorFlow Lite refuses to run while NumPy arrays still reference its buffers.
+
+  Args:
+    interpreter: The interpreter whose (first) input tensor receives the frames.
+    interpolation: 'nearest', 'linear', 'area', 'cubic', or an OpenCV `INTER_*` constant.
+    keep_aspect_ratio: If True, frames are scaled to fit in the top-left corner of the
+      tensor and the rest is zero-filled, as `common.set_resized_input()` does. Otherwise,
+      frames are stretched to fill the tensor.
+  """
+  def __init__(self, interpreter, interpolation, keep_aspect_ratio):
+    self._tensor = interpreter.tensor(interpreter.get_input_details()[0]['index'])
+    self._width, self._height = common.input_size(interpreter)
+    self._interpolation = INTERPOLATION.get(interpolation, interpolation)
+    self._keep_aspect_ratio = keep_aspect_ratio
+    # The size of the image area last written to the tensor; the zero padding around it
+    # only needs to be redrawn when this changes.
+    self._image_size = None
+    self._scratch = collections.defaultdict(list)
+    self._scratch_lock = threading.Lock()
+
+  def _layout(self, frame):
+    """Returns the (width, height) to resize `frame` to, and the scale factor."""
+    if not self._keep_aspect_ratio:
+      return (self._width, self._height), 1.0
+    frame_height, frame_width = frame.shape[:2]
+    scale = min(self._width / frame_width, self._height / frame_height)
+    return (int(frame_width * scale), int(frame_height * scale)), scale
+
+  def write(self, frame):
+    """Resizes `frame` into the input tensor and returns the scale factor."""
+    size, scale = self._layout(frame)
+    dst = self._image_area(size)
+    if cv2.resize(frame, size, dst=dst, interpolation=self._interpolation) is not dst:
+      # Some OpenCV builds can't write into a strided view; fall back to a copy.
+      dst[...] = cv2.resize(frame, size, interpolation=self._interpolation)
+    return scale
+
+  def resize(self, frame):
+    """Resizes `frame` into a scratch buffer, for use from a worker thread.
+
+    Returns:
+      A (buffer, scale) tuple. Pass the buffer to `write_resized()`.
+    """
+    size, scale = self._layout(frame)
+    width, height = size
+    shape = (height, width) + frame.shape[2:]
+    with self._scratch_lock:
+      free = self._scratch[shape, frame.dtype]
+      buffer = free.pop() if free else np.empty(shape, dtype=frame.dtype)
+    cv2.resize(frame, size, dst=buffer, interpolation=self._interpolation)
+    return buffer, scale
+
+  def write_resized(self, buffer):
+    """Copies a buffer from `resize()` into the input tensor and recycles the buffer."""
+    height, width = buffer.shape[:2]
+    self._image_area((width, height))[...] = buffer
+    with self._scratch_lock:
+      self._scratch[buffer.shape, buffer.dtype].append(buffer)
+
+  def _image_area(self, size):
+    tensor = self._tensor()[0]
+    if not self._keep_aspect_ratio:
+      return tensor
+    if size != self._image_size:
+      tensor.fill(0)
+      self._image_size = size
+    width, height = size
+    return tensor[:height, :width]
+
 class Detector:
   """Performs inferencing with an object detection model.
 
   Args:
     model: Path to a `.tflite` file (compiled for the Edge TPU). Must be an SSD model.
+    backend: How to run the model: 'edgetpu', 'cpu' or 'stub'. See `backends`.
+    num_threads: The number of threads to use with the 'cpu' backend.
+    interpolation: How frames are resized to the model input: 'nearest', 'linear', 'area'
+      or 'cubic'. 'area' and 'linear' are a good deal faster than 'cubic' on the Pi.
   """
-  def __init__(self, model):
-    self.interpreter = make_interpreter(model)
+  def __init__(self, model, backend=None, num_threads=None, interpolation='cubic'):
+    self.interpreter = make_interpreter(model, backend, num_threads,
+                                        stub=backends.detection_stub())
     self.interpreter.allocate_tensors()
+    self._input = _InputWriter(self.interpreter, interpolation, keep_aspect_ratio=True)
 
   def get_objects(self, frame, threshold=0.01):
     """
@@ -74,22 +190,77 @@ class Detector:
       id, score, and bounding box as `BBox`.
       See https://coral.ai/docs/reference/py/pycoral.adapters/#pycoral.adapters.detect.Object
     """
-    height, width, _ = frame.shape
-    _, scale = common.set_resized_input(self.interpreter, (width, height),
-                                        lambda size: cv2.resize(frame, size, fx=0, fy=0,
-                                                                interpolation=cv2.INTER_CUBIC))
-    self.interpreter.invoke()
-    return detect.get_objects(self.interpreter, threshold, scale)
+    with metrics.span('detector.preprocess'):
+      scale = self._input.write(frame)
+    with metrics.span('detector.invoke'):
+      self.interpreter.invoke()
+    with metrics.span('detector.postprocess'):
+      return detect.get_objects(self.interpreter, threshold, (scale, scale))
+
+  def get_objects_batch(self, frames, threshold=0.01, num_workers=2, skip_unreadable=False):
+    """
+    Gets the objects detected in each of many image frames.
+
+    Frames are read and resized on worker threads while the model runs on earlier frames.
+
+    Args:
+      frames: An iterable of bitmap images or image file paths, or a stacked NumPy array of
+        images with shape (count, height, width, channels).
+      threshold: The minimum confidence score for returned results.
+      num_workers: The number of threads that read and resize frames.
+      skip_unreadable: If True, a file that can't be read yields None instead of raising
+        ValueError.
+
+    Returns:
+      An iterator that yields a list of `Object` objects (see `get_objects()`) for each
+      frame, in the same order as `frames`.
+    """
+    def preprocess(frame):
+      image = _read_frame(frame, skip_unreadable)
+      if image is None:
+        return None
+      with metrics.span('detector.preprocess'):
+        return self._input.resize(image)
+
+    for prepared in _prefetch(frames, preprocess, num_workers):
+      if prepared is None:
+        yield None
+        continue
+      resized, scale = prepared
+      self._input.write_resized(resized)
+      with metrics.span('detector.invoke'):
+        self.interpreter.invoke()
+      with metrics.span('detector.postprocess'):
+        objects = detect.get_objects(self.interpreter, threshold, (scale, scale))
+      yield objects
 
 class Classifier:
   """Performs inferencing with an image classification model.
 
   Args:
     model: Path to a `.tflite` file (compiled for the Edge TPU). Must be a classification model.
+    backend: How to run the model: 'edgetpu', 'cpu' or 'stub'. See `backends`.
+    num_threads: The number of threads to use with the 'cpu' backend.
+    interpolation: How frames are resized to the model input: 'nearest', 'linear', 'area'
+      or 'cubic'. 'area' and 'linear' are a good deal faster than 'cubic' on the Pi.
+    head: An embedding classifier from `embeddings` (or the path of one saved with its
+      `save()`), which classifies the model's output. The model is then an embedding
+      extractor, such as the one `evaluate_images.py --out_extractor` saves.
   """
-  def __init__(self, model):
-    self.interpreter = make_interpreter(model)
+  def __init__(self, model, backend=None, num_threads=None, interpolation='cubic',
+               head=None):
+    self.interpreter = make_interpreter(model, backend, num_threads,
+                                        stub=backends.classification_stub())
     self.interpreter.allocate_tensors()
+    self._input = _InputWriter(self.interpreter, interpolation, keep_aspect_ratio=False)
+    if isinstance(head, (str, os.PathLike)):
+      head = embeddings.load_classifier(head)
+    self.head = head
+
+  def _get_classes(self, top_k, threshold):
+    if self.head is not None:
+      return self.head.classify(classify.get_scores(self.interpreter), top_k, threshold)
+    return classify.get_classes(self.interpreter, top_k, threshold)
 
   def get_classes(self, frame, top_k=1, threshold=0.0):
     """
@@ -104,10 +275,233 @@ class Classifier:
       A list of `Class` objects representing the classification results, ordered by scores.
       See https://coral.ai/docs/reference/py/pycoral.adapters/#pycoral.adapters.classify.Class
     """
-    size = common.input_size(self.interpreter)
-    common.set_input(self.interpreter, cv2.resize(frame, size, fx=0, fy=0, interpolation = cv2.INTER_CUBIC))
-    self.interpreter.invoke()
-    return classify.get_classes(self.interpreter, top_k, threshold)
+    with metrics.span('classifier.preprocess'):
+      self._input.write(frame)
+    with metrics.span('classifier.invoke'):
+      self.interpreter.invoke()
+    with metrics.span('classifier.postprocess'):
+      return self._get_classes(top_k, threshold)
+
+  def get_classes_batch(self, frames, top_k=1, threshold=0.0, num_workers=2,
+                        skip_unreadable=False):
+    """
+    Gets classification results for each of many image frames.
+
+    Frames are read and resized on worker threads while the model runs on earlier frames.
+
+    Args:
+      frames: An iterable of bitmap images or image file paths, or a stacked NumPy array of
+        images with shape (count, height, width, channels).
+      top_k: The number of top results to return for each frame.
+      threshold: The minimum confidence score for returned results.
+      num_workers: The number of threads that read and resize frames.
+      skip_unreadable: If True, a file that can't be read yields None instead of raising
+        ValueError.
+
+    Returns:
+      An iterator that yields a list of `Class` objects (see `get_classes()`) for each frame,
+      in the same order as `frames`.
+    """
+    def preprocess(frame):
+      image = _read_frame(frame, skip_unreadable)
+      if image is None:
+        return None
+      with metrics.span('classifier.preprocess'):
+        return self._input.resize(image)
+
+    for prepared in _prefetch(frames, preprocess, num_workers):
+      if prepared is None:
+        yield None
+        continue
+      resized, _ = prepared
+      self._input.write_resized(resized)
+      with metrics.span('classifier.invoke'):
+        self.interpreter.invoke()
+      with metrics.span('classifier.postprocess'):
+        classes = self._get_classes(top_k, threshold)
+      yield classes
+
+def edgetpu_devices():
+  """Returns the device names (':0', ':1', ...) of all connected Edge TPUs."""
+  # Imported here because it loads the Edge TPU runtime, which the cpu and stub
+  # backends don't need.
+  from pycoral.utils import edgetpu
+  return [':%d' % i for i in range(len(edgetpu.list_edge_tpus()))]
+
+class _InterpreterPool:
+  """Runs one model instance per device and spreads frames across them.
+
+  Idle model instances wait in a FIFO queue, so frames go round-robin to whichever
+  device is free next.
+  """
+  def __init__(self, model_class, model, devices, backend, num_threads):
+    if devices is None:
+      if (backend or backends.default_backend()) == backends.EDGETPU:
+        devices = edgetpu_devices()
+      else:
+        devices = ['']
+    if not devices:
+      raise ValueError('No Edge TPU devices found')
+    self.devices = list(devices)
+    self._idle = queue.Queue()
+    for device in self.devices:
+      model_file = '%s@%s' % (model, device) if device else model
+      self._idle.put((device, model_class(model_file, backend, num_threads)))
+    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.devices))
+    self._lock = threading.Lock()
+    self.reset_stats()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def close(self):
+    """Waits for pending frames and shuts down the worker threads."""
+    self._executor.shutdown(wait=True)
+
+  def _run(self, frame, kwargs):
+    device, instance = self._idle.get()
+    start = time.monotonic()
+    try:
+      return self._predict(instance, frame, **kwargs)
+    finally:
+      elapsed = time.monotonic() - start
+      with self._lock:
+        self._busy[device] += elapsed
+        self._frames[device] += 1
+      self._idle.put((device, instance))
+
+  def submit(self, frame, **kwargs):
+    """
+    Queues a frame for inference on the next free device.
+
+    Args:
+      frame: The bitmap image to pass through the model.
+      **kwargs: Arguments for the single-device method, such as `threshold`.
+
+    Returns:
+      A `concurrent.futures.Future` for the results.
+    """
+    return self._executor.submit(self._run, frame, kwargs)
+
+  def map(self, frames, **kwargs):
+    """
+    Runs inference on a stream of frames, using all devices at once.
+
+    Args:
+      frames: An iterable of bitmap images.
+      **kwargs: Arguments for the single-device method, such as `threshold`.
+
+    Returns:
+      An iterator over the results, in the same order as `frames`.
+    """
+    pending = collections.deque()
+    for frame in frames:
+      pending.append(self.submit(frame, **kwargs))
+      if len(pending) >= 2 * len(self.devices):
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+
+  def reset_stats(self):
+    with self._lock:
+      self._start_time = time.monotonic()
+      self._busy = {device: 0.0 for device in self.devices}
+      self._frames = {device: 0 for device in self.devices}
+
+  def utilization(self):
+    """
+    Gets the fraction of time each device spent running inference since the pool was created
+    (or since `reset_stats()`).
+
+    Returns:
+      A dict that maps each device name to a value between 0 and 1.
+    """
+    elapsed = time.monotonic() - self._start_time
+    with self._lock:
+      return {device: busy / elapsed for device, busy in self._busy.items()}
+
+  def stats(self):
+    """
+    Gets per-device counters.
+
+    Returns:
+      A dict that maps each device name to a dict with the number of 'frames' processed,
+      the 'busy' time in seconds and the 'utilization'.
+    """
+    utilization = self.utilization()
+    with self._lock:
+      return {device: {'frames': self._frames[device],
+                       'busy': self._busy[device],
+                       'utilization': utilization[device]}
+              for device in self.devices}
+
+class DetectorPool(_InterpreterPool):
+  """Performs inferencing with an object detection model on several Edge TPUs at once.
+
+  Args:
+    model: Path to a `.tflite` file (compiled for the Edge TPU). Must be an SSD model.
+    devices: The devices to use, such as `[':0', ':1']`. Defaults to all connected Edge TPUs.
+      With the 'cpu' or 'stub' backend, each entry adds another interpreter.
+    backend: How to run the model: 'edgetpu', 'cpu' or 'stub'. See `backends`.
+    num_threads: The number of threads to use per interpreter with the 'cpu' backend.
+  """
+  def __init__(self, model, devices=None, backend=None, num_threads=None):
+    super().__init__(Detector, model, devices, backend, num_threads)
+
+  def _predict(self, detector, frame, **kwargs):
+    return detector.get_objects(frame, **kwargs)
+
+  def get_objects(self, frame, threshold=0.01):
+    """
+    Gets a list of objects detected in the given image frame, using the next free device.
+
+    This blocks until the result is ready, but it's safe to call from several threads. To
+    keep all devices busy from one thread, use `submit()` or `map()` instead.
+
+    Args:
+      frame: The bitmap image to pass through the model.
+      threshold: The minimum confidence score for returned results.
+
+    Returns:
+      A list of `Object` objects, as returned by `Detector.get_objects()`.
+    """
+    return self.submit(frame, threshold=threshold).result()
+
+class ClassifierPool(_InterpreterPool):
+  """Performs inferencing with an image classification model on several Edge TPUs at once.
+
+  Args:
+    model: Path to a `.tflite` file (compiled for the Edge TPU). Must be a classification model.
+    devices: The devices to use, such as `[':0', ':1']`. Defaults to all connected Edge TPUs.
+      With the 'cpu' or 'stub' backend, each entry adds another interpreter.
+    backend: How to run the model: 'edgetpu', 'cpu' or 'stub'. See `backends`.
+    num_threads: The number of threads to use per interpreter with the 'cpu' backend.
+  """
+  def __init__(self, model, devices=None, backend=None, num_threads=None):
+    super().__init__(Classifier, model, devices, backend, num_threads)
+
+  def _predict(self, classifier, frame, **kwargs):
+    return classifier.get_classes(frame, **kwargs)
+
+  def get_classes(self, frame, top_k=1, threshold=0.0):
+    """
+    Gets classification results as a list of ordered classes, using the next free device.
+
+    This blocks until the result is ready, but it's safe to call from several threads. To
+    keep all devices busy from one thread, use `submit()` or `map()` instead.
+
+    Args:
+      frame: The bitmap image to pass through the model.
+      top_k: The number of top results to return.
+      threshold: The minimum confidence score for returned results.
+
+    Returns:
+      A list of `Class` objects, as returned by `Classifier.get_classes()`.
+    """
+    return self.submit(frame, top_k=top_k, threshold=threshold).result()
 
 #############################
 ### CAMERA & DISPLAY APIS ###
@@ -124,12 +518,14 @@ def draw_objects(frame, objs, labels=None, color=CORAL_COLOR, thickness=5):
     color: The RGB color to use for the bounding box.
     thickness: The bounding box pixel thickness.
   """
-  for obj in objs:
-    bbox = obj.bbox
-    cv2.rectangle(frame, (bbox.xmin, bbox.ymin), (bbox.xmax, bbox.ymax), color, thickness)
-    if labels:
-      cv2.putText(frame, labels.get(obj.id), (bbox.xmin + thickness, bbox.ymax - thickness),
-                  fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=1, color=CORAL_COLOR, thickness=2)
+  with metrics.span('draw'):
+    for obj in objs:
+      bbox = obj.bbox
+      cv2.rectangle(frame, (bbox.xmin, bbox.ymin), (bbox.xmax, bbox.ymax), color, thickness)
+      if labels:
+        cv2.putText(frame, labels.get(obj.id), (bbox.xmin + thickness, bbox.ymax - thickness),
+                    fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=1, color=CORAL_COLOR,
+                    thickness=2)
 
 def draw_circle(frame, point, radius, color=CORAL_COLOR, thickness=5):
   """Draws a circle onto the frame."""
@@ -156,15 +552,26 @@ def draw_classes(frame, classes, labels, color=CORAL_COLOR):
     cv2.putText(frame, label, (10, 30), cv2.FONT_HERSHEY_PLAIN, 2.0, color, 2)
 
 def get_frames(title='Raspimon camera', size=VIDEO_SIZE, handle_key=None,
-               capture_device_index=0):
+               capture_device_index=0, stats=None, queue_size=1):
   """
   Gets a stream of image frames from the default camera.
 
+  Camera capture and display each run on their own thread, so reading the next frame and
+  showing the previous one overlap with whatever the caller does with the current frame. The
+  stages are connected by queues that drop the oldest frame when full, so a slow stage always
+  gets the freshest frame instead of falling behind. On macOS, where windows only work on
+  the main thread, frames are displayed between iterations instead (see `DISPLAY_THREAD`).
+
   Args:
     title: A title for the display window.
     size: The image resolution for all frames, as a tuple (x, y).
     handle_key: A callback function that accepts arguments (key, frame) for a key event and
       the image frame from the moment the key was pressed.
+    capture_device_index: The index of the camera to capture from.
+    stats: An optional `pipeline.PipelineStats` that collects frame rate and latency counters
+      for the 'capture', 'inference' (the caller's loop body), 'display' and 'end2end' stages.
+      By default, they feed the 'camera.*' metrics (see `metrics`).
+    queue_size: The number of frames buffered between stages.
   Returns:
     An iterator that yields each image frame from the default camera.
   """
@@ -176,6 +583,9 @@ def get_frames(title='Raspimon camera', size=VIDEO_SIZE, handle_key=None,
         return False
       return True
 
+  if stats is None:
+    stats = pipeline.PipelineStats(metric_prefix='camera')
+
   attempts = 5
   while True:
     cap = cv2.VideoCapture(capture_device_index)
@@ -194,28 +604,125 @@ def get_frames(title='Raspimon camera', size=VIDEO_SIZE, handle_key=None,
   cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
   cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
 
-  try:
-    while True:
+  captured = pipeline.DropOldestQueue(queue_size, name='camera.capture')
+  processed = pipeline.DropOldestQueue(queue_size, name='camera.display')
+  keys = queue.Queue()
+  stopped = threading.Event()
+
+  def capture():
+    retry_seconds = READ_RETRY_SECONDS
+    while not stopped.is_set():
+      start = time.monotonic()
       success, frame = cap.read()
+      if not success:
+        metrics.count('camera.read_failures')
+        # Don't spin while the camera is stalled.
+        stopped.wait(retry_seconds)
+        retry_seconds = min(2 * retry_seconds, MAX_READ_RETRY_SECONDS)
+        continue
+      retry_seconds = READ_RETRY_SECONDS
       frame = cv2.flip(frame, 1)
-      if success:
-        yield frame
-        cv2.imshow(title, frame)
+      stats['capture'].record(time.monotonic() - start)
+      captured.put((frame, start))
+      stats['capture'].dropped = captured.dropped
+
+  def show(frame, timestamp):
+    start = time.monotonic()
+    cv2.imshow(title, frame)
+    key = cv2.waitKey(1)
+    end = time.monotonic()
+    stats['display'].record(end - start)
+    stats['end2end'].record(end - timestamp)
+    return key
+
+  # All HighGUI calls stay on one thread, because window handling is not thread-safe.
+  def display():
+    frame = None
+    while not stopped.is_set():
+      try:
+        frame, timestamp = processed.get(timeout=0.01)
+      except queue.Empty:
+        key = cv2.waitKey(1)
+      else:
+        key = show(frame, timestamp)
+      if key != -1:
+        keys.put((key, frame))
+    cv2.destroyAllWindows()
 
-      key = cv2.waitKey(1)
-      if key != -1 and not handle_key(key, frame):
+  threads = [threading.Thread(target=capture, daemon=True)]
+  if DISPLAY_THREAD:
+    threads.append(threading.Thread(target=display, daemon=True))
+  for thread in threads:
+    thread.start()
+
+  try:
+    while True:
+      try:
+        frame, timestamp = captured.get(timeout=0.1)
+      except queue.Empty:
+        if not DISPLAY_THREAD:
+          cv2.waitKey(1)
+      else:
+        start = time.monotonic()
+        yield frame
+        stats['inference'].record(time.monotonic() - start)
+        if DISPLAY_THREAD:
+          processed.put((frame, timestamp))
+          stats['display'].dropped = processed.dropped
+        else:
+          key = show(frame, timestamp)
+          if key != -1:
+            keys.put((key, frame))
+
+      keep_going = True
+      while keep_going and not keys.empty():
+        key, key_frame = keys.get()
+        keep_going = handle_key(key, key_frame)
+      if not keep_going:
         break
   finally:
+    stopped.set()
+    for thread in threads:
+      thread.join()
+    if not DISPLAY_THREAD:
+      cv2.destroyAllWindows()
     cap.release()
-    cv2.destroyAllWindows()
 
-def save_frame(filename, frame):
+# Directories that save_frame() has already created. A directory that is removed
+# later is created again when a write to it fails.
+_made_dirs = set()
+
+def _write_frame(filename, frame, params):
+  """Writes an image, and returns False if OpenCV couldn't."""
+  if filename.endswith('.npy'):
+    try:
+      np.save(filename, frame)
+    except FileNotFoundError:
+      return False
+    return True
+  return cv2.imwrite(filename, frame, params or [])
+
+def save_frame(filename, frame, params=None):
   """
   Saves an image to a specified location.
 
   Args:
-    filename: The path where you'd like to save the image.
+    filename: The path where you'd like to save the image. The extension picks the format,
+      such as '.png' or '.jpg'; '.npy' saves the raw NumPy array, which is the fastest to write.
     frame: The bitmap image to save.
+    params: Optional OpenCV encoding parameters, such as `[cv2.IMWRITE_JPEG_QUALITY, 90]`.
+
+  Raises:
+    OSError: If the image couldn't be written.
   """
-  os.makedirs(os.path.dirname(filename), exist_ok=True)
-  cv2.imwrite(filename, frame)
+  directory = os.path.dirname(filename)
+  if directory not in _made_dirs:
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+    _made_dirs.add(directory)
+  if _write_frame(filename, frame, params):
+    return
+  if directory:
+    os.makedirs(directory, exist_ok=True)
+  if not _write_frame(filename, frame, params):
+    raise OSError('Cannot write image %s' % filename)
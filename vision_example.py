@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import metrics
+import tracker
 import vision
 from pycoral.utils.dataset import read_label_file
 
@@ -28,6 +30,15 @@ def run_face_detector_example():
     faces = detector.get_objects(frame)
     vision.draw_objects(frame, faces)
 
+def run_tracked_face_detector_example():
+  # Runs the model on every third frame and tracks the faces in between.
+  detector = tracker.TrackedDetector(vision.Detector(vision.FACE_DETECTION_MODEL),
+                                     detect_every=3)
+  for frame in vision.get_frames('Tracked Face Detector', size=(640, 480)):
+    faces = detector.get_objects(frame)
+    vision.draw_objects(frame, faces)
+  print(detector.summary())
+
 def run_classifier_example():
   labels = read_label_file(vision.CLASSIFICATION_LABELS)
   classifier = vision.Classifier(vision.CLASSIFICATION_MODEL)
@@ -36,5 +47,6 @@ def run_classifier_example():
     vision.draw_classes(frame, classes, labels)
 
 if __name__ == '__main__':
+  metrics.start_from_env()
   #run_classifier_example()
   run_object_detector_example()
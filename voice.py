@@ -14,37 +14,42 @@
 
 """Keyword spotter model."""
 
+import asyncio
+import collections
 import logging
-import platform
+import os
 import queue
 import sys
 import threading
+import time
 
 import numpy as np
 
 import audio_recorder
+import backends
 import mel_features
+import metrics
+import pipeline
 
-import tflite_runtime.interpreter as tflite
-
-_EDGETPU_SHARED_LIB = {
-  'Linux': 'libedgetpu.so.1',
-  'Darwin': 'libedgetpu.1.dylib',
-  'Windows': 'edgetpu.dll'
-}[platform.system()]
+# Set EDGE_ML_LOG_LEVEL (e.g. to INFO or DEBUG) to see the audio loggers' messages.
+LOG_LEVEL = os.environ.get('EDGE_ML_LOG_LEVEL', 'ERROR').upper()
 
 logging.basicConfig(
     stream=sys.stdout,
     format="%(levelname)-8s %(asctime)-15s %(name)s %(message)s")
-audio_recorder.logger.setLevel(logging.ERROR)
+audio_recorder.logger.setLevel(LOG_LEVEL)
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.ERROR)
+logger.setLevel(LOG_LEVEL)
 
 class Uint8LogMelFeatureExtractor(object):
   """Provide uint8 log mel spectrogram slices from an AudioRecorder object.
 
   This class provides one public method, get_next_spectrogram(), which gets
   a specified number of spectral slices from an AudioRecorder.
+
+  The extractor works incrementally: it keeps the audio samples that overlap
+  the next analysis window and the most recent mel frames, so each call only
+  computes the STFT of the new hop, using a shared MelFrontend.
   """
 
   def __init__(self, num_frames_hop=33):
@@ -61,92 +66,140 @@ class Uint8LogMelFeatureExtractor(object):
     self._clear_buffers()
 
   def _clear_buffers(self):
-    self._audio_buffer = np.array([], dtype=np.int16).reshape(0, 1)
-    self._spectrogram = np.zeros((self.frame_length_spectra, self.num_mel_bins),
-                                 dtype=np.float32)
-
-  def _spectrogram_underlap_samples(self, audio_sample_rate_hz):
-    return int((self.spectrogram_window_length_seconds -
-                self.spectrogram_hop_length_seconds) * audio_sample_rate_hz)
-
-  def _frame_duration_seconds(self, num_spectra):
-    return (self.spectrogram_window_length_seconds +
-            (num_spectra - 1) * self.spectrogram_hop_length_seconds)
-
-  def _compute_spectrogram(self, audio_samples, audio_sample_rate_hz):
-    """Compute log-mel spectrogram and scale it to uint8."""
-    samples = audio_samples.flatten() / float(2**15)
-    spectrogram = 30 * (
-        mel_features.log_mel_spectrogram(
-            samples,
-            audio_sample_rate_hz,
-            log_offset=0.001,
-            window_length_secs=self.spectrogram_window_length_seconds,
-            hop_length_secs=self.spectrogram_hop_length_seconds,
-            num_mel_bins=self.num_mel_bins,
-            lower_edge_hertz=60,
-            upper_edge_hertz=3800) - np.log(1e-3))
-    return spectrogram
+    self._sample_rate_hz = None
+    self._num_samples = 0
+    # Each mel frame is stored twice, at i and i + frame_length_spectra, so the
+    # most recent frame_length_spectra frames are always one contiguous slice.
+    self._spectra = np.zeros((2 * self.frame_length_spectra, self.num_mel_bins),
+                             dtype=np.float32)
+    self._spectra_index = 0
+    self._normalized = np.zeros((self.frame_length_spectra, self.num_mel_bins),
+                                dtype=np.float32)
+    # When the newest audio sample was recorded, in time.time() seconds.
+    self.last_audio_timestamp = None
+
+  def _configure(self, audio_sample_rate_hz):
+    """Look up the mel frontend and size the sample buffer for a sample rate."""
+    if audio_sample_rate_hz == self._sample_rate_hz:
+      return
+    self._sample_rate_hz = audio_sample_rate_hz
+    self._frontend = mel_features.get_mel_frontend(
+        audio_sample_rate_hz,
+        window_length_secs=self.spectrogram_window_length_seconds,
+        hop_length_secs=self.spectrogram_hop_length_seconds,
+        num_mel_bins=self.num_mel_bins,
+        lower_edge_hertz=60,
+        upper_edge_hertz=3800,
+        log_offset=0.001)
+    self._samples = np.zeros(2 * self._required_num_samples(self.frame_hop_spectra))
+    self._num_samples = 0
+
+  def _required_num_samples(self, num_spectra):
+    return (self._frontend.window_length_samples +
+            (num_spectra - 1) * self._frontend.hop_length_samples)
+
+  def _append_audio(self, audio_samples):
+    """Scale int16-range audio to [-1, 1) and append it to the sample buffer."""
+    audio_samples = audio_samples.reshape(-1)
+    end = self._num_samples + len(audio_samples)
+    if end > len(self._samples):
+      samples = np.zeros(2 * end)
+      samples[:self._num_samples] = self._samples[:self._num_samples]
+      self._samples = samples
+    np.divide(audio_samples, float(2**15), out=self._samples[self._num_samples:end],
+              casting='unsafe')
+    self._num_samples = end
+
+  def _compute_spectrogram(self, samples):
+    """Compute the log-mel spectrogram of scaled samples, in uint8 units."""
+    return 30 * (self._frontend(samples) - np.log(1e-3))
 
   def _get_next_spectra(self, recorder, num_spectra):
     """Returns the next spectrogram.
 
-    Compute num_spectra spectrogram samples from an AudioRecorder.
+    Compute num_spectra spectrogram samples from an AudioSource.
     Blocks until num_spectra spectrogram slices are available.
 
     Args:
-      recorder: an AudioRecorder object from which to get raw audio samples.
+      recorder: an AudioSource (such as an AudioRecorder) from which to get
+        raw audio samples.
       num_spectra: the number of spectrogram slices to return.
 
     Returns:
       num_spectra spectrogram slices computed from the samples.
     """
-    required_audio_duration_seconds = self._frame_duration_seconds(num_spectra)
-    logger.info("required_audio_duration_seconds %f",
-                required_audio_duration_seconds)
-    required_num_samples = int(
-        np.ceil(required_audio_duration_seconds *
-                recorder.audio_sample_rate_hz))
-    logger.info("required_num_samples %d, %s", required_num_samples,
-                str(self._audio_buffer.shape))
-    audio_samples = np.concatenate(
-        (self._audio_buffer,
-         recorder.get_audio(required_num_samples - len(self._audio_buffer))[0]))
-    self._audio_buffer = audio_samples[
-        required_num_samples -
-        self._spectrogram_underlap_samples(recorder.audio_sample_rate_hz):]
-    spectrogram = self._compute_spectrogram(
-        audio_samples[:required_num_samples], recorder.audio_sample_rate_hz)
+    self._configure(recorder.audio_sample_rate_hz)
+    required_num_samples = self._required_num_samples(num_spectra)
+    logger.info("required_num_samples %d, buffered %d", required_num_samples,
+                self._num_samples)
+    if self._num_samples < required_num_samples:
+      audio, _, self.last_audio_timestamp = recorder.get_audio(
+          required_num_samples - self._num_samples)
+      self._append_audio(audio)
+    spectrogram = self._compute_spectrogram(self._samples[:required_num_samples])
+    # Keep the samples that the next hop's first window overlaps.
+    consumed = num_spectra * self._frontend.hop_length_samples
+    remaining = self._num_samples - consumed
+    self._samples[:remaining] = self._samples[consumed:self._num_samples]
+    self._num_samples = remaining
     assert len(spectrogram) == num_spectra
     return spectrogram
 
-  def get_next_spectrogram(self, recorder):
+  def _push_spectra(self, spectra):
+    """Add new mel frames to the ring buffer, evicting the oldest ones."""
+    start = self._spectra_index
+    end = start + len(spectra)
+    self._spectra[start:end] = spectra
+    self._spectra[start + self.frame_length_spectra:
+                  end + self.frame_length_spectra] = spectra
+    self._spectra_index = end % self.frame_length_spectra
+
+  @property
+  def newest_spectra(self):
+    """The mel frames added by the last get_next_spectrogram() call, oldest first."""
+    end = self._spectra_index + self.frame_length_spectra
+    return self._spectra[end - self.frame_hop_spectra:end]
+
+  @property
+  def _spectrogram(self):
+    """The most recent frame_length_spectra mel frames, oldest first."""
+    return self._spectra[self._spectra_index:
+                         self._spectra_index + self.frame_length_spectra]
+
+  def get_next_spectrogram(self, recorder, out=None):
     """Get the most recent spectrogram frame.
 
     Blocks until the frame is available.
 
     Args:
-      recorder: an AudioRecorder instance which provides the audio samples.
+      recorder: an AudioSource (such as an AudioRecorder) which provides the
+        audio samples.
+      out: an optional uint8 array of shape (frame_length_spectra,
+        num_mel_bins), such as a view of the model's input tensor, to write
+        the spectrogram to instead of a new array.
 
     Returns:
-      The next spectrogram frame as a uint8 numpy array.
+      The next spectrogram frame as a uint8 numpy array (`out`, if given).
+
+    Raises:
+      EOFError: if the source ran out of audio.
     """
     assert recorder.is_active
-    logger.info("self._spectrogram shape %s", str(self._spectrogram.shape))
-    self._spectrogram[:-self.frame_hop_spectra] = (
-        self._spectrogram[self.frame_hop_spectra:])
-    self._spectrogram[-self.frame_hop_spectra:] = (
-        self._get_next_spectra(recorder, self.frame_hop_spectra))
-    # Return a copy of the internal state that's safe to persist and won't
-    # change the next time we call this function.
-    logger.info("self._spectrogram shape %s", str(self._spectrogram.shape))
-    spectrogram = self._spectrogram.copy()
+    self._push_spectra(self._get_next_spectra(recorder, self.frame_hop_spectra))
+    # Normalize in a buffer of our own, so the ring buffer isn't modified and
+    # the result is safe to persist.
+    spectrogram = self._normalized
+    np.copyto(spectrogram, self._spectrogram)
     spectrogram -= np.mean(spectrogram, axis=0)
     if self._norm_factor:
       spectrogram /= self._norm_factor * np.std(spectrogram, axis=0)
       spectrogram += 1
       spectrogram *= 127.5
-    return np.maximum(0, np.minimum(255, spectrogram)).astype(np.uint8)
+    np.clip(spectrogram, 0, 255, out=spectrogram)
+    if out is None:
+      return spectrogram.astype(np.uint8)
+    np.copyto(out, spectrogram, casting='unsafe')
+    return out
 
 def read_labels(filename):
   # The labels file can be made something like this.
@@ -179,78 +232,411 @@ def set_input(interpreter, data):
     interpreter_shape = interpreter.get_input_details()[0]['shape']
     input_tensor(interpreter)[:,:] = np.reshape(data, interpreter_shape[1:3])
 
-def make_interpreter(model_file):
-  model_file, *device = model_file.split('@')
-  return tflite.Interpreter(
-      model_path=model_file,
-      experimental_delegates=[tflite.load_delegate(_EDGETPU_SHARED_LIB,
-                              {'device': device[0]} if device else {})])
+class KeywordModel(object):
+  """The keyword spotter model, with its tensor details resolved once.
+
+  The input and output functions above look up the tensor details and
+  quantization on every call; this class does it when it is created, so
+  running the model for each hop costs no dict lookups and allocates
+  nothing. The interpreter rejects invoke() while NumPy views of its tensors
+  are alive, so the class keeps the tensor accessor functions rather than
+  the views themselves, and only holds a view while filling or reading it.
+
+  Args:
+    interpreter: An interpreter for the model, with tensors allocated.
+  """
+
+  def __init__(self, interpreter):
+    self.interpreter = interpreter
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+    self._input = interpreter.tensor(input_details['index'])
+    self._output = interpreter.tensor(output_details['index'])
+    self.input_shape = tuple(input_details['shape'][1:])
+    scale, zero_point = output_details.get('quantization', (0.0, 0))
+    self._scale = scale or 1.0
+    self._zero_point = zero_point
+    self._scores = np.zeros(int(np.prod(output_details['shape'])))
+
+  def set_input_from(self, feature_extractor, recorder):
+    """Writes the next spectrogram straight into the input tensor.
+
+    Args:
+      feature_extractor: the Uint8LogMelFeatureExtractor to get it from.
+      recorder: the AudioSource to pass to get_next_spectrogram().
+
+    Returns:
+      The mean value of the spectrogram.
+
+    Raises:
+      EOFError: if the source ran out of audio.
+    """
+    spectrogram = self._input()[0]
+    feature_extractor.get_next_spectrogram(recorder, out=spectrogram)
+    return spectrogram.mean()
+
+  def set_input(self, spectrogram):
+    """Copies a uint8 spectrogram from get_next_spectrogram() into the input tensor."""
+    np.copyto(self._input()[0], spectrogram)
+
+  def invoke(self):
+    self.interpreter.invoke()
+
+  def get_scores(self):
+    """Returns the dequantized score of each label.
+
+    The array is reused by the next call, so copy it to keep it.
+    """
+    np.subtract(self._output().reshape(-1), self._zero_point, out=self._scores)
+    self._scores *= self._scale
+    return self._scores
+
+
+class VoiceActivityDetector(object):
+  """Decides from the mel frames of each hop whether anyone may be speaking.
+
+  Each frame is compared with an adaptive per-band noise floor: a frame is
+  speech if it is more than onset_margin_db above the floor on average, or if
+  its energy rises sharply from the previous frame (spectral flux) while it
+  is at least offset_margin_db above the floor. While speech is active, the
+  lower offset_margin_db is enough to keep it active. A hop is active if it
+  has min_speech_frames speech frames, and stays active for hangover_hops
+  more hops so the model sees the whole word go through its window.
+
+  The floor starts at the level of the first hop, follows quiet frames down
+  quickly and noise up slowly (over a few seconds). During speech it rises
+  ten times slower still, so a lasting change in background noise is
+  eventually absorbed rather than keeping the detector active forever.
+
+  Args:
+    onset_margin_db: How far above the noise floor speech must start.
+    offset_margin_db: How far above the noise floor speech must stay.
+    flux_threshold_db: The average per-band rise between frames that counts
+      as a speech onset.
+    min_speech_frames: The number of speech frames that make a hop active.
+    hangover_hops: How many hops to stay active after the last active hop.
+      The default covers the model's 198-frame window at 33 frames per hop.
+    floor_fall: How fast the noise floor follows quieter frames, per frame.
+    floor_rise: How fast the noise floor follows louder non-speech frames,
+      per frame.
+  """
+
+  # Converts Uint8LogMelFeatureExtractor frames (30 per natural log of
+  # magnitude) to dB.
+  _DB_PER_UNIT = 20 / (30 * np.log(10))
+
+  def __init__(self, onset_margin_db=6.0, offset_margin_db=4.0,
+               flux_threshold_db=4.0, min_speech_frames=3, hangover_hops=6,
+               floor_fall=0.03, floor_rise=0.01):
+    self.onset_margin_db = onset_margin_db
+    self.offset_margin_db = offset_margin_db
+    self.flux_threshold_db = flux_threshold_db
+    self.min_speech_frames = min_speech_frames
+    self.hangover_hops = hangover_hops
+    self._floor_fall = floor_fall
+    self._floor_rise = floor_rise
+    self.reset()
+
+  def reset(self):
+    self.active = False
+    self.invocations = 0
+    self.skipped = 0
+    self._floor = None
+    self._prev_frame = None
+    self._hangover = 0
+
+  def update(self, mel_frames):
+    """Adds one hop of mel frames and returns whether the hop is active.
+
+    Args:
+      mel_frames: The hop's frames from Uint8LogMelFeatureExtractor, as
+        returned by its newest_spectra property.
+    """
+    frames = np.asarray(mel_frames) * self._DB_PER_UNIT
+    if self._floor is None:
+      self._floor = frames.mean(axis=0)
+      self._prev_frame = frames[0]
+    num_speech = 0
+    for frame in frames:
+      margin = frame - self._floor
+      snr = margin.mean()
+      flux = np.maximum(frame - self._prev_frame, 0).mean()
+      self._prev_frame = frame
+      speech = (snr > self.onset_margin_db or
+                snr > self.offset_margin_db and
+                (self.active or flux > self.flux_threshold_db))
+      num_speech += speech
+      rise = self._floor_rise / 10 if speech else self._floor_rise
+      self._floor = self._floor + np.where(
+          margin < 0, self._floor_fall, rise) * margin
+
+    if num_speech >= self.min_speech_frames:
+      self.active = True
+      self._hangover = self.hangover_hops
+    elif self._hangover > 0:
+      self._hangover -= 1
+    else:
+      self.active = False
+    if self.active:
+      self.invocations += 1
+    else:
+      self.skipped += 1
+    return self.active
+
+
+class PosteriorSmoother(object):
+  """Turns the model's per-hop class scores into keyword detections.
+
+  Scores are averaged over the last `window_hops` inferences before picking
+  the top class, which evens out single-hop spikes and dips. A keyword fires
+  once when it becomes the top class, and again only after something else
+  has been on top in between. After any detection, no keyword fires for
+  `refractory_hops` hops. The defaults reproduce the frame-by-frame decisions
+  classify_audio has always made.
+
+  Args:
+    labels: The model's labels; index 0 is the negative class.
+    window_hops: How many hops of scores to average.
+    negative_threshold: Nothing is detected while the smoothed score of the
+      negative class is at least this.
+    label_thresholds: Optional dict of the minimum smoothed score for a label
+      to be detected, by label.
+    refractory_hops: How many hops to wait after a detection before detecting
+      again.
+  """
+
+  def __init__(self, labels, window_hops=1, negative_threshold=0.6,
+               label_thresholds=None, refractory_hops=0):
+    if window_hops < 1:
+      raise ValueError('window_hops must be >= 1, got %d' % window_hops)
+    self._labels = labels
+    self._negative_threshold = negative_threshold
+    self._thresholds = np.zeros(len(labels))
+    for label, threshold in (label_thresholds or {}).items():
+      self._thresholds[labels.index(label)] = threshold
+    self._refractory_hops = refractory_hops
+    self._scores = np.zeros((window_hops, len(labels)))
+    self.reset()
+
+  def reset(self):
+    self._scores[:] = 0
+    self._num_scores = 0
+    self._prev_detection = -1
+    self._hops_since_detection = self._refractory_hops
+
+  def update(self, scores):
+    """Adds one hop of scores.
+
+    Args:
+      scores: The model's score for each label.
+
+    Returns:
+      A (label, smoothed score) tuple if a keyword was detected, else None.
+    """
+    self._scores[self._num_scores % len(self._scores)] = scores
+    self._num_scores += 1
+    smoothed = self._scores[:self._num_scores].mean(axis=0)
+    self._hops_since_detection += 1
+
+    detection = np.argmax(smoothed)
+    if (smoothed[0] >= self._negative_threshold or detection == 0 or
+        smoothed[detection] < self._thresholds[detection]):
+      self._prev_detection = -1
+      return None
+    if detection == self._prev_detection:
+      return None
+    self._prev_detection = detection
+    if self._hops_since_detection <= self._refractory_hops:
+      return None
+    self._hops_since_detection = 0
+    return self._labels[detection], smoothed[detection]
+
+
+make_interpreter = backends.make_interpreter
+
+# The sample rate the keyword spotter model was trained on.
+MODEL_SAMPLE_RATE_HZ = 16000
+
+# The PipelineStats stages classify_audio records: the time to run the model,
+# and the time from recording the newest audio to a result for every hop
+# ('end2end') and for every detection ('detection').
+STAGES = ('inference', 'end2end', 'detection')
 
 def classify_audio(model_file, labels_file, callback,
                    audio_device_index=0, sample_rate_hz=16000,
-                   negative_threshold=0.6, num_frames_hop=33):
-  """Acquire audio, preprocess, and classify."""
-  downsample_factor = 1
-  if sample_rate_hz == 48000:
-    downsample_factor = 3
-  # Most microphones support this
-  # Because the model expects 16KHz audio, we downsample 3 fold
-  recorder = audio_recorder.AudioRecorder(
-      sample_rate_hz,
-      downsample_factor=downsample_factor,
-      device_index=audio_device_index)
+                   negative_threshold=0.6, num_frames_hop=33,
+                   backend=None, num_threads=None, audio_source=None,
+                   stop_event=None, window_hops=1, refractory_hops=0,
+                   label_thresholds=None, stats=None, vad=None):
+  """Acquire audio, preprocess, and classify.
+
+  `sample_rate_hz` is the rate to record at, and may be anything the mic
+  supports (e.g. 48000, 44100, 22050 or 8000); the audio is resampled to the
+  16 kHz the model expects. `backend` and `num_threads` select how the model
+  runs; see `backends`.
+
+  To classify recorded audio instead of the mic, pass an `audio_source` such
+  as an `audio_recorder.WavAudioSource` that provides 16 kHz audio. This
+  returns when the source runs out of audio.
+
+  Classification also stops when `callback` returns False, or when the
+  optional `stop_event` (a `threading.Event`) is set by another thread.
+
+  `negative_threshold`, `window_hops`, `refractory_hops` and
+  `label_thresholds` configure how scores become detections; see
+  `PosteriorSmoother`. Averaging over more hops lets you raise
+  `num_frames_hop` (fewer inferences, less CPU) without double-firing.
+
+  If `stats` is a `pipeline.PipelineStats` with the `STAGES` of this module,
+  the inference time and audio-to-result latencies are recorded in it. By
+  default, they feed the 'keyword.*' metrics (see `metrics`).
+
+  To save power, pass a `VoiceActivityDetector` (or True for one with the
+  default settings) as `vad`: the model then only runs on hops that may
+  contain speech. Its `invocations` and `skipped` attributes count the hops
+  that ran the model and those that didn't, and skipped hops are also counted
+  as `dropped` in the 'inference' stage of `stats`.
+  """
+  if audio_source is None:
+    recorder = audio_recorder.AudioRecorder(
+        sample_rate_hz,
+        device_index=audio_device_index,
+        audio_sample_rate_hz=MODEL_SAMPLE_RATE_HZ)
+  else:
+    recorder = audio_source
   feature_extractor = Uint8LogMelFeatureExtractor(num_frames_hop=num_frames_hop)
   labels = read_labels(labels_file)
 
-  interpreter = make_interpreter(model_file)
+  interpreter = make_interpreter(model_file, backend, num_threads,
+                                 stub=backends.keyword_stub(len(labels)))
   interpreter.allocate_tensors()
-
+  model = KeywordModel(interpreter)
+
+  smoother = PosteriorSmoother(labels, window_hops, negative_threshold,
+                               label_thresholds, refractory_hops)
+  if stats is None:
+    stats = pipeline.PipelineStats(STAGES, metric_prefix='keyword')
+  if vad is True:
+    vad = VoiceActivityDetector(hangover_hops=-(
+        -feature_extractor.frame_length_spectra // num_frames_hop))
+  silence = np.zeros(len(labels))
+  silence[0] = 1.0
   keep_listening = True
-  prev_detection = -1
   with recorder:
-    print("Ready for voice commands...")
-    while keep_listening:
-      spectrogram = feature_extractor.get_next_spectrogram(recorder)
-      if spectrogram.mean() < 0.001:
+    if audio_source is None:
+      print("Ready for voice commands...")
+    while keep_listening and not (stop_event and stop_event.is_set()):
+      try:
+        with metrics.span('keyword.features'):
+          spectrogram_mean = model.set_input_from(feature_extractor, recorder)
+      except EOFError:
+        return
+      if spectrogram_mean < 0.001:
         print("Warning: Input audio signal is nearly 0. Mic may be off ?")
 
-      set_input(interpreter, spectrogram.flatten())
-      interpreter.invoke()
-      result = get_output(interpreter)
-
-      if result[0] >= negative_threshold:
-        prev_detection = -1
+      if vad and not vad.update(feature_extractor.newest_spectra):
+        smoother.update(silence)
+        stats['inference'].drop()
         continue
 
-      detection = np.argmax(result)
-      if detection == 0:
-        prev_detection = -1
-        continue
+      start = time.monotonic()
+      model.invoke()
+      result = model.get_scores()
+      stats['inference'].record(time.monotonic() - start)
+      stats['end2end'].record(time.time() - feature_extractor.last_audio_timestamp)
 
-      if detection != prev_detection:
-        keep_listening = callback(labels[detection], result[detection])
-        prev_detection = detection
+      with metrics.span('keyword.postprocess'):
+        detection = smoother.update(result)
+      if detection:
+        stats['detection'].record(time.time() - feature_extractor.last_audio_timestamp)
+        keep_listening = callback(*detection)
 
 class AudioClassifier:
   """Performs classifications with a speech detection model.
 
+  The model runs on a background thread. Get its results with `next()`, or from asyncio code
+  with `await next_async()` or `async for label, score in classifier`. Call `close()` (or use
+  the classifier as a context manager, `with` or `async with`) to stop the thread.
+
   Args:
     model_file: Path to a `.tflite` speech classification model (compiled for the Edge TPU).\
     labels_file: Path to the corresponding labels file for the model.
     audio_device_index: Specify the device card for your mic. Defaults to 0.
       You can check from the command line with `arecord -l`. On Raspberry Pi, your mic must be via
       USB or a sound card HAT, because the Pi's headphone jack does not support mic input.
+    sample_rate_hz: The rate to record at. Any rate your mic supports works; the audio is
+      resampled to the 16 kHz the model expects.
+    backend: How to run the model: 'edgetpu', 'cpu' or 'stub'. See `backends`.
+    num_threads: The number of threads to use with the 'cpu' backend.
+    audio_source: An `audio_recorder.AudioSource` to classify instead of the mic.
+    **kwargs: Other options for `classify_audio`, such as the smoothing options `window_hops`,
+      `refractory_hops` and `label_thresholds`, or `stats`.
   """
-  def __init__(self, model_file, labels_file, audio_device_index=0):
-    self._thread = threading.Thread(target=classify_audio,
-      args=(model_file, labels_file, self._callback, audio_device_index), daemon=True)
+  def __init__(self, model_file, labels_file, audio_device_index=0, sample_rate_hz=16000,
+               backend=None, num_threads=None, audio_source=None, **kwargs):
+    self._stop_event = threading.Event()
+    self._thread = threading.Thread(target=self._run,
+      args=(model_file, labels_file, self._callback, audio_device_index),
+      kwargs={'sample_rate_hz': sample_rate_hz, 'backend': backend,
+              'num_threads': num_threads, 'audio_source': audio_source,
+              'stop_event': self._stop_event, **kwargs}, daemon=True)
     self._queue = queue.Queue()
+    # Futures of pending next_async() calls, with their event loops, oldest first.
+    self._waiters = collections.deque()
+    self._lock = threading.Lock()
+    self._finished = False
+    self._error = None
     self._thread.start()
 
+  def _run(self, *args, **kwargs):
+    try:
+      classify_audio(*args, **kwargs)
+    except Exception as e:
+      self._error = e
+      raise
+    finally:
+      with self._lock:
+        self._finished = True
+        waiters = list(self._waiters)
+        self._waiters.clear()
+        # None tells blocking next() calls that there are no more results.
+        self._queue.put(None)
+      for loop, future in waiters:
+        loop.call_soon_threadsafe(self._finish_future, future)
+
   def _callback(self, label, score):
-    self._queue.put((label, score))
+    self._dispatch((label, score))
     return True
 
+  def _dispatch(self, result):
+    """Hands a result to the oldest next_async() call, or queues it."""
+    with self._lock:
+      if self._waiters:
+        loop, future = self._waiters.popleft()
+      else:
+        self._queue.put(result)
+        return
+    try:
+      loop.call_soon_threadsafe(self._resolve_future, future, result)
+    except RuntimeError:
+      # The waiter's event loop was closed.
+      self._dispatch(result)
+
+  def _resolve_future(self, future, result):
+    if future.done():
+      # The next_async() call was cancelled before the result arrived, so it goes to the
+      # next caller instead.
+      self._dispatch(result)
+    else:
+      future.set_result(result)
+
+  def _finish_future(self, future):
+    if not future.done():
+      if self._error:
+        future.set_exception(self._error)
+      else:
+        future.set_result(None)
+
   def next(self, block=True):
     """
     Returns a speech classification.
@@ -262,13 +648,336 @@ class AudioClassifier:
       block (boolean): Whether this function should block until the next classification arrives (if
         there are no queued classification). If False, it always returns immediately and returns
         None if the classification queue is empty.
+
+    Returns:
+      A (label, score) tuple, or None if there is none yet (when not blocking) or the classifier
+      has stopped.
     """
     try:
       result = self._queue.get(block)
       self._queue.task_done()
+    except queue.Empty:
+      return None
+    if result is None:
+      # Leave the end marker for other callers.
+      self._queue.put(None)
+    return result
+
+  async def next_async(self):
+    """Waits for the next speech classification without blocking the event loop.
+
+    Returns:
+      A (label, score) tuple, or None if the classifier has stopped.
+
+    Raises:
+      The exception that stopped the classifier thread, if any.
+    """
+    with self._lock:
+      try:
+        result = self._queue.get_nowait()
+      except queue.Empty:
+        if self._finished:
+          result = None
+        else:
+          loop = asyncio.get_running_loop()
+          future = loop.create_future()
+          waiter = (loop, future)
+          self._waiters.append(waiter)
+      else:
+        if result is None:
+          self._queue.put(None)
+        future = None
+    if future is None:
+      if result is None and self._error:
+        raise self._error
       return result
+    try:
+      return await future
+    finally:
+      with self._lock:
+        if waiter in self._waiters:
+          self._waiters.remove(waiter)
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self):
+    result = await self.next_async()
+    if result is None:
+      raise StopAsyncIteration
+    return result
+
+  def close(self, timeout=None):
+    """Stops classification and waits for the background thread to exit.
+
+    Pending `next()` and `next_async()` calls return None.
+
+    Args:
+      timeout: How long to wait for the thread, in seconds. None waits until it exits, which
+        takes at most one hop of audio.
+    """
+    self._stop_event.set()
+    self._thread.join(timeout)
+
+  async def aclose(self):
+    """Like close(), but waits for the thread without blocking the event loop."""
+    await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, traceback):
+    await self.aclose()
+
+class _KeywordStream(object):
+  """The state of one audio stream of a MultiStreamAudioClassifier."""
+
+  def __init__(self, index, recorder, labels, num_frames_hop, smoothing, vad, max_results):
+    self.index = index
+    self.recorder = recorder
+    self.extractor = Uint8LogMelFeatureExtractor(num_frames_hop=num_frames_hop)
+    self.smoother = PosteriorSmoother(labels, **smoothing)
+    if vad:
+      vad = VoiceActivityDetector(hangover_hops=-(
+          -self.extractor.frame_length_spectra // num_frames_hop))
+    self.vad = vad
+    # Hops waiting for the model, oldest first, as (spectrogram, audio
+    # timestamp) tuples. A spectrogram of None is a hop the VAD skipped.
+    self.pending = collections.deque()
+    self.results = pipeline.DropOldestQueue(max_results)
+    self.stats = pipeline.PipelineStats(STAGES, metric_prefix='keyword.%d' % index)
+    self.last_served = 0.0
+    self.finished = False
+
+
+class MultiStreamAudioClassifier:
+  """Performs classifications on several audio streams with one speech detection model.
+
+  Each stream (normally one mic per room) gets its own recorder and feature extractor thread,
+  while a single interpreter, and so a single Edge TPU, is shared between them. Whenever the
+  model is free, it runs on the oldest waiting hop of the stream that it served least recently,
+  so every stream waits for at most one invocation per other stream, and none can starve the
+  others even when there are more hops than the model can keep up with. A hop whose audio is
+  older than `max_latency` seconds is dropped, and counted as dropped in the 'end2end' stage of
+  that stream's stats.
+
+  Get the results of one stream with `next(stream_index)`, or, if `delivery` is 'any', of all
+  streams with `next_any()`. Results wait in bounded queues that drop the oldest result when
+  full, so a caller that stops reading doesn't make them grow forever. Each stream also holds
+  at most `max_pending` hops for the model; when they're all waiting, the stream's capture
+  thread waits too (and a mic's recorder buffers or counts overflows meanwhile).
+
+  Args:
+    model_file: Path to a `.tflite` speech classification model (compiled for the Edge TPU).
+    labels_file: Path to the corresponding labels file for the model.
+    audio_device_indices: The device card of each mic; see `AudioClassifier`.
+    sample_rate_hz: The rate to record at. The audio is resampled to 16 kHz.
+    backend: How to run the model: 'edgetpu', 'cpu' or 'stub'. See `backends`.
+    num_threads: The number of threads to use with the 'cpu' backend.
+    audio_sources: A list of `audio_recorder.AudioSource` to classify instead of mics.
+    num_frames_hop: Spectrogram frames between inferences, for every stream.
+    max_latency: How old a hop's audio may be when the model gets to it, in seconds.
+    vad: Whether to skip hops without speech; see `VoiceActivityDetector`.
+    delivery: 'stream' to get results with `next(stream_index)`, or 'any' to get the results
+      of all streams, in order, with `next_any()`.
+    max_results: The number of results each queue holds before dropping the oldest.
+    max_pending: The number of hops each stream may have waiting for the model.
+    **smoothing: Options for each stream's `PosteriorSmoother`, such as `window_hops`.
+  """
+  def __init__(self, model_file, labels_file, audio_device_indices=(0,), sample_rate_hz=16000,
+               backend=None, num_threads=None, audio_sources=None, num_frames_hop=33,
+               max_latency=1.0, vad=False, delivery='stream', max_results=32, max_pending=8,
+               **smoothing):
+    if delivery not in ('stream', 'any'):
+      raise ValueError("delivery must be 'stream' or 'any', got %r" % (delivery,))
+    if audio_sources is None:
+      audio_sources = [audio_recorder.AudioRecorder(sample_rate_hz, device_index=index,
+                                                    audio_sample_rate_hz=MODEL_SAMPLE_RATE_HZ)
+                       for index in audio_device_indices]
+    self._labels = read_labels(labels_file)
+    self._silence = np.zeros(len(self._labels))
+    self._silence[0] = 1.0
+    self._streams = [_KeywordStream(i, source, self._labels, num_frames_hop, smoothing, vad,
+                                    max_results)
+                     for i, source in enumerate(audio_sources)]
+    self._max_latency = max_latency
+    self._max_pending = max_pending
+    self._delivery = delivery
+    self._any_results = pipeline.DropOldestQueue(max_results)
+    self._cond = threading.Condition()
+    self._stop_event = threading.Event()
+
+    interpreter = make_interpreter(model_file, backend, num_threads,
+                                   stub=backends.keyword_stub(len(self._labels)))
+    interpreter.allocate_tensors()
+    self._model = KeywordModel(interpreter)
+
+    self._threads = [threading.Thread(target=self._capture, args=(stream,), daemon=True)
+                     for stream in self._streams]
+    self._threads.append(threading.Thread(target=self._classify, daemon=True))
+    for thread in self._threads:
+      thread.start()
+
+  @property
+  def num_streams(self):
+    return len(self._streams)
+
+  @property
+  def stats(self):
+    """A `pipeline.PipelineStats` with `STAGES` for each stream.
+
+    Stream i also feeds the 'keyword.<i>.*' metrics (see `metrics`).
+    """
+    return [stream.stats for stream in self._streams]
+
+  def _capture(self, stream):
+    """Computes the spectrograms of one stream and queues them for the model."""
+    try:
+      with stream.recorder:
+        while not self._stop_event.is_set():
+          try:
+            spectrogram = stream.extractor.get_next_spectrogram(stream.recorder)
+          except EOFError:
+            return
+          if stream.vad and not stream.vad.update(stream.extractor.newest_spectra):
+            spectrogram = None
+          with self._cond:
+            self._cond.wait_for(lambda: (len(stream.pending) < self._max_pending or
+                                         self._stop_event.is_set()))
+            stream.pending.append((spectrogram, stream.extractor.last_audio_timestamp))
+            self._cond.notify_all()
+    finally:
+      with self._cond:
+        stream.finished = True
+        self._cond.notify_all()
+
+  def _next_hop(self):
+    """Waits for the next hop to classify, or returns None when done.
+
+    Hops that are already too old are dropped on the way.
+    """
+    def ready():
+      return (self._stop_event.is_set() or any(s.pending for s in self._streams) or
+              all(s.finished for s in self._streams))
+    while True:
+      with self._cond:
+        self._cond.wait_for(ready)
+        if self._stop_event.is_set():
+          return None
+        oldest = time.time() - self._max_latency
+        for stream in self._streams:
+          while stream.pending and stream.pending[0][1] < oldest:
+            stream.pending.popleft()
+            stream.stats['end2end'].drop()
+        waiting = [s for s in self._streams if s.pending]
+        if waiting:
+          stream = min(waiting, key=lambda s: s.last_served)
+          stream.last_served = time.monotonic()
+          spectrogram, timestamp = stream.pending.popleft()
+          # Wake capture threads waiting for room in their pending hops.
+          self._cond.notify_all()
+          return stream, spectrogram, timestamp
+        if all(s.finished for s in self._streams):
+          return None
+
+  def _classify(self):
+    """Runs the model on the queued hops of all streams, one at a time."""
+    try:
+      while True:
+        hop = self._next_hop()
+        if hop is None:
+          return
+        stream, spectrogram, timestamp = hop
+        if spectrogram is None:
+          stream.smoother.update(self._silence)
+          stream.stats['inference'].drop()
+          continue
+
+        start = time.monotonic()
+        self._model.set_input(spectrogram)
+        self._model.invoke()
+        result = self._model.get_scores()
+        stream.stats['inference'].record(time.monotonic() - start)
+        stream.stats['end2end'].record(time.time() - timestamp)
+
+        detection = stream.smoother.update(result)
+        if detection:
+          stream.stats['detection'].record(time.time() - timestamp)
+          if self._delivery == 'any':
+            self._any_results.put((stream.index,) + detection)
+          else:
+            stream.results.put(detection)
+    finally:
+      # None tells blocking next() calls that there are no more results.
+      for stream in self._streams:
+        stream.results.put(None)
+      self._any_results.put(None)
+
+  @staticmethod
+  def _get(results, block):
+    try:
+      result = results.get() if block else results.get_nowait()
     except queue.Empty:
       return None
+    if result is None:
+      # Leave the end marker for other callers.
+      results.put(None)
+    return result
+
+  def next(self, stream_index, block=True):
+    """
+    Returns a speech classification from one stream.
+
+    Args:
+      stream_index: The index of the stream, in the order of `audio_device_indices` (or
+        `audio_sources`).
+      block (boolean): Whether to wait for the next classification if there is none queued.
+
+    Returns:
+      A (label, score) tuple, or None if there is none yet (when not blocking) or the classifier
+      has stopped.
+
+    Raises:
+      ValueError: if the classifier delivers results to `next_any()` instead.
+    """
+    if self._delivery != 'stream':
+      raise ValueError("next() needs delivery='stream'")
+    return self._get(self._streams[stream_index].results, block)
+
+  def next_any(self, block=True):
+    """
+    Returns the next speech classification from any stream.
+
+    Returns:
+      A (stream_index, label, score) tuple, or None if there is none yet (when not blocking)
+      or the classifier has stopped.
+
+    Raises:
+      ValueError: if the classifier delivers results to `next()` instead.
+    """
+    if self._delivery != 'any':
+      raise ValueError("next_any() needs delivery='any'")
+    return self._get(self._any_results, block)
+
+  def close(self, timeout=None):
+    """Stops classification and waits for the background threads to exit."""
+    self._stop_event.set()
+    with self._cond:
+      self._cond.notify_all()
+    for thread in self._threads:
+      thread.join(timeout)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
 
 VOICE_MODEL = 'models/voice_commands_v0.7_edgetpu.tflite'
 VOICE_LABELS = 'models/labels_gc2.raw.txt'
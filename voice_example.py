@@ -12,6 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+
+import metrics
 import voice
 
 def callback(label, score):
@@ -33,6 +36,20 @@ def run_audio_classifier():
     label, score = c.next()
     print(label, score)
 
+async def run_audio_classifier_async():
+  async with voice.AudioClassifier(model_file=voice.VOICE_MODEL,
+                                   labels_file=voice.VOICE_LABELS,
+                                   audio_device_index=2) as c:
+    async for label, score in c:
+      print(label, score)
+      if label.startswith('exit'):
+        break
+
+def run_audio_classifier_in_event_loop():
+  asyncio.run(run_audio_classifier_async())
+
 if __name__ == '__main__':
+  metrics.start_from_env()
   #run_classify_audio()
   run_audio_classifier()
+  #run_audio_classifier_in_event_loop()